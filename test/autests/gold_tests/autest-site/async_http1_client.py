@@ -0,0 +1,294 @@
+'''
+Implement an asyncio HTTP/1 client for proxying to the origin.
+'''
+# @file
+#
+# Copyright 2023, Verizon Media
+# SPDX-License-Identifier: Apache-2.0
+#
+
+
+import asyncio
+import http.client
+import io
+
+
+class AsyncHttp1Response:
+    """
+    An HTTP/1 response read by AsyncHttp1Connection.
+
+    Its attributes mirror those of http.client.HTTPResponse, with the body
+    already read, or, for a streamed response, with chunks iterating over
+    the body as it is read.
+    """
+
+    def __init__(self, version, status, reason, headers, body, chunks=None):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.msg = headers
+        self.body = body
+        self.chunks = chunks
+
+
+class AsyncHttp1Connection:
+    """
+    A keep-alive HTTP/1.1 connection to the origin, driven by asyncio.
+
+    The connection is made by the first request rather than on construction,
+    so that connections can be created synchronously by an
+    UpstreamConnectionPool. Like http.client.HTTPConnection, the connection
+    exposes a sock attribute, which is None once the connection cannot carry
+    another request, so that the pool can tell reusable connections apart.
+
+    Requests are written as http.client would write them: a Host and an
+    Accept-Encoding: identity field are added if missing, as is the
+    Content-Length of a body, and an iterated body of unknown length is sent
+    chunked. Each read from the origin times out after
+    timeout seconds, like a socket timeout of http.client.
+
+    Request bodies may be streamed to the origin, and response bodies
+    streamed from it, a chunk at a time. Writes wait for the origin to keep
+    up, so that neither direction buffers the whole body.
+
+    >>> async def exchange():
+    ...     async def respond(reader, writer):
+    ...         await reader.readuntil(b'\\r\\n\\r\\n')
+    ...         writer.write(b'HTTP/1.1 200 OK\\r\\nContent-Length: 2\\r\\n\\r\\nok')
+    ...     server = await asyncio.start_server(respond, '127.0.0.1', 0)
+    ...     port = server.sockets[0].getsockname()[1]
+    ...     connection = AsyncHttp1Connection('127.0.0.1', port)
+    ...     response = await connection.request('GET', '/', None, {})
+    ...     reusable = connection.sock is not None
+    ...     connection.close()
+    ...     server.close()
+    ...     return response.status, response.reason, response.body, reusable
+    >>> asyncio.run(exchange())
+    (200, 'OK', b'ok', True)
+
+    >>> async def upload():
+    ...     received = asyncio.get_running_loop().create_future()
+    ...     async def respond(reader, writer):
+    ...         request = await reader.readuntil(b'\\r\\n0\\r\\n\\r\\n')
+    ...         received.set_result(request.partition(b'\\r\\n\\r\\n')[2])
+    ...         writer.write(b'HTTP/1.1 204 No Content\\r\\n\\r\\n')
+    ...     server = await asyncio.start_server(respond, '127.0.0.1', 0)
+    ...     port = server.sockets[0].getsockname()[1]
+    ...     connection = AsyncHttp1Connection('127.0.0.1', port)
+    ...     async def body():
+    ...         yield b'abc'
+    ...         yield b'de'
+    ...     response = await connection.request('POST', '/', body(), {})
+    ...     connection.close()
+    ...     server.close()
+    ...     return response.status, await received
+    >>> asyncio.run(upload())
+    (204, b'3\\r\\nabc\\r\\n2\\r\\nde\\r\\n0\\r\\n\\r\\n')
+    """
+
+    # The longest line, or header block, that can be read from the origin.
+    READ_LIMIT = 1 << 20
+    # The most body bytes read from the origin at a time.
+    BODY_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+
+    @property
+    def sock(self):
+        """
+        The connection's socket, or None if the connection is not usable.
+        """
+        if self._writer is None or self._writer.is_closing() or self._reader.at_eof():
+            return None
+        return self._writer.get_extra_info('socket')
+
+    async def request(self, method, path, body, headers, stream=False):
+        """
+        Send a request and read its response.
+
+        Args:
+            method: The request method.
+
+            path: The request target.
+
+            body: The request body as bytes, None, or an async iterable of
+            the body's chunks. An iterated body is sent chunked unless the
+            headers give its Content-Length.
+
+            headers: A mapping of the request header fields, such as an
+            http.client.HTTPMessage.
+
+            stream: Whether to return once the response's header block is
+            read rather than once the whole response is. The body is then
+            read by iterating over the response's chunks, and the
+            connection can only carry another request once they are
+            exhausted.
+
+        Returns:
+            The AsyncHttp1Response.
+        """
+        if self._writer is None:
+            self._reader, self._writer = await self._with_timeout(
+                asyncio.open_connection(self.host, self.port, limit=self.READ_LIMIT))
+        if body is None or isinstance(body, (bytes, bytearray)):
+            self._writer.write(self._encode_request(method, path, body, headers))
+        else:
+            chunked = 'content-length' not in {name.lower() for name in headers.keys()}
+            self._writer.write(self._encode_request(method, path, None, headers, chunked))
+            async for chunk in body:
+                if chunked:
+                    if not chunk:
+                        # An empty chunk would end the body.
+                        continue
+                    chunk = b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                self._writer.write(chunk)
+                await self._writer.drain()
+            if chunked:
+                self._writer.write(b'0\r\n\r\n')
+        await self._writer.drain()
+        response = await self._with_timeout(self._read_head(self._reader))
+        response.chunks = self._iter_body(response, method)
+        if not stream:
+            response.body = b''.join([chunk async for chunk in response.chunks])
+            response.chunks = None
+        return response
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+
+    async def _with_timeout(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+    def _encode_request(self, method, path, body, headers, chunked=False):
+        lines = [f'{method} {path} HTTP/1.1']
+        names = {name.lower() for name in headers.keys()}
+        if 'host' not in names:
+            lines.append(f'Host: {self.host}:{self.port}')
+        if 'accept-encoding' not in names:
+            lines.append('Accept-Encoding: identity')
+        if chunked and 'transfer-encoding' not in names:
+            lines.append('Transfer-Encoding: chunked')
+        if body is not None and 'content-length' not in names and \
+                'transfer-encoding' not in names:
+            lines.append(f'Content-Length: {len(body)}')
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        return head + body if body else head
+
+    async def _iter_body(self, response, method):
+        """
+        Read the response body chunk by chunk, then close the connection if
+        it cannot carry another request.
+        """
+        chunks = self._read_body(self._reader, response, method)
+        try:
+            while True:
+                try:
+                    chunk = await self._with_timeout(chunks.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except BaseException:
+            # The rest of the body is still to be read.
+            self.close()
+            raise
+        if response.version == 10 or self._reader.at_eof() or \
+                'close' in response.headers.get('Connection', '').lower():
+            self.close()
+
+    @staticmethod
+    async def _read_head(reader):
+        """
+        Read a response's status line and header block, skipping any
+        interim 1xx responses.
+
+        >>> async def parse(data):
+        ...     reader = asyncio.StreamReader()
+        ...     reader.feed_data(data)
+        ...     response = await AsyncHttp1Connection._read_head(reader)
+        ...     return response.version, response.status, response.headers['X-A']
+        >>> asyncio.run(parse(
+        ...     b'HTTP/1.1 100 Continue\\r\\n\\r\\n'
+        ...     b'HTTP/1.1 200 OK\\r\\nX-A: 1\\r\\n\\r\\n'))
+        (11, 200, '1')
+        """
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            status_line, _, header_block = head.partition(b'\r\n')
+            version, status, reason = (status_line.decode('latin-1').split(None, 2) + [''])[:3]
+            if not version.startswith('HTTP/1.'):
+                raise http.client.BadStatusLine(status_line)
+            status = int(status)
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+            if not 100 <= status < 200:
+                break
+        version = 10 if version == 'HTTP/1.0' else 11
+        return AsyncHttp1Response(version, status, reason.strip(), headers, None)
+
+    @staticmethod
+    async def _read_body(reader, response, method):
+        """
+        Generate the chunks of a response's body as they are read.
+
+        >>> async def parse(data, method='GET'):
+        ...     reader = asyncio.StreamReader()
+        ...     reader.feed_data(data)
+        ...     reader.feed_eof()
+        ...     response = await AsyncHttp1Connection._read_head(reader)
+        ...     chunks = AsyncHttp1Connection._read_body(reader, response, method)
+        ...     return [chunk async for chunk in chunks]
+        >>> asyncio.run(parse(
+        ...     b'HTTP/1.1 200 OK\\r\\nTransfer-Encoding: chunked\\r\\n\\r\\n'
+        ...     b'3\\r\\nabc\\r\\n2;ext=1\\r\\nde\\r\\n0\\r\\n\\r\\n'))
+        [b'abc', b'de']
+        >>> asyncio.run(parse(b'HTTP/1.0 200 OK\\r\\n\\r\\nuntil close'))
+        [b'until close']
+        >>> asyncio.run(parse(
+        ...     b'HTTP/1.1 200 OK\\r\\nContent-Length: 5\\r\\n\\r\\n', 'HEAD'))
+        []
+        """
+        headers = response.headers
+        chunk_size = AsyncHttp1Connection.BODY_CHUNK_SIZE
+        if method == 'HEAD' or response.status in (204, 304):
+            return
+        elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            while True:
+                size_line = await reader.readuntil(b'\r\n')
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    break
+                while size:
+                    chunk = await reader.readexactly(min(size, chunk_size))
+                    size -= len(chunk)
+                    yield chunk
+                await reader.readexactly(2)
+            # Skip any trailer fields.
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass
+        elif headers.get('Content-Length') is not None:
+            remaining = int(headers['Content-Length'])
+            while remaining:
+                chunk = await reader.readexactly(min(remaining, chunk_size))
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            # The body is delimited by the origin closing the connection.
+            while True:
+                chunk = await reader.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,190 @@
+'''
+Implement a background writer of log files for the test proxies.
+'''
+# @file
+#
+# Copyright 2023, Verizon Media
+# SPDX-License-Identifier: Apache-2.0
+#
+
+
+import atexit
+import os
+import queue
+import sys
+import threading
+
+
+class BackgroundFileWriter:
+    """
+    Append records to files from a background thread.
+
+    write() only queues a record. A writer thread renders the records,
+    appends them to their files, opening the files as needed, and flushes
+    the files whenever the queue runs empty. Neither rendering nor disk I/O
+    therefore happens on the caller's thread, which is typically an event
+    loop.
+
+    The queue is bounded. Once max_queued records wait, write() drops the
+    record rather than wait for the writer, unless asked to block, and
+    counts it in dropped.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'log')
+    >>> writer = BackgroundFileWriter()
+    >>> writer.write(path, {'a': 1}, render=lambda record: f"{record['a']}\\n")
+    True
+    >>> stream = writer.stream(path)
+    >>> stream.write('2\\n')
+    >>> stream.flush()
+    >>> writer.close_file(path)
+    >>> writer.close()
+    >>> with open(path, encoding='utf-8') as f:
+    ...     print(f.read(), end='')
+    1
+    2
+    """
+
+    # The default bound on the records waiting for the writer thread.
+    MAX_QUEUED = 10000
+
+    _STOP = object()
+
+    def __init__(self, max_queued=MAX_QUEUED):
+        """
+        Args:
+            max_queued: How many records may wait for the writer thread
+            before write() drops them.
+        """
+        self._max_queued = max_queued
+        self._start_lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # The writer thread does not survive a fork. Give the child its own.
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._queue = queue.Queue(self._max_queued)
+        self._writer = None
+        self._closed = False
+        self.dropped = 0
+
+    def write(self, path, record, render=None, block=False):
+        """
+        Queue a record to be appended to a file.
+
+        Args:
+            path: The file to append to.
+
+            record: The text to append, or an object for render to turn into
+            text. It must not be modified after this call.
+
+            render: A function turning the record into the text to append,
+            called on the writer thread. By default the record is the text.
+
+            block: Whether to wait for room in the queue rather than drop the
+            record.
+
+        Returns:
+            False if the record was dropped, True otherwise.
+        """
+        if self._closed:
+            return False
+        if self._writer is None:
+            self._start_writer()
+        try:
+            self._queue.put((path, record, render), block=block)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close_file(self, path):
+        """
+        Close the file once the records queued for it so far are written.
+        """
+        if not self._closed and self._writer is not None:
+            self._queue.put((path, None, None))
+
+    def stream(self, path):
+        """
+        Return a file-like object whose writes are queued for path. Its
+        writes are never dropped.
+        """
+        return _BackgroundStream(self, path)
+
+    def close(self):
+        """
+        Write out everything queued so far and stop the writer thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._queue.put(BackgroundFileWriter._STOP)
+            self._writer.join()
+        if self.dropped:
+            print(f"Dropped {self.dropped} log records the writer could not keep up with.",
+                  file=sys.stderr)
+
+    def _start_writer(self):
+        with self._start_lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(
+                target=self._write_records, name='background-writer', daemon=True)
+            self._writer.start()
+
+    def _write_records(self):
+        files = {}
+        while True:
+            item = self._queue.get()
+            # Write everything that has queued up, then flush once.
+            while True:
+                if item is BackgroundFileWriter._STOP:
+                    for f in files.values():
+                        f.close()
+                    return
+                path, record, render = item
+                try:
+                    if record is None:
+                        f = files.pop(path, None)
+                        if f is not None:
+                            f.close()
+                    else:
+                        f = files.get(path)
+                        if f is None:
+                            f = files[path] = open(path, 'a', encoding='utf-8')
+                        f.write(record if render is None else render(record))
+                except Exception as e:
+                    print(f"Failed to write to {path}: {e}", file=sys.stderr)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            for f in files.values():
+                f.flush()
+
+
+class _BackgroundStream:
+    """
+    A file-like object writing through a BackgroundFileWriter.
+    """
+
+    def __init__(self, writer, path):
+        self._writer = writer
+        self._path = path
+
+    def write(self, text):
+        self._writer.write(self._path, text, block=True)
+
+    def flush(self):
+        # The writer flushes the file once it has caught up.
+        pass
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
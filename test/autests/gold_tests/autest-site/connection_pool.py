@@ -0,0 +1,194 @@
+'''
+Implement a process-wide pool of keep-alive connections to the origin.
+'''
+# @file
+#
+# Copyright 2023, Verizon Media
+# SPDX-License-Identifier: Apache-2.0
+#
+
+
+import collections
+import select
+import threading
+import time
+
+
+class UpstreamConnectionPool:
+    """
+    A bounded pool of idle keep-alive connections to the origin.
+
+    Connections are checked out with acquire() for the duration of a single
+    transaction and handed back with release() once the response has been
+    fully read. Idle connections are keyed by the caller, typically by
+    (scheme, server, sni, proxy protocol header), so that a connection is only
+    reused for transactions that would have produced an identical connection.
+
+    The pool is safe to share across the proxy's handler threads.
+
+    >>> import socket
+    >>> class FakeConnection:
+    ...     def __init__(self):
+    ...         self.sock, self.peer = socket.socketpair()
+    ...     def close(self):
+    ...         self.sock.close()
+    ...         self.peer.close()
+    ...         self.sock = None
+    >>> pool = UpstreamConnectionPool(max_idle_per_key=1)
+    >>> key = ('http', '127.0.0.1:8080', None, None)
+    >>> first = pool.acquire(key, FakeConnection)
+    >>> pool.release(key, first)
+    >>> pool.acquire(key, FakeConnection) is first
+    True
+
+    Only max_idle_per_key connections are kept per key. The oldest are closed.
+
+    >>> second = pool.acquire(key, FakeConnection)
+    >>> pool.release(key, first)
+    >>> pool.release(key, second)
+    >>> first.sock is None, second.sock is None
+    (True, False)
+
+    Connections the origin has since closed are not handed out again.
+
+    >>> second.peer.close()
+    >>> pool.acquire(key, FakeConnection) is second
+    False
+    >>> len(pool)
+    0
+    """
+
+    def __init__(self, max_idle_per_key=8, max_idle_total=64, idle_timeout=30.0):
+        """
+        Args:
+            max_idle_per_key: The maximum number of idle connections kept for
+            any one key.
+
+            max_idle_total: The maximum number of idle connections kept
+            across all keys.
+
+            idle_timeout: The number of seconds after which an idle
+            connection is closed instead of being reused.
+        """
+        self.max_idle_per_key = max_idle_per_key
+        self.max_idle_total = max_idle_total
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # key -> deque of (connection, release time), oldest on the left.
+        self._idle = {}
+        self._num_idle = 0
+
+    def __len__(self):
+        return self._num_idle
+
+    def acquire(self, key, create_connection):
+        """
+        Check out a connection for the given key.
+
+        Args:
+            key: The hashable pool key identifying the origin.
+
+            create_connection: A callable taking no arguments that creates a
+            new connection if no healthy idle one is available.
+
+        Returns:
+            A connection to be used for one transaction.
+        """
+        while True:
+            candidate = None
+            expired = []
+            now = time.monotonic()
+            with self._lock:
+                idle = self._idle.get(key)
+                while idle:
+                    # Prefer the most recently used connection: it is the
+                    # least likely to have been closed by the origin.
+                    conn, released_at = idle.pop()
+                    self._num_idle -= 1
+                    if now - released_at > self.idle_timeout:
+                        expired.append(conn)
+                        continue
+                    candidate = conn
+                    break
+                if idle is not None and not idle:
+                    del self._idle[key]
+            for conn in expired:
+                conn.close()
+            if candidate is None:
+                return create_connection()
+            if self._is_healthy(candidate):
+                return candidate
+            candidate.close()
+
+    def release(self, key, conn):
+        """
+        Return a connection to the pool after a completed transaction.
+
+        Connections whose socket has been closed, as http.client does when the
+        origin responds with "Connection: close", are dropped.
+        """
+        if getattr(conn, 'sock', None) is None:
+            return
+        to_close = []
+        with self._lock:
+            idle = self._idle.setdefault(key, collections.deque())
+            idle.append((conn, time.monotonic()))
+            self._num_idle += 1
+            while len(idle) > self.max_idle_per_key:
+                to_close.append(idle.popleft()[0])
+                self._num_idle -= 1
+            while self._num_idle > self.max_idle_total:
+                to_close.append(self._pop_oldest())
+        for conn in to_close:
+            conn.close()
+
+    def discard(self, conn):
+        """
+        Close a checked out connection that can no longer be used.
+        """
+        conn.close()
+
+    def close_all(self):
+        """
+        Close every idle connection.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            self._num_idle = 0
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+    def _pop_oldest(self):
+        """
+        Remove and return the least recently released idle connection.
+
+        The caller must hold the lock.
+        """
+        oldest_key = min(self._idle, key=lambda k: self._idle[k][0][1])
+        idle = self._idle[oldest_key]
+        conn, _ = idle.popleft()
+        if not idle:
+            del self._idle[oldest_key]
+        self._num_idle -= 1
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn):
+        """
+        Determine whether an idle connection can still carry a request.
+
+        An idle keep-alive socket should have nothing to read. If it is
+        readable, the origin either closed it or sent unsolicited data, and
+        in both cases it cannot be reused.
+        """
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        try:
+            if hasattr(sock, 'pending') and sock.pending():
+                return False
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
@@ -8,7 +8,11 @@ Implement X-Proxy-Directive behavior.
 #
 
 
+import email.message
+import functools
+import math
 import re
+import time
 
 
 class Directive:
@@ -38,6 +42,28 @@ class Directive:
         """
         raise NotImplementedError("Must be implemented in derived class.")
 
+    def add_to_plan(self, plan):
+        """
+        Record the directive's header manipulation in a HeaderRewritePlan.
+
+        This must have the same effect on the headers as apply_headers. The
+        default implementation records nothing.
+
+        Args:
+            plan: The HeaderRewritePlan to add to.
+        """
+        pass
+
+    def add_to_pacing(self, pacing):
+        """
+        Record the directive's effect on the timing of the message in a
+        Pacing. The default implementation records nothing.
+
+        Args:
+            pacing: The Pacing to add to.
+        """
+        pass
+
     def apply_url(self):
         """
         Another public interface of all Directive objects.
@@ -61,6 +87,9 @@ class Directive:
         >>> d = Directive.directive_factory("insert", "X-Request-ID: 3")
         >>> type(d) == InsertDirective
         True
+        >>> d = Directive.directive_factory("stall", "100:250")
+        >>> type(d) == StallDirective
+        True
         """
         if command.lower() == DeleteDirective.get_command_name().lower():
             return DeleteDirective(value)
@@ -68,6 +97,14 @@ class Directive:
             return InsertDirective(value)
         if command.lower() == SetURLDirective.get_command_name().lower():
             return SetURLDirective(value)
+        if command.lower() == DelayDirective.get_command_name().lower():
+            return DelayDirective(value)
+        if command.lower() == ThrottleDirective.get_command_name().lower():
+            return ThrottleDirective(value)
+        if command.lower() == ChunkSizeDirective.get_command_name().lower():
+            return ChunkSizeDirective(value)
+        if command.lower() == StallDirective.get_command_name().lower():
+            return StallDirective(value)
         return None
 
 
@@ -163,6 +200,9 @@ class DeleteDirective(Directive):
             pass
         return headers
 
+    def add_to_plan(self, plan):
+        plan.delete(self._field_name_to_delete)
+
     def apply_url(self):
         """
         >>> d = DeleteDirective('x-test')
@@ -231,6 +271,9 @@ class InsertDirective(Directive):
         headers[self._new_field_name] = self._new_field_value
         return headers
 
+    def add_to_plan(self, plan):
+        plan.insert(self._new_field_name, self._new_field_value)
+
     def apply_url(self):
         """
         >>> d = InsertDirective('x-request-id:    5')
@@ -240,6 +283,487 @@ class InsertDirective(Directive):
         return None
 
 
+def _parse_number(description, value, minimum):
+    """
+    Parse the numeric value of a pacing directive.
+
+    >>> _parse_number('Delay', ' 250 ', 0)
+    250.0
+    >>> _parse_number('ChunkSize', '0', 1)
+    Traceback (most recent call last):
+    ...
+    ValueError: ChunkSize directive value must be at least 1: 0
+    >>> _parse_number('Delay', 'nan', 0)
+    Traceback (most recent call last):
+    ...
+    ValueError: Delay directive value is not a finite number: nan
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{description} directive value is not a number: {value}")
+    if not math.isfinite(number):
+        raise ValueError(f"{description} directive value is not a finite number: {value}")
+    if number < minimum:
+        raise ValueError(f"{description} directive value must be at least {minimum}: {value}")
+    return number
+
+
+class PacingDirective(Directive):
+    """
+    The base class for the directives controlling the timing of a message
+    rather than its content.
+
+    A pacing directive in a request's X-Proxy-Directive paces the request
+    sent to the server, one in a response's paces the response sent to the
+    client.
+    """
+
+    def apply_headers(self, headers):
+        """
+        >>> import email.message
+        >>> headers = email.message.Message()
+        >>> headers.add_header('Host', 'example.com')
+        >>> d = DelayDirective('10')
+        >>> len(d.apply_headers(headers))
+        1
+        """
+        return headers
+
+    def apply_url(self):
+        """
+        >>> d = ThrottleDirective('1000')
+        >>> d.apply_url() is None
+        True
+        """
+        return None
+
+
+class DelayDirective(PacingDirective):
+    """
+    Implement the delay directive.
+
+    This is associated with the Delay=%<milliseconds%> specification. The
+    message is held for the given number of milliseconds before it is sent,
+    but for no longer than Pacing.MAX_WAIT.
+
+    >>> pacing = Pacing()
+    >>> DelayDirective('3600000').add_to_pacing(pacing)
+    >>> pacing.delay
+    60.0
+    """
+
+    _command_name = "Delay"
+
+    def __init__(self, milliseconds):
+        self._delay = min(
+            _parse_number(self._command_name, milliseconds, 0) / 1000, Pacing.MAX_WAIT)
+
+    @staticmethod
+    def get_command_name():
+        """
+        Return the command name associated with this Directive.
+        """
+        return DelayDirective._command_name
+
+    def add_to_pacing(self, pacing):
+        pacing.delay = self._delay
+
+
+class ThrottleDirective(PacingDirective):
+    """
+    Implement the throttle directive.
+
+    This is associated with the Throttle=%<bytes_per_second%> specification.
+    The message body is sent no faster than the given rate.
+    """
+
+    _command_name = "Throttle"
+
+    def __init__(self, bytes_per_second):
+        self._bytes_per_second = _parse_number(self._command_name, bytes_per_second, 1)
+
+    @staticmethod
+    def get_command_name():
+        """
+        Return the command name associated with this Directive.
+        """
+        return ThrottleDirective._command_name
+
+    def add_to_pacing(self, pacing):
+        pacing.bytes_per_second = self._bytes_per_second
+
+
+class ChunkSizeDirective(PacingDirective):
+    """
+    Implement the chunk size directive.
+
+    This is associated with the ChunkSize=%<bytes%> specification. The
+    message body is written in pieces of at most the given number of bytes.
+    """
+
+    _command_name = "ChunkSize"
+
+    def __init__(self, chunk_size):
+        self._chunk_size = int(_parse_number(self._command_name, chunk_size, 1))
+
+    @staticmethod
+    def get_command_name():
+        """
+        Return the command name associated with this Directive.
+        """
+        return ChunkSizeDirective._command_name
+
+    def add_to_pacing(self, pacing):
+        pacing.chunk_size = self._chunk_size
+
+
+class StallDirective(PacingDirective):
+    """
+    Implement the stall directive.
+
+    This is associated with the Stall=%<after_bytes:milliseconds%>
+    specification. Once after_bytes bytes of the message body have been sent,
+    sending pauses for the given number of milliseconds, but for no longer
+    than Pacing.MAX_WAIT. Several stalls may be specified for the same
+    message.
+    """
+
+    _command_name = "Stall"
+
+    def __init__(self, stall):
+        after_bytes, separator, milliseconds = stall.partition(':')
+        if not separator:
+            raise ValueError(f"Stall directive value has no colon: {stall}")
+        self._after_bytes = int(_parse_number(self._command_name, after_bytes, 0))
+        self._duration = min(
+            _parse_number(self._command_name, milliseconds, 0) / 1000, Pacing.MAX_WAIT)
+
+    @staticmethod
+    def get_command_name():
+        """
+        Return the command name associated with this Directive.
+        """
+        return StallDirective._command_name
+
+    def add_to_pacing(self, pacing):
+        pacing.add_stall(self._after_bytes, self._duration)
+
+
+class Pacing:
+    """
+    The timing requested for a message by its pacing directives.
+
+    A Pacing only describes the requested timing. The proxies carry it out,
+    each with the waiting mechanism of its own event loop, with the help of a
+    Pacer.
+
+    >>> pacing = DirectiveProgram.compile('Delay=%<1500%> Throttle=%<100%>').pacing
+    >>> pacing.delay, pacing.bytes_per_second, pacing.paces_body
+    (1.5, 100.0, True)
+    >>> DirectiveProgram.compile('Insert=%<X-A: 1%>').pacing.is_paced
+    False
+    """
+
+    # Without a ChunkSize, a throttled body is written in pieces of roughly a
+    # tenth of a second's worth of bytes, capped at this size.
+    MAX_THROTTLED_CHUNK_SIZE = 16 * 1024
+    # The longest a Delay or a Stall holds a message up, in seconds, so that
+    # a mistyped directive does not hang the transaction.
+    MAX_WAIT = 60.0
+
+    def __init__(self):
+        # Seconds to hold the message before sending it.
+        self.delay = 0.0
+        self.bytes_per_second = None
+        self.chunk_size = None
+        # (after_bytes, seconds) pairs, ordered by after_bytes.
+        self.stalls = []
+
+    def add_stall(self, after_bytes, seconds):
+        self.stalls.append((after_bytes, seconds))
+        self.stalls.sort(key=lambda stall: stall[0])
+
+    @property
+    def paces_body(self):
+        """
+        Whether the body has to be sent in paced pieces.
+        """
+        return bool(self.bytes_per_second or self.chunk_size or self.stalls)
+
+    @property
+    def is_paced(self):
+        """
+        Whether the message deviates from being sent as fast as possible.
+        """
+        return bool(self.delay) or self.paces_body
+
+    def pacer(self, clock=time.monotonic):
+        """
+        Create a Pacer to send one message body with.
+        """
+        return Pacer(self, clock)
+
+
+class Pacer:
+    """
+    Split a message body into the paced steps requested by a Pacing.
+
+    A Pacer is stateful, so a body can be fed to pace() piece by piece as it is
+    relayed. Each step is a (wait, chunk) pair: the caller waits for wait
+    seconds, using whatever does not block other connections, and then sends
+    chunk.
+
+    >>> pacing = DirectiveProgram.compile('ChunkSize=%<4%> Stall=%<6:500%>').pacing
+    >>> pacer = pacing.pacer()
+    >>> [(wait, bytes(chunk)) for wait, chunk in pacer.pace(b'01234')]
+    [(0.0, b'0123'), (0.0, b'4')]
+    >>> [(wait, bytes(chunk)) for wait, chunk in pacer.pace(b'56789')]
+    [(0.0, b'5'), (0.5, b'6789')]
+
+    The throttle is measured against the clock, so time spent producing the
+    body is not waited for again.
+
+    >>> now = [0.0]
+    >>> pacer = DirectiveProgram.compile('Throttle=%<20%>').pacing.pacer(lambda: now[0])
+    >>> steps = pacer.pace(b'0123456789')
+    >>> wait, chunk = next(steps)
+    >>> wait, bytes(chunk)
+    (0.0, b'01')
+    >>> now[0] = 0.05
+    >>> wait, chunk = next(steps)
+    >>> round(wait, 2), bytes(chunk)
+    (0.05, b'23')
+    """
+
+    def __init__(self, pacing, clock=time.monotonic):
+        self._clock = clock
+        self._bytes_per_second = pacing.bytes_per_second
+        self._chunk_size = pacing.chunk_size
+        if self._bytes_per_second and not self._chunk_size:
+            self._chunk_size = int(min(
+                Pacing.MAX_THROTTLED_CHUNK_SIZE, max(1, self._bytes_per_second // 10)))
+        self._stalls = list(pacing.stalls)
+        self._next_stall = 0
+        self._sent = 0
+        self._started_at = None
+        # The time spent stalled, which the throttle does not make up for.
+        self._stalled = 0.0
+
+    def pace(self, data):
+        """
+        Generate the (wait, chunk) steps to send data with.
+        """
+        view = memoryview(data)
+        while view:
+            stall = 0.0
+            while self._next_stall < len(self._stalls) and \
+                    self._stalls[self._next_stall][0] <= self._sent:
+                stall += self._stalls[self._next_stall][1]
+                self._next_stall += 1
+            size = len(view)
+            if self._chunk_size:
+                size = min(size, self._chunk_size)
+            if self._next_stall < len(self._stalls):
+                size = min(size, self._stalls[self._next_stall][0] - self._sent)
+            wait = stall
+            if self._bytes_per_second:
+                now = self._clock()
+                if self._started_at is None:
+                    self._started_at = now
+                due = self._started_at + self._stalled + self._sent / self._bytes_per_second
+                wait += max(0.0, due - now)
+            self._stalled += stall
+            yield wait, view[:size]
+            self._sent += size
+            view = view[size:]
+
+
+class HeaderRewritePlan:
+    """
+    The combined effect of a sequence of header directives.
+
+    Applying directives one at a time costs a scan of the headers per
+    directive. A plan instead reduces the directives to the set of field
+    names to remove from the headers and the fields to then append to them,
+    so that only the field names the headers actually have cost a removal,
+    however many directives there are.
+
+    Field names are matched as the headers themselves match them: exactly
+    for dict headers, and case insensitively for email.message.Message
+    headers and any other headers, such as proxy_http2.Headers. The plan
+    therefore tracks both.
+
+    >>> import email.message
+    >>> headers = email.message.Message()
+    >>> headers.add_header('Host', 'example.com')
+    >>> headers.add_header('X-Test', 'one')
+    >>> headers.add_header('x-test', 'two')
+    >>> headers.add_header('X-Keep', 'yes')
+    >>> plan = HeaderRewritePlan()
+    >>> plan.insert('X-Request-ID', '1')
+    >>> plan.delete('X-TEST')
+    >>> plan.insert('X-New', 'a')
+    >>> plan.insert('x-request-id', '2')
+    >>> plan.apply(headers).items()
+    [('Host', 'example.com'), ('X-Keep', 'yes'), ('X-New', 'a'), ('x-request-id', '2')]
+
+    >>> import collections
+    >>> headers = collections.OrderedDict()
+    >>> headers['host'] = 'example.com'
+    >>> headers['x-test'] = 'one'
+    >>> headers['x-request-id'] = '0'
+    >>> list(plan.apply(headers))
+    ['host', 'x-test', 'X-Request-ID', 'X-New', 'x-request-id']
+    >>> headers['X-Request-ID'], headers['x-request-id']
+    ('1', '2')
+
+    A deletion after an insertion removes the inserted field from case
+    insensitive headers even if the names differ in case.
+
+    >>> import wsgiref.headers
+    >>> headers = wsgiref.headers.Headers([('Host', 'example.com')])
+    >>> plan = HeaderRewritePlan()
+    >>> plan.insert('X-A', '1')
+    >>> plan.delete('x-a')
+    >>> plan.apply(headers).items()
+    [('Host', 'example.com')]
+    """
+
+    def __init__(self):
+        # Field names whose original fields are removed, case folded.
+        self._folded_deletes = set()
+        # Case folded field name -> (field name, value) of the fields to
+        # append, in the order they are appended.
+        self._folded_inserts = {}
+        # The same, but for headers matching field names exactly.
+        self._exact_deletes = set()
+        self._exact_inserts = {}
+
+    def delete(self, field_name):
+        """
+        Record the removal of all fields named field_name.
+        """
+        folded = field_name.lower()
+        self._folded_deletes.add(folded)
+        self._folded_inserts.pop(folded, None)
+        self._exact_deletes.add(field_name)
+        self._exact_inserts.pop(field_name, None)
+
+    def insert(self, field_name, field_value):
+        """
+        Record the replacement of any fields named field_name with a single
+        field appended to the headers.
+        """
+        self.delete(field_name)
+        self._folded_inserts[field_name.lower()] = (field_name, field_value)
+        self._exact_inserts[field_name] = (field_name, field_value)
+
+    def apply(self, headers):
+        """
+        Rewrite the headers in place according to the plan.
+
+        Returns:
+            The rewritten headers.
+        """
+        if isinstance(headers, email.message.Message):
+            # A single scan finds the field names to remove. Deleting a name
+            # removes all of its fields, whatever their case.
+            deletes = self._folded_deletes
+            present = {name.lower() for name in headers.keys()}
+            for name in present & deletes:
+                del headers[name]
+            for name, value in self._folded_inserts.values():
+                headers[name] = value
+        elif isinstance(headers, dict):
+            for name in self._exact_deletes:
+                headers.pop(name, None)
+            for name, value in self._exact_inserts.values():
+                headers[name] = value
+        else:
+            # Fall back to the headers' own item access, which matches field
+            # names case insensitively.
+            for name in self._folded_deletes:
+                try:
+                    del headers[name]
+                except KeyError:
+                    pass
+            for name, value in self._folded_inserts.values():
+                headers[name] = value
+        return headers
+
+
+class DirectiveProgram:
+    """
+    The compiled form of an X-Proxy-Directive value.
+
+    Compiling parses the value and builds its Directive objects once, and
+    reduces their header manipulations, along with the removal of the
+    X-Proxy-Directive field itself, to a HeaderRewritePlan. Since neither
+    holds per-message state, a program is shared by every message carrying
+    the same X-Proxy-Directive value. Programs are kept in an LRU cache keyed
+    by that value.
+
+    >>> program = DirectiveProgram.compile('Delete=%<X-Test%> SetURL=%</a%>')
+    >>> program is DirectiveProgram.compile('Delete=%<X-Test%> SetURL=%</a%>')
+    True
+    >>> [type(d).__name__ for d in program.directives]
+    ['DeleteDirective', 'SetURLDirective']
+    >>> program.new_url
+    '/a'
+
+    A directive whose value is malformed is left out of the program, and
+    the reason recorded in its errors.
+
+    >>> program = DirectiveProgram.compile('Delay=%<abc%> ChunkSize=%<10%>')
+    >>> [type(d).__name__ for d in program.directives]
+    ['ChunkSizeDirective']
+    >>> program.errors
+    ('Delay directive value is not a number: abc',)
+    """
+
+    # The number of distinct X-Proxy-Directive values whose programs are kept.
+    CACHE_SIZE = 1024
+
+    def __init__(self, directive_value):
+        directives = []
+        errors = []
+        for command, value in DirectiveEngine._directive_value_parser(directive_value):
+            try:
+                directives.append(Directive.directive_factory(command, value))
+            except ValueError as e:
+                errors.append(str(e))
+        self.directives = tuple(directives)
+        self.errors = tuple(errors)
+        # The URL does not depend on the message, so resolve it up front.
+        self.new_url = None
+        self.header_plan = HeaderRewritePlan()
+        self.pacing = Pacing()
+        for directive in self.directives:
+            possible_url = directive.apply_url()
+            if possible_url is not None:
+                self.new_url = possible_url
+            directive.add_to_plan(self.header_plan)
+            directive.add_to_pacing(self.pacing)
+        self.header_plan.delete(DirectiveEngine.PROXY_DIRECTIVE_FIELD_NAME.lower())
+
+    @staticmethod
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def compile(directive_value):
+        """
+        Return the program for an X-Proxy-Directive value, compiling it only
+        if it is not already cached.
+        """
+        return DirectiveProgram(directive_value)
+
+    def apply_headers(self, headers):
+        """
+        Apply the program's header directives and remove the
+        X-Proxy-Directive field, in a single pass over the headers.
+        """
+        return self.header_plan.apply(headers)
+
+
 class DirectiveEngine:
     """
     Implements directive parsing and header manipulation.
@@ -257,6 +781,22 @@ class DirectiveEngine:
       This header requests the proxy to replace the forwarded URL with the
       specified value <new_URL>.
 
+    The following directives control the timing rather than the content of
+    the message. In a request they apply to the request forwarded to the
+    server, in a response to the response forwarded to the client.
+
+    X-Proxy-Directive: Delay=%<milliseconds%>
+      Hold the message for <milliseconds> before forwarding it.
+
+    X-Proxy-Directive: Throttle=%<bytes_per_second%>
+      Forward the message body no faster than <bytes_per_second>.
+
+    X-Proxy-Directive: ChunkSize=%<bytes%>
+      Forward the message body in writes of at most <bytes>.
+
+    X-Proxy-Directive: Stall=%<after_bytes:milliseconds%>
+      Pause for <milliseconds> once <after_bytes> of the body are forwarded.
+
     Multiple directives can be passed in the same X-Proxy-Directive by simply
     appending them in the value of the header. White space may be used as a
     separator. For instance:
@@ -267,7 +807,11 @@ class DirectiveEngine:
     or modify an existing X-Request-ID header to have the value 23.
 
     In addition to the above manipulations, the X-Proxy-Directive is filtered
-    out via get_new_headers.
+    out via get_new_headers. A directive with a malformed value is ignored.
+
+    The X-Proxy-Directive value is compiled into a DirectiveProgram, which is
+    cached, so an engine is cheap to construct. Still, a single engine should
+    serve both get_new_url and get_new_headers for a message.
     """
 
     PROXY_DIRECTIVE_FIELD_NAME = 'X-Proxy-Directive'
@@ -275,8 +819,7 @@ class DirectiveEngine:
     def __init__(self, headers):
         self._original_headers = headers
         self._x_proxy_directive_value = None
-        self._split_directive_values = []
-        self._directives = []
+        self._program = DirectiveProgram.compile('')
 
         if DirectiveEngine.PROXY_DIRECTIVE_FIELD_NAME.lower() in headers:
             directive_value = headers[DirectiveEngine.PROXY_DIRECTIVE_FIELD_NAME.lower()]
@@ -288,11 +831,9 @@ class DirectiveEngine:
             if isinstance(directive_value, bytes):
                 directive_value = directive_value.decode('ascii')
             self._x_proxy_directive_value = directive_value
-            self._split_directive_values = DirectiveEngine._directive_value_parser(
-                self._x_proxy_directive_value)
-
-            for command, value in self._split_directive_values:
-                self._directives.append(Directive.directive_factory(command, value))
+            self._program = DirectiveProgram.compile(directive_value)
+            for error in self._program.errors:
+                print(f"Ignoring a malformed X-Proxy-Directive: {error}")
 
     @staticmethod
     def _directive_value_parser(x_proxy_directive_value):
@@ -310,8 +851,12 @@ class DirectiveEngine:
         >>> directive = "SetURL=%<http://example.one:8080/config/settings.yaml?q=3#F%>"
         >>> DirectiveEngine._directive_value_parser(directive)
         [('SetURL', 'http://example.one:8080/config/settings.yaml?q=3#F')]
+        >>> DirectiveEngine._directive_value_parser("Delay=%<100%> Stall=%<10:5%>")
+        [('Delay', '100'), ('Stall', '10:5')]
         """
-        return re.findall(r"(Delete|Insert|SetURL)=%<(.*?)%>", x_proxy_directive_value)
+        return re.findall(
+            r"(Delete|Insert|SetURL|Delay|Throttle|ChunkSize|Stall)=%<(.*?)%>",
+            x_proxy_directive_value)
 
     def get_new_url(self):
         """
@@ -329,12 +874,21 @@ class DirectiveEngine:
         >>> len(new_headers)
         0
         """
-        new_url = None
-        for directive in self._directives:
-            possible_url = directive.apply_url()
-            if possible_url is not None:
-                new_url = possible_url
-        return new_url
+        return self._program.new_url
+
+    def get_pacing(self):
+        """
+        Return the Pacing requested by the Delay, Throttle, ChunkSize and
+        Stall directives.
+
+        >>> import email.message
+        >>> headers = email.message.Message()
+        >>> headers.add_header('X-Proxy-Directive', 'Delay=%<20%> ChunkSize=%<512%>')
+        >>> pacing = DirectiveEngine(headers).get_pacing()
+        >>> pacing.delay, pacing.chunk_size
+        (0.02, 512)
+        """
+        return self._program.pacing
 
     def get_new_headers(self):
         """
@@ -389,14 +943,7 @@ class DirectiveEngine:
         >>> new_headers.items()
         odict_items([('host', 'example.com'), ('x-duplicate-header', 'two'), ('X-Request-ID', '4')])
         """
-        new_headers = self._original_headers
-        for directive in self._directives:
-            new_headers = directive.apply_headers(new_headers)
-        try:
-            del new_headers[DirectiveEngine.PROXY_DIRECTIVE_FIELD_NAME.lower()]
-        except KeyError:
-            pass
-        return new_headers
+        return self._program.apply_headers(self._original_headers)
 
 
 if __name__ == '__main__':
@@ -8,24 +8,182 @@ Implement HTTP/1 proxy behavior in Python.
 #
 
 
+import base64
 import sys
 import socket
 import ssl
 import http.client
 import urllib.parse
-import threading
 import traceback
 import re
+import threading
+import time
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
+from connection_pool import UpstreamConnectionPool
 from directive_engine import DirectiveEngine
-from proxy_protocol_context import ProxyProtocolUtil
+from proxy_protocol_context import ProxyProtocolContext, ProxyProtocolUtil
+from transaction_log import TransactionLog
 import socket
 
+# The terminating chunk of a chunked body, with no trailers.
+LAST_CHUNK = b'0\r\n\r\n'
+# The room reserved ahead of a relay buffer's payload for a chunk size line:
+# up to 16 hexadecimal digits followed by CRLF.
+CHUNK_HEADER_ROOM = 18
+# The maximum length of a chunk size or trailer line.
+MAX_LINE_LENGTH = 65537
+
+
+class RelayBuffer:
+    """
+    A reusable buffer through which message bodies are relayed.
+
+    Body bytes are read into the payload view. Room is reserved around the
+    payload so that a chunk of it can be framed with the chunked transfer
+    coding in place, without copying it.
+
+    >>> buf = RelayBuffer(16)
+    >>> len(buf.payload)
+    16
+    >>> buf.payload[:3] = b'abc'
+    >>> bytes(buf.frame_chunk(3))
+    b'3\\r\\nabc\\r\\n'
+    >>> buf.payload[:16] = b'0123456789abcdef'
+    >>> bytes(buf.frame_chunk(16))
+    b'10\\r\\n0123456789abcdef\\r\\n'
+    """
+
+    def __init__(self, size):
+        self._buffer = bytearray(CHUNK_HEADER_ROOM + size + 2)
+        self._view = memoryview(self._buffer)
+        self.payload = self._view[CHUNK_HEADER_ROOM:CHUNK_HEADER_ROOM + size]
+
+    def frame_chunk(self, n):
+        """
+        Frame the first n bytes of the payload as a single chunk.
+
+        Returns:
+            A view of the chunk, including its size line and trailing CRLF.
+        """
+        size_line = b'%x\r\n' % n
+        start = CHUNK_HEADER_ROOM - len(size_line)
+        end = CHUNK_HEADER_ROOM + n
+        self._view[start:CHUNK_HEADER_ROOM] = size_line
+        self._view[end:end + 2] = b'\r\n'
+        return self._view[start:end + 2]
+
+
+class UpstreamTLSContext(ssl.SSLContext):
+    '''
+    The context for TLS connections from the proxy to the origin.
+
+    HTTPSConnection provides no way to specify the server_hostname in the
+    underlying socket. We accomplish this by overriding the wrap_socket
+    behavior (called later by HTTPSConnection) to specify the server_hostname
+    that we want.
+
+    One context is created per SNI and shared by every connection using it.
+    The context remembers the last session negotiated with each origin
+    address so that new connections resume it instead of performing a full
+    handshake.
+    '''
+    _contexts = {}
+    _contexts_lock = threading.Lock()
+
+    def __new__(cls, server_hostname=None):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, server_hostname=None):
+        super().__init__()
+        # The origin's certificate is not verified.
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self._server_hostname = server_hostname
+        # origin address -> ssl.SSLSession
+        self._sessions = {}
+
+    @classmethod
+    def for_sni(cls, server_hostname):
+        """
+        Return the shared context for connections with the given SNI, which
+        may be None for connections without one.
+        """
+        context = cls._contexts.get(server_hostname)
+        if context is None:
+            with cls._contexts_lock:
+                context = cls._contexts.get(server_hostname)
+                if context is None:
+                    context = cls(server_hostname)
+                    cls._contexts[server_hostname] = context
+        return context
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self._server_hostname:
+            kwargs['server_hostname'] = self._server_hostname
+        if 'session' not in kwargs:
+            kwargs['session'] = self._sessions.get(self._peer_of(sock))
+        return super().wrap_socket(sock, *args, **kwargs)
+
+    def save_session(self, ssl_sock):
+        """
+        Remember the session of an established connection for resumption by
+        later connections to the same origin.
+        """
+        session = ssl_sock.session
+        peer = self._peer_of(ssl_sock)
+        if session is not None and peer is not None:
+            self._sessions[peer] = session
+
+    @staticmethod
+    def _peer_of(sock):
+        try:
+            return sock.getpeername()
+        except OSError:
+            return None
+
+
+def create_server_context(https_pem):
+    """
+    Create the context for TLS connections from clients to the proxy.
+
+    Session tickets are encrypted with keys generated by the context. Create
+    the context before forking worker processes so that they all share these
+    keys and a client can resume its session with any of them.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=https_pem)
+    context.set_servername_callback(servername_callback)
+    # Session tickets are OpenSSL's default, but be explicit: resumption
+    # across workers depends on them since each worker has its own session
+    # ID cache.
+    context.options &= ~ssl.OP_NO_TICKET
+    return context
+
 
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
     address_family = socket.AF_INET
     daemon_threads = True
+    # socketserver's default backlog of 5 has the kernel refuse connections
+    # from all but a few of many clients connecting at once.
+    request_queue_size = 128
+
+    def finish_request(self, request, client_address):
+        # configure_http1_server wraps the listening socket in a PP_socket,
+        # whose accept leaves reading the PROXY header and the TLS handshake
+        # to this, the connection's own thread.
+        try:
+            connection, pp_context = self.socket.complete_accept(request)
+        except (OSError, ValueError) as e:
+            print(f"Dropping the connection from {client_address[0]}:{client_address[1]}: {e}")
+            return
+        try:
+            self.RequestHandlerClass(connection, client_address, self, pp_context=pp_context)
+        finally:
+            if connection is not request:
+                # The TLS socket took over the accepted one, which is all that
+                # process_request_thread shuts down.
+                self.shutdown_request(connection)
 
     def handle_error(self, request, client_address):
         # surpress socket/ssl related errors
@@ -46,14 +204,21 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
     in DirectiveEngine for how these directives work.
     """
     timeout = 5
-    # For serializing output. See the uses of "with lock".
-    lock = threading.Lock()
-
-    def __init__(self, *args, **kwargs):
-        self.tls = threading.local()
-        self.tls.conns = {}
-
-        BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+    # Transactions are logged asynchronously, see TransactionLog.
+    transaction_log = TransactionLog()
+    # Bodies are relayed through a buffer of this size, so the memory used
+    # per transaction does not grow with the body size.
+    relay_buffer_size = 64 * 1024
+    # The number of body bytes per message kept for the transaction log.
+    max_logged_body_size = 1024 * 1024
+    # Keep-alive connections to the origin, shared by all client connections.
+    upstream_pool = UpstreamConnectionPool()
+
+    def __init__(self, request, client_address, server, pp_context=None):
+        # The PROXY protocol header received on this client connection, which
+        # the connections to the origin made for it pass on.
+        self.pp_context = pp_context or ProxyProtocolContext()
+        BaseHTTPRequestHandler.__init__(self, request, client_address, server)
 
     def log_error(self, fmt, *args):
         # surpress "Request timed out: timeout('timed out',)"
@@ -62,25 +227,27 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
 
         self.log_message(fmt, *args)
 
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Reused for every body relayed on this client connection.
+        self.relay_buffer = RelayBuffer(self.relay_buffer_size)
+
     def do_GET(self):
         req = self
         content_length = int(req.headers.get('Content-Length', 0))
-        req_body = b''
-        if content_length:
-            req_body = self.rfile.read(content_length)
-        elif "chunked" in req.headers.get("Transfer-Encoding", ""):
-            # Borrowed chunk reading code from: https://stackoverflow.com/a/63037533/629530
-            while True:
-                line = self.rfile.readline().strip()
-                chunk_length = int(line, 16)
-                if chunk_length == 0:
-                    self.rfile.readline()
-                    break
-                req_body += self.rfile.read(chunk_length)
-
-                # Each chunk is followed by an additional empty newline (\r\n)
-                # that we have to consume.
-                self.rfile.readline()
+        req_chunked = "chunked" in req.headers.get("Transfer-Encoding", "")
+        # The request body is relayed to the origin as it is read from the
+        # client. Only a bounded prefix of it is kept for logging.
+        req_log_body = bytearray() if self.transaction_log.log_bodies else None
+        req_body = None
+        if req_chunked:
+            req_body = self._frame_body(
+                self._read_chunked_body(self.rfile, self.relay_buffer.payload),
+                req_chunked, req_log_body)
+        elif content_length:
+            req_body = self._frame_body(
+                self._read_sized_body(self.rfile, self.relay_buffer.payload, content_length),
+                req_chunked, req_log_body)
 
         if req.path[0] == '/':
             if isinstance(self.connection, ssl.SSLSocket):
@@ -92,115 +259,120 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         if hasattr(socket, 'client_sni'):
             client_sni = socket.client_sni
             print("Client SNI: {}".format(client_sni))
-        req_body_modified = self.request_handler(req, req_body)
+        # Bodies are streamed, so the request hook only sees the headers. It
+        # can still replace the body wholesale.
+        req_body_modified = self.request_handler(req, None)
         if req_body_modified is False:
             self.send_error(403)
             return
         elif req_body_modified is not None:
             req_body = req_body_modified
+            if req_log_body is not None:
+                req_log_body[:] = req_body_modified
+            req_chunked = False
             req.headers['Content-length'] = str(len(req_body))
 
         u = urllib.parse.urlsplit(req.path)
         scheme, netloc, path = u.scheme, u.netloc, (
             u.path + '?' + u.query if u.query else u.path)
         assert scheme in ('http', 'https')
-        final_url = self.get_url(req.headers, path)
-        setattr(req, 'headers', self.filter_headers(req.headers))
+        # The URL and the headers are rewritten from the same directives.
+        req_directives = DirectiveEngine(req.headers)
+        final_url = self.get_url(req.headers, path, req_directives)
+        setattr(req, 'headers', self.filter_headers(req.headers, req_directives))
+        req_pacing = req_directives.get_pacing()
+        if req_body is not None and req_pacing.paces_body:
+            req_body = self.paced(req_body, req_pacing.pacer())
 
         replay_server = f"127.0.0.1:{self.server_port}"
         print(f"Connecting to: {replay_server} with scheme {scheme}")
 
+        # Upstream connections carry the SNI and PROXY protocol header of the
+        # client connection they were created for, so only reuse them for
+        # client connections that would produce an identical one.
+        pool_key = (scheme, replay_server, client_sni, self.pp_context.key)
+        # Wait before taking a connection from the pool, which the origin may
+        # otherwise time out while it sits idle.
+        self._wait(req_pacing.delay)
+        conn = None
         try:
-            origin = (scheme, replay_server)
-            if origin not in self.tls.conns:
-                if scheme == 'https':
-                    if client_sni:
-
-                        class WrapSSSLContext(ssl.SSLContext):
-                            '''
-                            HTTPSConnection provides no way to specify the
-                            server_hostname in the underlying socket. We
-                            accomplish this by wrapping the context to
-                            overrride the wrap_socket behavior (called later
-                            by HTTPSConnection) to specify the
-                            server_hostname that we want.
-                            '''
-                            def __new__(cls, server_hostname, *args, **kwargs):
-                                return super().__new__(cls, *args, *kwargs)
-
-                            def __init__(self, server_hostname, *args, **kwargs):
-                                super().__init__(*args, **kwargs)
-                                self._server_hostname = server_hostname
-
-                            def wrap_socket(self, sock, *args, **kwargs):
-                                kwargs['server_hostname'] = self._server_hostname
-                                return super().wrap_socket(sock, *args, **kwargs)
-
-                        proxy_to_server_context = WrapSSSLContext(client_sni)
-                    else:
-                        proxy_to_server_context = ssl.SSLContext()
-                    self.tls.conns[origin] = http.client.HTTPSConnection(
-                        replay_server, timeout=self.timeout,
-                        context=proxy_to_server_context, cert_file=self.cert_file)
-                else:
-                    self.tls.conns[origin] = http.client.HTTPConnection(
-                        replay_server, timeout=self.timeout)
+            conn = self.upstream_pool.acquire(
+                pool_key,
+                lambda: self._create_upstream_connection(scheme, replay_server, client_sni))
 
-            # wrap_create_connection.  here, we monkey patch the
-            # create_connection method so that the proxy protocol is sent as the
-            # connection is established
-            self.tls.conns[origin]._create_connection = ProxyProtocolUtil.create_connection_and_send_pp
-            conn = self.tls.conns[origin]
-
-            if 'transfer-encoding' in req.headers and req.headers['transfer-encoding'] == 'chunked':
-                req_body = self.chunkify_body(req_body)
             conn.request(self.command, final_url, req_body, req.headers)
             res = conn.getresponse()
+            if isinstance(conn.sock, ssl.SSLSocket):
+                # By now, any session ticket from the origin has arrived.
+                UpstreamTLSContext.for_sni(client_sni).save_session(conn.sock)
 
             version_table = {10: 'HTTP/1.0', 11: 'HTTP/1.1'}
             setattr(res, 'headers', res.msg)
             setattr(res, 'response_version', version_table[res.version])
-
-            # support streaming
-            if 'Content-Length' not in res.headers and 'no-store' in res.headers.get(
-                    'Cache-Control', ''):
-                self.response_handler(req, req_body, res, '')
-                setattr(res, 'headers', self.filter_headers(res.headers))
-                self.relay_streaming(res)
-                with self.lock:
-                    self.save_handler(req, req_body, res, '')
-                return
-
-            res_body = res.read()
         except Exception as e:
-            if origin in self.tls.conns:
-                del self.tls.conns[origin]
+            if conn is not None:
+                self.upstream_pool.discard(conn)
+            # The client's request body may not have been consumed.
+            self.close_connection = True
             self.send_error(502)
             print(f"Connection to '{replay_server}' initiated with request to "
                   f"{scheme}://{netloc}{path}' failed: {e}")
             traceback.print_exc(file=sys.stdout)
             return
 
-        if 'transfer-encoding' in res.headers and res.headers['transfer-encoding'] == 'chunked':
-            res_body = self.chunkify_body(res_body)
+        self.response_handler(req, None, res, None)
+        res_chunked = 'transfer-encoding' in res.headers and \
+            res.headers['transfer-encoding'] == 'chunked'
 
         if 'connection' in res.headers and res.headers['connection'] == 'close':
             self.close_connection = True
         else:
             self.close_connection = False
-        setattr(res, 'headers', self.filter_headers(res.headers))
+        res_directives = DirectiveEngine(res.headers)
+        setattr(res, 'headers', self.filter_headers(res.headers, res_directives))
+        res_pacing = res_directives.get_pacing()
 
-        status_line = f"{self.protocol_version} {res.status} {res.reason}\r\n"
-        self.wfile.write(status_line.encode())
-        for key, value in res.headers.items():
-            self.wfile.write(f"{key}:{value}\r\n".encode())
-        # End the headers.
-        self.wfile.write(b"\r\n")
-        self.wfile.write(res_body)
-        self.wfile.flush()
+        # Relay the response body to the client as it arrives from the origin.
+        res_log_body = bytearray() if self.transaction_log.log_bodies else None
+        head_sent = False
+        try:
+            pieces = self._frame_body(
+                self._read_response_body(res, self.relay_buffer.payload),
+                res_chunked, res_log_body)
+            self._wait(res_pacing.delay)
+            if res_pacing.paces_body:
+                # The body's pacing starts once the client has the head.
+                self._send_vectored([self._response_head(res)])
+                head_sent = True
+                pieces = self.paced(pieces, res_pacing.pacer())
+            else:
+                # Send the response head along with the first piece of the
+                # body in a single write.
+                first_piece = next(pieces, None)
+                head_sent = True
+                if first_piece is None:
+                    self._send_vectored([self._response_head(res)])
+                else:
+                    self._send_vectored([self._response_head(res), first_piece])
+            for piece in pieces:
+                self.wfile.write(piece)
+            self.wfile.flush()
+        except Exception as e:
+            self.upstream_pool.discard(conn)
+            self.close_connection = True
+            if not head_sent:
+                self.send_error(502)
+            # Otherwise the response head may already be on its way to the
+            # client, so the best we can do is to abort the client connection.
+            print(f"Relaying the response body from '{replay_server}' for "
+                  f"{scheme}://{netloc}{path}' failed: {e}")
+            traceback.print_exc(file=sys.stdout)
+            return
+        self.upstream_pool.release(pool_key, conn)
 
-        with self.lock:
-            self.save_handler(req, req_body, res, res_body)
+        self.save_handler(
+            req, self._body_for_log(req_log_body, req_chunked),
+            res, self._body_for_log(res_log_body, res_chunked))
 
     # Map all the do_<method> commands to our do_GET because that has our
     # request implementation for all of them.
@@ -216,25 +388,198 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
     do_OPTIONS = do_GET
     do_options = do_GET
 
-    def relay_streaming(self, res):
-        self.wfile.write(
-            f"{self.protocol_version} {res.status} {res.reason}\r\n")
-        for line in res.headers.headers:
-            self.wfile.write(line)
-        self.end_headers()
-        try:
-            while True:
-                chunk = res.read(8192)
-                if not chunk:
-                    break
-                self.wfile.write(chunk)
-            self.wfile.flush()
-        except socket.error:
-            # connection closed by client
-            pass
+    def _create_upstream_connection(self, scheme, replay_server, client_sni):
+        """
+        Create a new, not yet connected, connection to the origin.
+        """
+        if scheme == 'https':
+            proxy_to_server_context = UpstreamTLSContext.for_sni(client_sni)
+            conn = http.client.HTTPSConnection(
+                replay_server, timeout=self.timeout,
+                context=proxy_to_server_context, cert_file=self.cert_file)
+        else:
+            conn = http.client.HTTPConnection(replay_server, timeout=self.timeout)
+
+        # wrap_create_connection.  here, we monkey patch the
+        # create_connection method so that the proxy protocol is sent as the
+        # connection is established
+        conn._create_connection = self.pp_context.create_connection
+        return conn
 
     @staticmethod
-    def filter_headers(headers):
+    def _wait(seconds):
+        """
+        Wait as requested by a pacing directive.
+
+        This blocks the calling thread, which is what is wanted here: each
+        client connection is served by a ThreadingHTTPServer thread of its
+        own, so waiting holds up only the transaction being paced, and the
+        directives bound the wait by Pacing.MAX_WAIT.
+        """
+        if seconds > 0:
+            time.sleep(seconds)
+
+    @staticmethod
+    def paced(pieces, pacer):
+        """
+        Split a body into the chunks of a Pacer, waiting between them as it
+        requests.
+
+        The waits block the thread iterating over the chunks, so that must be
+        a thread of the transaction's own.
+
+        Args:
+            pieces: The body, either as bytes or as an iterable of pieces.
+
+            pacer: The Pacer for the body.
+        """
+        if isinstance(pieces, (bytes, bytearray, memoryview)):
+            pieces = (pieces,)
+        for piece in pieces:
+            for wait, chunk in pacer.pace(piece):
+                ProxyRequestHandler._wait(wait)
+                yield chunk
+
+    def _response_head(self, res):
+        """
+        Assemble the status line and header fields of a response.
+
+        Returns:
+            The encoded response head, terminated by the empty line.
+        """
+        lines = [f"{self.protocol_version} {res.status} {res.reason}\r\n"]
+        lines.extend(f"{key}:{value}\r\n" for key, value in res.headers.items())
+        # End the headers.
+        lines.append("\r\n")
+        return "".join(lines).encode()
+
+    def _send_vectored(self, buffers):
+        """
+        Write the buffers to the client with as few system calls as possible.
+
+        Plain sockets get a single sendmsg (scatter/gather) call per attempt.
+        TLS sockets do not support sendmsg, so the buffers are joined first.
+        """
+        sock = self.connection
+        if isinstance(sock, ssl.SSLSocket):
+            sock.sendall(b"".join(buffers))
+            return
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            sent = sock.sendmsg(views)
+            # Drop what was sent and retry with the remainder.
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views and sent:
+                views[0] = views[0][sent:]
+
+    def _frame_body(self, counts, chunked, log_body):
+        """
+        Generate the pieces of a body to forward, as views of the relay buffer.
+
+        Args:
+            counts: A generator that, per step, places the next body bytes at
+            the start of the relay buffer payload and yields their number.
+
+            chunked: Whether to frame the pieces with the chunked transfer
+            coding.
+
+            log_body: A bytearray to which a bounded prefix of the body is
+            appended for the transaction log, or None.
+        """
+        for n in counts:
+            if log_body is not None and len(log_body) < self.max_logged_body_size:
+                log_body += self.relay_buffer.payload[
+                    :min(n, self.max_logged_body_size - len(log_body))]
+            if chunked:
+                yield self.relay_buffer.frame_chunk(n)
+            else:
+                yield self.relay_buffer.payload[:n]
+        if chunked:
+            yield LAST_CHUNK
+
+    @staticmethod
+    def _read_sized_body(rfile, payload, content_length):
+        """
+        Read a Content-Length delimited body into payload as it arrives.
+        """
+        remaining = content_length
+        while remaining:
+            n = rfile.readinto1(payload[:min(remaining, len(payload))])
+            if not n:
+                raise ConnectionError(
+                    f"Connection closed with {remaining} body bytes outstanding")
+            remaining -= n
+            yield n
+
+    @staticmethod
+    def _read_chunked_body(rfile, payload):
+        """
+        Read a chunked body into payload as it arrives, removing the chunk
+        framing.
+        """
+        while True:
+            line = rfile.readline(MAX_LINE_LENGTH)
+            # Ignore any chunk extensions.
+            chunk_length = int(line.split(b';', 1)[0].strip(), 16)
+            if chunk_length == 0:
+                # Consume any trailer fields through the terminating empty
+                # line.
+                while rfile.readline(MAX_LINE_LENGTH) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            while chunk_length:
+                n = rfile.readinto1(payload[:min(chunk_length, len(payload))])
+                if not n:
+                    raise ConnectionError("Connection closed in the middle of a chunk")
+                chunk_length -= n
+                yield n
+
+            # Each chunk is followed by an additional empty newline (\r\n)
+            # that we have to consume.
+            rfile.readline(MAX_LINE_LENGTH)
+
+    @staticmethod
+    def _read_response_body(res, payload):
+        """
+        Read the origin's response body into payload as it arrives.
+
+        http.client takes care of the response framing: readinto1 returns
+        the bytes available so far, without chunk framing, and 0 at the end.
+        It also returns 0 if the origin closes the connection short of the
+        Content-Length, which is then left outstanding in res.length.
+
+        Raises:
+            http.client.IncompleteRead: The origin closed the connection
+            before the end of the body.
+        """
+        while True:
+            n = res.readinto1(payload)
+            if not n:
+                if res.length:
+                    raise http.client.IncompleteRead(b'', res.length)
+                # Unlike read(), read1() does not mark a Content-Length
+                # delimited response as complete. Do so, or http.client will
+                # not send another request on the connection.
+                res.close()
+                return
+            yield n
+
+    @staticmethod
+    def _body_for_log(log_body, chunked):
+        """
+        Render a logged body as it would look as a single forwarded message.
+        """
+        if log_body is None:
+            return None
+        body = bytes(log_body)
+        if chunked:
+            body = ProxyRequestHandler.chunkify_body(body)
+        return body
+
+    @staticmethod
+    def filter_headers(headers, directive_engine=None):
         # http://tools.ietf.org/html/rfc2616#section-13.5.1
         hop_by_hop = ['proxy-authenticate',
                       'proxy-authorization', 'te', 'trailers',
@@ -248,12 +593,14 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
                 continue
 
         # Apply our X-Proxy-Directive manipulations.
-        directive_engine = DirectiveEngine(headers)
+        if directive_engine is None:
+            directive_engine = DirectiveEngine(headers)
         return directive_engine.get_new_headers()
 
     @staticmethod
-    def get_url(headers, original_url):
-        directive_engine = DirectiveEngine(headers)
+    def get_url(headers, original_url, directive_engine=None):
+        if directive_engine is None:
+            directive_engine = DirectiveEngine(headers)
         new_url = directive_engine.get_new_url()
         if new_url is None:
             return original_url
@@ -268,44 +615,59 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         trailer = b'\r\n0\r\n\r\n'
         return header + res_body + trailer
 
-    def print_info(self, req, req_body, res, res_body):
+    @staticmethod
+    def format_info(fields):
+        """
+        Render the fields of a logged transaction as text.
+        """
         def parse_qsl(s):
             return '\n'.join(
                 "%-20s %s" %
                 (k, v) for k, v in urllib.parse.parse_qsl(
                     s, keep_blank_values=True))
 
-        req_header_text = f"{req.command} {req.path} {req.request_version}\n{req.headers}"
-        res_header_text = f"{res.response_version} {res.status} {res.reason}\n{res.headers}"
+        def headers_text(headers):
+            return ''.join(f"{k}: {v}\n" for k, v in headers) + '\n'
 
-        print(req_header_text)
+        def get_field(headers, name):
+            name = name.lower()
+            return next((v for k, v in headers if k.lower() == name), None)
 
-        u = urllib.parse.urlsplit(req.path)
+        request_headers = fields.get('request_headers', [])
+        response_headers = fields.get('response_headers', [])
+        text = []
+
+        text.append(f"{fields['method']} {fields['url']} {fields['request_version']}\n"
+                    f"{headers_text(request_headers)}\n")
+
+        u = urllib.parse.urlsplit(fields['url'])
         if u.query:
             query_text = parse_qsl(u.query)
-            print(f"==== QUERY PARAMETERS ====\n{query_text}\n")
+            text.append(f"==== QUERY PARAMETERS ====\n{query_text}\n\n")
 
-        cookie = req.headers.get('Cookie', '')
+        cookie = get_field(request_headers, 'Cookie')
         if cookie:
             cookie = parse_qsl(re.sub(r';\s*', '&', cookie))
-            print(f"==== COOKIE ====\n{cookie}\n")
+            text.append(f"==== COOKIE ====\n{cookie}\n\n")
 
-        auth = req.headers.get('Authorization', '')
+        auth = get_field(request_headers, 'Authorization') or ''
         if auth.lower().startswith('basic'):
-            token = auth.split()[1].decode('base64')
-            print(f"==== BASIC AUTH ====\n{token}\n")
+            token = base64.b64decode(auth.split()[1]).decode('utf-8', errors='backslashreplace')
+            text.append(f"==== BASIC AUTH ====\n{token}\n\n")
 
-        if req_body is not None:
-            print(f"==== REQUEST BODY ====\n{req_body}\n")
+        if fields.get('request_body') is not None:
+            text.append(f"==== REQUEST BODY ====\n{fields['request_body']}\n\n")
 
-        print(res_header_text)
+        text.append(f"{fields['response_version']} {fields['status']} {fields['reason']}\n"
+                    f"{headers_text(response_headers)}\n")
 
-        cookies = res.headers['Set-Cookie']
+        cookies = get_field(response_headers, 'Set-Cookie')
         if cookies:
-            print(f"==== SET-COOKIE ====\n{cookies}\n")
+            text.append(f"==== SET-COOKIE ====\n{cookies}\n\n")
 
-        if res_body is not None:
-            print(f"==== RESPONSE BODY ====\n{res_body}\n")
+        if fields.get('response_body') is not None:
+            text.append(f"==== RESPONSE BODY ====\n{fields['response_body']}\n\n")
+        return ''.join(text)
 
     def request_handler(self, req, req_body):
         pass
@@ -314,7 +676,22 @@ class ProxyRequestHandler(BaseHTTPRequestHandler):
         pass
 
     def save_handler(self, req, req_body, res, res_body):
-        self.print_info(req, req_body, res, res_body)
+        if not self.transaction_log.enabled:
+            return
+        # Snapshot everything: the handler, and with it req, is reused for the
+        # next request on this connection before the record is written.
+        self.transaction_log.log({
+            'method': req.command,
+            'url': req.path,
+            'request_version': req.request_version,
+            'request_headers': list(req.headers.items()),
+            'request_body': req_body,
+            'response_version': res.response_version,
+            'status': res.status,
+            'reason': res.reason,
+            'response_headers': list(res.headers.items()),
+            'response_body': res_body,
+        }, self.format_info)
 
 
 def servername_callback(sock, req_hostname, cb_context, as_callback=True):
@@ -322,20 +699,31 @@ def servername_callback(sock, req_hostname, cb_context, as_callback=True):
 
 
 def configure_http1_server(HandlerClass, ServerClass, protocol,
-                           listen_port, server_port, https_pem):
+                           listen_port, server_port, https_pem, transaction_log=None,
+                           reuse_port=False, server_context=None):
 
     listen_address = ('127.0.0.1', listen_port)
 
     HandlerClass.protocol_version = protocol
     HandlerClass.server_port = server_port
     HandlerClass.cert_file = https_pem
-    httpd = ServerClass(listen_address, HandlerClass)
+    if transaction_log is not None:
+        HandlerClass.transaction_log = transaction_log
+    httpd = ServerClass(listen_address, HandlerClass, bind_and_activate=False)
+    if reuse_port:
+        # Let several worker processes listen on the same port. The kernel
+        # then balances incoming connections across them.
+        httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        httpd.server_bind()
+        httpd.server_activate()
+    except BaseException:
+        httpd.server_close()
+        raise
     client_to_proxy_context = None
     use_ssl = False
     if https_pem:
-        client_to_proxy_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        client_to_proxy_context.load_cert_chain(certfile=https_pem)
-        client_to_proxy_context.set_servername_callback(servername_callback)
+        client_to_proxy_context = server_context or create_server_context(https_pem)
         use_ssl = True
     # wrap the socket with proxy protocol socket
     httpd.socket = ProxyProtocolUtil.wrap_socket(
@@ -8,26 +8,41 @@ Implement HTTP/2 proxy behavior in Python.
 #
 
 
+import concurrent.futures
+import functools
 from email.message import EmailMessage as HttpHeaders
+from enum import Enum
+import socket
 import sys
 import ssl
 from OpenSSL.SSL import Error as SSLError
 from OpenSSL.SSL import SysCallError as SSLSysCallError
 import http.client
+import os
+import queue
+import selectors
 import urllib.parse
 import threading
 import traceback
 
+from connection_pool import UpstreamConnectionPool
+from directive_engine import DirectiveEngine
 from proxy_http1 import ProxyRequestHandler
-from proxy_protocol_context import ProxyProtocolUtil, ProxyProtocolVersion
+from proxy_protocol_context import PP_ACCEPT_TIMEOUT, ProxyProtocolContext, ProxyProtocolUtil
 
 import eventlet
+import eventlet.event
+import eventlet.greenio
+from eventlet import tpool
 from eventlet.green.OpenSSL import SSL, crypto
+from eventlet.semaphore import Semaphore
 from h2.config import H2Configuration
 from h2.connection import H2Connection
-from h2.events import StreamEnded, RequestReceived, ResponseReceived, DataReceived, TrailersReceived, StreamReset, ConnectionTerminated
+from h2.events import (
+    StreamEnded, RequestReceived, ResponseReceived, DataReceived, TrailersReceived, StreamReset,
+    ConnectionTerminated, WindowUpdated, RemoteSettingsChanged)
 from h2.errors import ErrorCodes as H2ErrorCodes
-from h2.exceptions import StreamClosedError, StreamIDTooLowError
+from h2.exceptions import ProtocolError, StreamClosedError, StreamIDTooLowError
 
 
 class WrapSSSLContext(ssl.SSLContext):
@@ -39,54 +54,370 @@ class WrapSSSLContext(ssl.SSLContext):
     by HTTPSConnection) to specify the
     server_hostname that we want.
     '''
-    def __new__(cls, server_hostname, *args, **kwargs):
+    def __new__(cls, server_hostname, pp_context, *args, **kwargs):
         return super().__new__(cls, *args, *kwargs)
 
-    def __init__(self, server_hostname, *args, **kwargs):
+    def __init__(self, server_hostname, pp_context, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._server_hostname = server_hostname
+        self._pp_context = pp_context
 
     def wrap_socket(self, sock, *args, **kwargs):
         # send proxy protocol header first before TLS handshake
-        if ProxyProtocolUtil.pp_version != ProxyProtocolVersion.NONE:
-            ProxyProtocolUtil.send_proxy_header(
-                sock, ProxyProtocolUtil.pp_version)
+        self._pp_context.send_header(sock)
         kwargs['server_hostname'] = self._server_hostname
         return super().wrap_socket(sock, *args, **kwargs)
 
 
+class RequestBodyTimeout(TimeoutError):
+    '''
+    The client sent nothing more of a request body for too long.
+    '''
+
+
+class RequestBody:
+    '''
+    A request body received in DATA frames, readable while it still arrives.
+
+    The connection's green thread appends the frames' data as it arrives and
+    the native thread sending the request to the origin iterates over it,
+    blocking until more arrives or the body ends. The chunks are kept, rather
+    than concatenated, so that large bodies take linear time, and joined by
+    getvalue once the whole body is needed.
+
+    Each chunk's data is reported to on_consumed as the chunk is handed to
+    the sending thread, so that it is only then acknowledged to the client.
+    The client's stream flow control window therefore bounds the data
+    waiting for the origin.
+    '''
+
+    def __init__(self, on_consumed=None, timeout=None):
+        '''
+        Args:
+            on_consumed: Called from the reading thread with the flow
+            controlled length of each chunk handed to it, or None.
+
+            timeout: How long the reading thread waits for more of the body,
+            in seconds, before giving up with a RequestBodyTimeout, or None
+            to wait for as long as it takes.
+        '''
+        self._chunks = []
+        # Hands (chunk, flow controlled length) pairs to the reading thread,
+        # a None chunk marking the end.
+        self._arrived = queue.SimpleQueue()
+        self._on_consumed = on_consumed
+        self._timeout = timeout
+        self._discarded = False
+        self.ended = False
+
+    def append(self, data, flow_controlled_length=None):
+        if flow_controlled_length is None:
+            flow_controlled_length = len(data)
+        self._chunks.append(data)
+        if self._discarded:
+            self._consumed(flow_controlled_length)
+        else:
+            self._arrived.put((data, flow_controlled_length))
+
+    def end(self):
+        if not self.ended:
+            self.ended = True
+            self._arrived.put((None, 0))
+
+    def discard(self):
+        '''
+        Give up on sending the rest of the body, such as once the origin
+        responded, consuming what arrived and will arrive of it.
+        '''
+        self._discarded = True
+        while True:
+            try:
+                data, flow_controlled_length = self._arrived.get_nowait()
+            except queue.Empty:
+                break
+            self._consumed(flow_controlled_length)
+        self._arrived.put((None, 0))
+
+    def __iter__(self):
+        while True:
+            try:
+                data, flow_controlled_length = self._arrived.get(timeout=self._timeout)
+            except queue.Empty:
+                raise RequestBodyTimeout(
+                    f"No more of the request body arrived for {self._timeout} seconds")
+            if data is None:
+                # Leave the end marked for any later reader.
+                self._arrived.put((None, 0))
+                return
+            self._consumed(flow_controlled_length)
+            yield data
+
+    def _consumed(self, flow_controlled_length):
+        if self._on_consumed is not None and flow_controlled_length:
+            self._on_consumed(flow_controlled_length)
+
+    def read_all(self):
+        '''
+        Wait for the body to end and return all of it.
+        '''
+        for _ in self:
+            pass
+        return self.getvalue()
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+
+class ResponseState(Enum):
+    '''
+    How far the response on a stream to the client has been sent.
+    '''
+    # Nothing has been sent yet.
+    PENDING = 0
+    # The headers have been sent, and possibly part of the body.
+    SENDING_BODY = 1
+    # The whole response has been sent.
+    ENDED = 2
+    # The stream was closed before the whole response was sent.
+    CLOSED = 3
+
+
+class ResponseStream:
+    '''
+    Track the sending of a response to the client on a stream.
+    '''
+
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.state = ResponseState.PENDING
+        self.body_bytes_sent = 0
+
+
 class RequestInfo(object):
     def __init__(self, stream_id):
-        self._body_bytes = None
+        self._body = None
         self._headers = None
         self._stream_id = stream_id
 
 
+class SharedHttp2Connections:
+    '''
+    The HTTP/2 connections to the origin, shared by the streams of all the
+    client connections the process serves.
+
+    Connections are keyed by the caller, typically by (scheme, server, sni,
+    proxy protocol header), so that streams only share a connection the
+    origin would have seen set up the same way for each of them. Connecting
+    blocks, so this is used from the native threads doing the exchanges
+    with the origin. Connects to different origins do not wait on each
+    other.
+
+    >>> class FakeConnection:
+    ...     is_usable = True
+    ...     def close(self):
+    ...         self.is_usable = False
+    >>> connections = SharedHttp2Connections()
+    >>> key = ('https', '127.0.0.1:8443', None, None)
+    >>> first = connections.get(key, FakeConnection)
+    >>> connections.get(key, FakeConnection) is first
+    True
+
+    A connection which is no longer usable is replaced.
+
+    >>> first.close()
+    >>> second = connections.get(key, FakeConnection)
+    >>> second is first
+    False
+
+    Discarding a connection only removes it if it is still the one cached.
+
+    >>> connections.discard(key, first)
+    >>> connections.get(key, FakeConnection) is second
+    True
+    >>> connections.discard(key, second)
+    >>> connections.get(key, FakeConnection) is second
+    False
+    '''
+
+    def __init__(self):
+        # key -> Http2Connection.
+        self._connections = {}
+        # key -> the lock held while connecting for that key.
+        self._connect_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, connect):
+        """
+        Return the usable connection for key, calling connect to make one
+        if there is none.
+
+        Returns:
+            The connection, or None if connect returned None.
+        """
+        with self._lock:
+            connect_lock = self._connect_locks.setdefault(key, threading.Lock())
+        with connect_lock:
+            with self._lock:
+                connection = self._connections.get(key)
+            if connection is not None and connection.is_usable:
+                return connection
+            connection = connect()
+            with self._lock:
+                if connection is None:
+                    self._connections.pop(key, None)
+                else:
+                    self._connections[key] = connection
+            return connection
+
+    def discard(self, key, connection):
+        """
+        Forget connection if it is still the one cached for key.
+        """
+        with self._lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
 class Http2ConnectionManager(object):
     timeout = 5
+    # The number of seconds without any stream in progress after which the
+    # connection to the client is closed.
+    idle_timeout = 120
+    # The names of the counters kept in counters.
+    COUNTER_NAMES = ('connections', 'streams', 'request_bytes', 'response_bytes')
+    # A WorkerCounters shared with the other worker processes, if any.
+    counters = None
+    # The size of eventlet's native thread pool, unless the
+    # EVENTLET_THREADPOOL_SIZE environment variable sets it.
+    UPSTREAM_THREADS = 256
+    # The HTTP/2 connections to the origin, shared by all the client
+    # connections of the process.
+    http2_conns = SharedHttp2Connections()
     """
     An object that manages a single HTTP/2 connection.
+
+    The connection's socket is read by run_forever. Each stream's request is
+    proxied from a green thread of its own, with the blocking exchange with
+    the origin run in eventlet's native thread pool, so a slow origin holds
+    up only the streams waiting on it. An exchange holds a thread for its
+    duration, so each process runs at most UPSTREAM_THREADS of them at once,
+    across all its connections, and the streams beyond that wait for a
+    thread. Responses are written back to the client as soon as they
+    complete, in frames that fit the client's flow control windows. A
+    response waiting for the client to open up a window is resumed when
+    run_forever receives the WINDOW_UPDATE.
+
+    Request bodies are held back at the stream level only: a stream's data
+    is acknowledged as the origin takes it, but the connection's window is
+    large enough for the stream windows of all the streams the client may
+    have open. A stream whose origin is slow, or which waits for a thread,
+    therefore never holds up the uploads of the others.
     """
 
-    def __init__(self, sock, h2_to_server=False):
+    def __init__(self, sock, h2_to_server=False, pp_context=None):
         listening_config = H2Configuration(
             client_side=False, validate_inbound_headers=False)
-        self.tls = threading.local()
-        self.tls.http_conns = {}
+        # HTTP/1 connections to the origin, one per concurrent stream.
+        self.http1_pool = UpstreamConnectionPool()
         self.sock = sock
-        self.sock.settimeout(1.0)
+        self.sock.settimeout(self.idle_timeout)
         self.listening_conn = H2Connection(config=listening_config)
         self.is_h2_to_server = h2_to_server
+        # The PROXY protocol header received on the client connection, which
+        # the connections to the origin made for it pass on.
+        self.pp_context = pp_context or ProxyProtocolContext()
         self.request_infos = {}
         self.client_sni = None
+        self._closed = False
+        # Responses are written from the streams' green threads. Serialize
+        # the writes to the socket so their frames do not interleave.
+        self._send_lock = Semaphore()
+        # stream id -> ResponseStream, for the responses being sent.
+        self.response_streams = {}
+        # The number of streams whose requests are being proxied.
+        self._streams_in_progress = 0
+        # Sent, and replaced, whenever the client may have opened up its flow
+        # control windows.
+        self._window_opened = eventlet.event.Event()
+        # (stream id, length) of the request body data handed to the origin
+        # by the native threads, which _send_acknowledgements acknowledges
+        # to the client once a byte written to _wake_writer wakes it up.
+        self._acknowledgements = queue.SimpleQueue()
+        wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_writer.setblocking(False)
+        self._wake_reader = eventlet.greenio.GreenSocket(wake_reader)
+
+    def _count(self, name, amount=1):
+        if self.counters is not None:
+            self.counters.add(name, amount)
+
+    def _notify_window_opened(self):
+        event, self._window_opened = self._window_opened, eventlet.event.Event()
+        event.send()
+
+    def _acknowledge_received_data(self, stream_id, flow_controlled_length):
+        """
+        Have request body data that was handed to the origin acknowledged to
+        the client. This may be called from any thread.
+        """
+        self._acknowledgements.put((stream_id, flow_controlled_length))
+        try:
+            self._wake_writer.send(b'\0')
+        except OSError:
+            # Either a wake up is already pending, filling the socket pair's
+            # buffer, or the connection is closed.
+            pass
+
+    def _send_acknowledgements(self):
+        """
+        Acknowledge the data passed to _acknowledge_received_data to the
+        client, letting it send more. This runs in a green thread of its own
+        until the connection ends.
+        """
+        try:
+            while self._wake_reader.recv(4096):
+                while True:
+                    try:
+                        stream_id, length = self._acknowledgements.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.listening_conn.acknowledge_received_data(length, stream_id)
+                self._flush()
+        finally:
+            self._wake_reader.close()
+
+    def _flush(self):
+        """
+        Send whatever the HTTP/2 connection has queued to the client.
+        """
+        with self._send_lock:
+            if self._closed:
+                return
+            data = self.listening_conn.data_to_send()
+            if not data:
+                return
+            try:
+                self.sock.sendall(data)
+            except (SSLError, SSLSysCallError) as e:
+                print(f'Ignoring exception for now: {e}')
 
     def run_forever(self):
+        self._count('connections')
         self.listening_conn.initiate_connection()
-
-        try:
-            self.sock.sendall(self.listening_conn.data_to_send())
-        except (SSLError, SSLSysCallError) as e:
-            print(f'Ignoring exception for now: {e}')
+        # See the class docstring.
+        settings = self.listening_conn.local_settings
+        self.listening_conn.increment_flow_control_window(
+            settings.max_concurrent_streams * settings.initial_window_size -
+            self.listening_conn.inbound_flow_control_window)
+        self._flush()
+        eventlet.spawn_n(self._send_acknowledgements)
 
         ssl_conn = self.sock.fd
         # See servername_callback for where this is set with set_app_data().
@@ -97,47 +428,45 @@ class Http2ConnectionManager(object):
 
         stream_id_list = set()
         frame_sequences = {}
-        resp_from_server = {}
+        # The streams whose requests have been handed to a green thread.
+        dispatched_streams = set()
         while True:
             try:
                 data = self.sock.recv(65535)
             except SSLError:
                 data = None
             except TimeoutError:
+                if self._streams_in_progress or self.listening_conn.open_inbound_streams:
+                    # Loop back around to receive more data.
+                    continue
+                # The connection is idle. Tell the client it is being closed.
+                self.listening_conn.close_connection()
+                self._flush()
                 data = None
-                for stream_id in resp_from_server.keys():
-                    response_headers, response_body, response_trailers = resp_from_server[
-                        stream_id]
-                    try:
-                        self.listening_conn.send_headers(
-                            stream_id, response_headers)
-                        self.listening_conn.send_data(
-                            stream_id, response_body, end_stream=False if response_trailers else True)
-                        if response_trailers:
-                            self.listening_conn.send_headers(
-                                stream_id, response_trailers, end_stream=True)
-
-                    except StreamClosedError as e:
-                        print(e)
-                    except StreamIDTooLowError as e:
-                        print(e)
-                try:
-                    self.sock.sendall(self.listening_conn.data_to_send())
-                except (SSLError, SSLSysCallError) as e:
-                    print(f'Ignoring exception for now: {e}')
-
-                # Loop back around to receive more data.
-                continue
 
             if not data:
                 # Connection ended.
-                for http_conn in self.tls.http_conns.values():
-                    http_conn.close()
+                self._closed = True
+                # Wake up the responses waiting on flow control.
+                self._notify_window_opened()
+                # Do not leave requests waiting for the rest of their bodies.
+                for request_info in self.request_infos.values():
+                    if request_info._body is not None:
+                        request_info._body.end()
+                # The HTTP/2 connections to the origin are shared with the
+                # other client connections, so they are left open.
+                self.http1_pool.close_all()
+                # Stop _send_acknowledgements.
+                self._wake_writer.close()
                 break
 
             events = self.listening_conn.receive_data(data)
             # For a header's only request, body data needs to be None.
             for event in events:
+                if isinstance(event, (WindowUpdated, RemoteSettingsChanged)):
+                    # Resume the responses waiting for a larger window.
+                    self._notify_window_opened()
+                    continue
                 if hasattr(event, 'stream_id'):
                     stream_id = event.stream_id
                     if stream_id not in self.request_infos:
@@ -149,9 +478,21 @@ class Http2ConnectionManager(object):
 
                     if isinstance(event, DataReceived):
                         frame_seq.append('DATA')
-                        if request_info._body_bytes is None:
-                            request_info._body_bytes = b''
-                        request_info._body_bytes += event.data
+                        if request_info._body is None:
+                            # The data is acknowledged to the client as it is
+                            # handed to the origin.
+                            request_info._body = RequestBody(
+                                functools.partial(self._acknowledge_received_data, stream_id),
+                                timeout=self.timeout)
+                        request_info._body.append(event.data, event.flow_controlled_length)
+                        self._count('request_bytes', len(event.data))
+                        # Start the request so that the body is forwarded to
+                        # the origin as it arrives.
+                        if stream_id not in dispatched_streams:
+                            dispatched_streams.add(stream_id)
+                            eventlet.spawn_n(
+                                self._handle_stream, request_info._headers,
+                                request_info._body, stream_id)
 
                     if isinstance(event, RequestReceived):
                         frame_seq.append('HEADERS')
@@ -165,20 +506,29 @@ class Http2ConnectionManager(object):
                         err = H2ErrorCodes(event.error_code).name
                         print(
                             f'Received RST_STREAM frame with error code {err} on stream {event.stream_id}.')
-                        if stream_id not in resp_from_server.keys():
-                            ret_vals = self.request_received(
-                                request_info._headers, request_info._body_bytes, stream_id)
-                            if ret_vals is not None:
-                                resp_from_server[stream_id] = ret_vals
+                        # Forward what was received of the body.
+                        if request_info._body is not None:
+                            request_info._body.end()
+                        response = self.response_streams.get(stream_id)
+                        if response is not None:
+                            response.state = ResponseState.CLOSED
+                            self._notify_window_opened()
+                        if stream_id not in dispatched_streams:
+                            dispatched_streams.add(stream_id)
+                            eventlet.spawn_n(
+                                self._handle_stream, request_info._headers,
+                                request_info._body, stream_id)
 
                     if isinstance(event, StreamEnded):
                         print('StreamEnded')
                         stream_id_list.add(stream_id)
-                        if stream_id not in resp_from_server.keys():
-                            ret_vals = self.request_received(
-                                request_info._headers, request_info._body_bytes, stream_id)
-                            if ret_vals is not None:
-                                resp_from_server[stream_id] = ret_vals
+                        if request_info._body is not None:
+                            request_info._body.end()
+                        if stream_id not in dispatched_streams:
+                            dispatched_streams.add(stream_id)
+                            eventlet.spawn_n(
+                                self._handle_stream, request_info._headers,
+                                request_info._body, stream_id)
 
                 else:
                     if isinstance(event, ConnectionTerminated):
@@ -202,11 +552,112 @@ class Http2ConnectionManager(object):
             except KeyError:
                 pass
 
-            try:
-                self.sock.sendall(self.listening_conn.data_to_send())
-            except (SSLError, SSLSysCallError) as e:
-                print(f'Ignoring exception for now: {e}')
-                pass
+            self._flush()
+
+    def _handle_stream(self, request_headers, req_body, stream_id):
+        """
+        Proxy a stream's request and write back the response.
+
+        This runs in a green thread of its own.
+        """
+        self._streams_in_progress += 1
+        self._count('streams')
+        try:
+            ret_vals = self.request_received(request_headers, req_body, stream_id)
+            if ret_vals is not None:
+                self._send_response(stream_id, *ret_vals)
+            # Send any error response or reset queued for the stream.
+            self._flush()
+        finally:
+            if req_body is not None:
+                # Acknowledge any of the body the origin did not take, so that
+                # it does not use up the connection's flow control window.
+                req_body.discard()
+            self._streams_in_progress -= 1
+
+    def _send_response(self, stream_id, response_headers, response_body,
+                       response_trailers, pacing):
+        """
+        Send a response as requested by its pacing directives and as the
+        client's flow control windows allow.
+
+        Its waits are green, so they let the connection's other streams, and
+        other connections, proceed.
+        """
+        response = ResponseStream(stream_id)
+        self.response_streams[stream_id] = response
+        try:
+            if pacing.delay:
+                eventlet.sleep(pacing.delay)
+            self.listening_conn.send_headers(stream_id, response_headers)
+            response.state = ResponseState.SENDING_BODY
+            if pacing.paces_body:
+                self._flush()
+                pacer = pacing.pacer()
+                for wait, chunk in pacer.pace(response_body or b''):
+                    eventlet.sleep(wait)
+                    if not self._send_data(response, chunk):
+                        return
+                    self._flush()
+            elif not self._send_data(response, response_body or b'',
+                                     end_stream=not response_trailers):
+                return
+            if response_trailers:
+                self.listening_conn.send_headers(
+                    stream_id, response_trailers, end_stream=True)
+            elif pacing.paces_body:
+                self.listening_conn.end_stream(stream_id)
+            response.state = ResponseState.ENDED
+        except StreamClosedError as e:
+            response.state = ResponseState.CLOSED
+            print(e)
+        except StreamIDTooLowError as e:
+            response.state = ResponseState.CLOSED
+            print(e)
+        finally:
+            del self.response_streams[stream_id]
+            self._flush()
+
+    def _send_data(self, response, data, end_stream=False):
+        """
+        Send data on the response's stream in frames that fit the client's
+        flow control windows, waiting for them to be opened up as needed.
+
+        Returns:
+            False if the stream or connection closed before all the data was
+            sent, True otherwise.
+        """
+        view = memoryview(data)
+        while True:
+            if response.state is ResponseState.CLOSED or self._closed:
+                return False
+            size = min(len(view), self.listening_conn.max_outbound_frame_size,
+                       self.listening_conn.local_flow_control_window(response.stream_id))
+            if size <= 0 and view:
+                self._flush()
+                self._window_opened.wait()
+                continue
+            last = size == len(view)
+            self.listening_conn.send_data(
+                response.stream_id, view[:size].tobytes(), end_stream=end_stream and last)
+            response.body_bytes_sent += size
+            self._count('response_bytes', size)
+            view = view[size:]
+            if last:
+                return True
+            # Let the other streams have their share of the connection's
+            # window.
+            eventlet.sleep(0)
+
+    def _reset_stalled_stream(self, stream_id, error):
+        """
+        Reset a stream whose client stopped sending its request body.
+        """
+        print(f"Resetting stream {stream_id}: {error}")
+        try:
+            self.listening_conn.reset_stream(stream_id, H2ErrorCodes.CANCEL)
+        except (StreamClosedError, ProtocolError) as err:
+            print(err)
 
     @staticmethod
     def convert_headers_to_http1(headers):
@@ -227,44 +678,59 @@ class Http2ConnectionManager(object):
                 request_headers_message.add_header(
                     name.decode("utf-8"), value.decode("utf-8"))
             request_headers = request_headers_message
-        request_headers = ProxyRequestHandler.filter_headers(request_headers)
+        req_directives = DirectiveEngine(request_headers)
+        request_headers = ProxyRequestHandler.filter_headers(request_headers, req_directives)
+        req_pacing = req_directives.get_pacing()
+        eventlet.sleep(req_pacing.delay)
 
         scheme = request_headers[':scheme']
         replay_server = f"127.0.0.1:{self.server_port}"
         method = request_headers[':method']
         path = request_headers[':path']
 
+        origin = (scheme, replay_server)
+        http1_headers = self.convert_headers_to_http1(request_headers)
+
+        def exchange_with_server():
+            # This runs in a native thread and must not touch the client
+            # connection.
+            connection_to_server = self.http1_pool.acquire(
+                origin, lambda: self._create_http1_connection(scheme, replay_server))
+            body = req_body
+            if body is not None and 'content-length' not in http1_headers:
+                # http.client would send a streamed body of unknown length
+                # chunked. Wait for all of it instead.
+                body = body.read_all()
+                http1_headers['Content-Length'] = str(len(body))
+            if body is not None and req_pacing.paces_body:
+                # This runs in the exchange's own native thread, which can
+                # wait between the chunks.
+                body = ProxyRequestHandler.paced(body, req_pacing.pacer())
+            try:
+                connection_to_server.request(method, path, body, http1_headers)
+                res = connection_to_server.getresponse()
+
+                version_table = {10: 'HTTP/1.0', 11: 'HTTP/1.1'}
+                setattr(res, 'headers', res.msg)
+                setattr(res, 'response_version', version_table[res.version])
+
+                response_body = res.read()
+            except Exception:
+                self.http1_pool.discard(connection_to_server)
+                raise
+            self.http1_pool.release(origin, connection_to_server)
+            return res, response_body
+
         try:
-            origin = (scheme, replay_server)
-            if origin not in self.tls.http_conns:
-                if scheme == 'https':
-                    if self.client_sni:
-                        gcontext = WrapSSSLContext(self.client_sni)
-                    else:
-                        gcontext = ssl.SSLContext()
-                    self.tls.http_conns[origin] = http.client.HTTPSConnection(
-                        replay_server, timeout=self.timeout, context=gcontext,
-                        cert_file=self.cert_file)
-                else:
-                    self.tls.http_conns[origin] = http.client.HTTPConnection(
-                        replay_server, timeout=self.timeout)
-            connection_to_server = self.tls.http_conns[origin]
-            http1_headers = self.convert_headers_to_http1(request_headers)
-            connection_to_server.request(method, path, req_body, http1_headers)
-            res = connection_to_server.getresponse()
-
-            version_table = {10: 'HTTP/1.0', 11: 'HTTP/1.1'}
-            setattr(res, 'headers', res.msg)
-            setattr(res, 'response_version', version_table[res.version])
-
-            response_body = res.read()
+            res, response_body = tpool.execute(exchange_with_server)
+        except RequestBodyTimeout as e:
+            self._reset_stalled_stream(stream_id, e)
+            return
         except Exception as e:
-            if origin in self.tls.http_conns:
-                del self.tls.http_conns[origin]
             try:
                 self.listening_conn.send_headers(
                     stream_id, [(':status', '502')], end_stream=True)
-            except StreamClosedError as err:
+            except (StreamClosedError, ProtocolError) as err:
                 print(err)
             authority = request_headers.get(':authority', '')
             print(f"Connection to '{replay_server}' initiated with request to "
@@ -272,7 +738,8 @@ class Http2ConnectionManager(object):
             traceback.print_exc(file=sys.stdout)
             return
 
-        setattr(res, 'headers', ProxyRequestHandler.filter_headers(res.headers))
+        res_directives = DirectiveEngine(res.headers)
+        setattr(res, 'headers', ProxyRequestHandler.filter_headers(res.headers, res_directives))
 
         response_headers = [
             (':status', str(res.status)),
@@ -288,7 +755,29 @@ class Http2ConnectionManager(object):
             res.status,
             res.reason)
         # do not return trailers
-        return response_headers, response_body, None
+        return response_headers, response_body, None, res_directives.get_pacing()
+
+    def _create_http1_connection(self, scheme, replay_server):
+        if scheme == 'https':
+            if self.client_sni:
+                gcontext = WrapSSSLContext(self.client_sni, self.pp_context)
+            else:
+                gcontext = ssl.SSLContext()
+            return http.client.HTTPSConnection(
+                replay_server, timeout=self.timeout, context=gcontext,
+                cert_file=self.cert_file)
+        return http.client.HTTPConnection(replay_server, timeout=self.timeout)
+
+    def _get_http2_connection(self, origin):
+        """
+        Return the HTTP/2 connection to the origin, connecting if there is
+        none yet. This blocks, so it is run in a native thread.
+
+        Returns:
+            The Http2Connection, or None if the server does not speak HTTP/2.
+        """
+        return self.http2_conns.get(origin, lambda: connect_to_http2_server(
+            self.server_port, self.cert_file, self.client_sni, self.pp_context))
 
     def _send_http2_request_to_server(self, request_headers, req_body, client_stream_id):
         if not self.is_h2_to_server:
@@ -300,70 +789,66 @@ class Http2ConnectionManager(object):
             request_headers_message.add_header(
                 name.decode("utf-8"), value.decode("utf-8"))
         request_headers = request_headers_message
-        request_headers = ProxyRequestHandler.filter_headers(request_headers)
+        req_directives = DirectiveEngine(request_headers)
+        request_headers = ProxyRequestHandler.filter_headers(request_headers, req_directives)
+        req_pacing = req_directives.get_pacing()
+        eventlet.sleep(req_pacing.delay)
 
         scheme = request_headers[':scheme']
         replay_server = f"127.0.0.1:{self.server_port}"
         path = request_headers[':path']
 
+        # The connection carries the client's PROXY header, if any, so it is
+        # only shared with clients that sent the same one.
+        origin = (scheme, replay_server, self.client_sni, self.pp_context.key)
+        client = None
         try:
-            origin = (scheme, replay_server, self.client_sni)
-            if origin not in self.tls.http_conns:
-                # Open a socket to the server and initiate TLS/SSL.
-                ssl_context = _create_ssl_context(
-                    cert=self.cert_file)
-                if self.client_sni:
-                    setattr(ssl_context, "old_wrap_socket",
-                            ssl_context.wrap_socket)
-
-                    def new_wrap_socket(sock, *args, **kwargs):
-                        # Send proxy protocol header first before TLS handshake.
-                        kwargs['server_hostname'] = self.client_sni
-                        return ssl_context.old_wrap_socket(sock, *args, **kwargs)
-                    setattr(ssl_context, "wrap_socket", new_wrap_socket)
-                # Opens a connection to the server.
-                sock = ProxyProtocolUtil.create_connection_and_send_pp(
-                    ('127.0.0.1', self.server_port))
-                sock = ssl_context.wrap_socket(sock)
-                if sock.selected_alpn_protocol() != 'h2':
-                    # Server downgrades to HTTP/1. Send an http/1 request
-                    # instead.
-                    return self._send_http1_request_to_server(
-                        request_headers, req_body, client_stream_id)
-                # Initiate a HTTP/2 connection.
-                http2_connection = H2Connection()
-                http2_connection.initiate_connection()
-                sock.sendall(http2_connection.data_to_send())
-                self.tls.http_conns[origin] = Http2Connection(
-                    sock, http2_connection)
-
-            client = self.tls.http_conns[origin]
-            response_from_server = client.send_request(
-                client_stream_id, request_headers.items(), req_body)
+            client = tpool.execute(self._get_http2_connection, origin)
+            if client is None:
+                # Server downgrades to HTTP/1. Send an http/1 request
+                # instead.
+                return self._send_http1_request_to_server(
+                    request_headers, req_body, client_stream_id)
+            body = req_body
+            if body is not None and req_pacing.paces_body:
+                # send_request iterates over the body in the exchange's own
+                # native thread, which can wait between the chunks.
+                body = ProxyRequestHandler.paced(body, req_pacing.pacer())
+            response_from_server = tpool.execute(
+                client.send_request, request_headers.items(), body)
             if response_from_server.errors:
-                if origin in self.tls.http_conns:
-                    del self.tls.http_conns[origin]
+                # A stream reset leaves the connection usable for the other
+                # streams.
+                if not client.is_usable:
+                    self.http2_conns.discard(origin, client)
                 try:
                     if 'StreamReset' in response_from_server.errors:
                         self.listening_conn.reset_stream(client_stream_id)
                     if 'ConnectionTerminated' in response_from_server.errors:
                         self.listening_conn.close_connection(last_stream_id=0)
-                except StreamClosedError as err:
+                except (StreamClosedError, ProtocolError) as err:
                     print(err)
                 return
+        except RequestBodyTimeout as e:
+            self._reset_stalled_stream(client_stream_id, e)
+            return
         except Exception as e:
-            if origin in self.tls.http_conns:
-                del self.tls.http_conns[origin]
-            self.listening_conn.send_headers(
-                client_stream_id, [(':status', '502')], end_stream=True)
+            if client is not None and not client.is_usable:
+                self.http2_conns.discard(origin, client)
+            try:
+                self.listening_conn.send_headers(
+                    client_stream_id, [(':status', '502')], end_stream=True)
+            except (StreamClosedError, ProtocolError) as err:
+                print(err)
             authority = request_headers.get(':authority', '')
             print(f"Connection to '{replay_server}' initiated with request to "
                   f"'{scheme}://{authority}{path}' failed: {e}")
             traceback.print_exc(file=sys.stdout)
             return
         # Process the headers with directEngine.
+        res_directives = DirectiveEngine(response_from_server.headers)
         filtered_response_headers = ProxyRequestHandler.filter_headers(
-            response_from_server.headers).raw
+            response_from_server.headers, res_directives).raw
         # Http/2 response does not have reason phrase.
         empty_reason_phrase = ''
 
@@ -375,7 +860,8 @@ class Http2ConnectionManager(object):
             response_from_server.trailers,
             response_from_server.status_code,
             empty_reason_phrase)
-        return filtered_response_headers, response_from_server.body, response_from_server.trailers
+        return (filtered_response_headers, response_from_server.body,
+                response_from_server.trailers, res_directives.get_pacing())
 
     def request_received(self, request_headers, req_body, stream_id):
         if self.is_h2_to_server:
@@ -405,6 +891,8 @@ class Http2ConnectionManager(object):
             print(f"{k}: {v}")
 
         if req_body is not None:
+            if isinstance(req_body, RequestBody):
+                req_body = req_body.getvalue()
             print(f"\n==== REQUEST BODY ====\n{req_body}")
 
         print("\n==== RESPONSE ====")
@@ -441,7 +929,13 @@ def servername_callback(conn):
     print(f"Got SNI from client: {sni}")
 
 
-def configure_http2_server(listen_port, server_port, https_pem, ca_pem, h2_to_server=False):
+def create_server_context(https_pem):
+    """
+    Create the context for TLS connections from clients to the proxy.
+
+    Create the context before forking worker processes so that they all
+    share its session ticket keys.
+    """
     # Let's set up SSL. This is a lot of work in PyOpenSSL.
     options = (
         SSL.OP_NO_COMPRESSION |
@@ -463,33 +957,66 @@ def configure_http2_server(listen_port, server_port, https_pem, ca_pem, h2_to_se
         "RSA+AESGCM"
     )
     context.set_tmp_ecdh(crypto.get_elliptic_curve('prime256v1'))
+    return context
 
-    server = eventlet.listen(('0.0.0.0', listen_port))
+
+def configure_http2_server(listen_port, server_port, https_pem, ca_pem, h2_to_server=False,
+                           server_context=None):
+    context = server_context or create_server_context(https_pem)
+    # The pool is sized when first used. Eventlet's default of 20 threads
+    # would serialize the exchanges with the origin beyond 20 streams.
+    if 'EVENTLET_THREADPOOL_SIZE' not in os.environ:
+        tpool.set_num_threads(Http2ConnectionManager.UPSTREAM_THREADS)
+
+    # SO_REUSEPORT, eventlet's default, lets several worker processes, each
+    # with its own hub, listen on the same port. The kernel then balances
+    # incoming connections across them.
+    server = eventlet.listen(('0.0.0.0', listen_port), reuse_port=True)
 
     print("wrapping socket with proxy protocol")
     # wrap the socket with proxy protocol socket. Here we don't pass in the SSL
     # info as SSL stuff will be taken care later in SSL.Connection()
     server = ProxyProtocolUtil.wrap_socket(server)
-    server = SSL.Connection(context, server)
     server_side_proto = "HTTP/2" if h2_to_server else "HTTP/1.x"
     print(f"Serving HTTP/2 Proxy on 127.0.0.1:{listen_port} with pem "
           f"'{https_pem}', forwarding to 127.0.0.1:{server_port} via "
           f"{server_side_proto}")
     pool = eventlet.GreenPool()
 
+    def serve_connection(client_sock, client_addr):
+        # The PROXY header is read, and the TLS handshake completed, in the
+        # connection's own green thread so that a slow or silent client does
+        # not hold up accepting the others.
+        try:
+            client_sock, pp_context = server.complete_accept(client_sock)
+            new_sock = SSL.Connection(context, client_sock)
+            new_sock.set_accept_state()
+            new_sock.settimeout(PP_ACCEPT_TIMEOUT)
+            new_sock.do_handshake()
+        except (OSError, ValueError, SSLError) as e:
+            print(f"Dropping the connection from {client_addr[0]}:{client_addr[1]}: {e}")
+            client_sock.close()
+            return
+        manager = Http2ConnectionManager(new_sock, h2_to_server, pp_context)
+        manager.server_port = server_port
+        manager.cert_file = https_pem
+        manager.ca_file = ca_pem
+        manager.run_forever()
+
     while True:
         try:
-            new_sock, _ = server.accept()
-            manager = Http2ConnectionManager(new_sock, h2_to_server)
-            manager.server_port = server_port
-            manager.cert_file = https_pem
-            manager.ca_file = ca_pem
-            pool.spawn_n(manager.run_forever)
+            client_sock, client_addr = server.accept()
+            # Responses waiting on flow control go out in small writes. Do not
+            # let Nagle's algorithm hold them back.
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            pool.spawn_n(serve_connection, client_sock, client_addr)
         except KeyboardInterrupt as e:
             # The calling test_proxy.py will handle this.
             print("Handling KeyboardInterrupt")
+            Http2ConnectionManager.http2_conns.close_all()
             raise e
         except SystemExit:
+            Http2ConnectionManager.http2_conns.close_all()
             break
 
 
@@ -498,131 +1025,571 @@ class Headers:
     This class is needed to support some dict-like operations in the
     directEngine logic for header processing. Under the hood, the headers are
     stored as a list of tuples. It allows for multiple values for the same key.
+
+    Field names are matched case insensitively, through an index from the
+    case folded name to the positions of its fields in the list. The index is
+    built on first use and then kept up to date by the item operations.
+    Deleted fields are only marked as such, and are dropped from the list when
+    raw is next read, so that no operation has to rebuild the list. The list
+    should therefore only be modified through the item operations.
     """
 
     def __init__(self, raw_headers):
-        self.raw = raw_headers
+        self._raw = list(raw_headers)
+        # Case folded name -> positions of its fields in self._raw.
+        self._index = None
+        # Whether self._raw has deleted fields, marked by None.
+        self._has_deleted = False
+
+    @property
+    def raw(self):
+        """
+        The headers as a list of (name, value) tuples, as h2 takes them.
+        """
+        if self._has_deleted:
+            self._raw = [field for field in self._raw if field is not None]
+            self._has_deleted = False
+            # The positions shifted.
+            self._index = None
+        return self._raw
+
+    @raw.setter
+    def raw(self, raw_headers):
+        self._raw = list(raw_headers)
+        self._index = None
+        self._has_deleted = False
+
+    def _positions(self):
+        if self._index is None:
+            # The index is only dropped along with the deleted fields, so
+            # every field is present here.
+            index = {}
+            for i, (name, _) in enumerate(self._raw):
+                folded = name.lower()
+                positions = index.get(folded)
+                if positions is None:
+                    index[folded] = [i]
+                else:
+                    positions.append(i)
+            self._index = index
+        return self._index
 
     def __getitem__(self, key):
         # This function returns the value of the key in the headers. If there
         # are multiple values, they are joined by a comma. This behavior is
         # similar to what httpx does.
-        values = [str(tuple_item[1])
-                  for tuple_item in self.raw if tuple_item[0] == key]
-        if not values:
+        positions = self._positions().get(key.lower())
+        if not positions:
             raise KeyError(f'Key {key} not found in headers.')
-        return ','.join(values)
+        return ','.join(str(self._raw[i][1]) for i in positions)
 
     def __setitem__(self, key, value):
         # This function sets the value of the first matching key in the headers.
-        for i, kv in enumerate(self.raw):
-            if kv[0] == key:
-                self.raw[i] = (key, value)
-                return
+        index = self._positions()
+        positions = index.get(key.lower())
+        if positions:
+            self._raw[positions[0]] = (key, value)
+            return
         # The key is not in the list. Append the key-value pair.
-        self.raw.append((key, value))
+        index[key.lower()] = [len(self._raw)]
+        self._raw.append((key, value))
 
     def __delitem__(self, key):
         # Remove all the key-value pairs with the given key.
-        self.raw = [item for item in self.raw if item[0] != key]
+        positions = self._positions().pop(key.lower(), None)
+        if not positions:
+            return
+        for i in positions:
+            self._raw[i] = None
+        self._has_deleted = True
+
+    def __contains__(self, key):
+        return bool(self._positions().get(key.lower()))
 
     def __iter__(self):
-        return (tuple_item[0] for tuple_item in self.raw)
+        return (field[0] for field in self._raw if field is not None)
 
 
 class Response:
     """
     This class represents a Http/2 response.
+
+    A response relayed as it arrives has no body but chunks, an async
+    iterator of the body's chunks, and its trailers are only known once they
+    are exhausted.
     """
 
-    def __init__(self, status, headers, body, trailers=None, errors=None):
+    def __init__(self, status, headers, body, trailers=None, errors=None, chunks=None):
         self.status_code = status
         self.headers = headers
         self.body = body
         self.trailers = trailers
         self.errors = errors
+        self.chunks = chunks
 
 
 class Http2Connection:
     '''
-    This class manages a single HTTP/2 connection to a server. It is not
-    thread-safe. For our purpose though, no lock is neccessary as the streams of
-    each connection are processed sequentially.
+    This class manages a single HTTP/2 connection to a server, shared by
+    concurrent streams.
+
+    send_request may be called from several threads at once. Each request is
+    sent on a stream id of its own, its body within the flow control windows
+    the server grants. A slow stream therefore holds up no other.
+
+    A request can also be sent without a thread waiting on it: open_stream
+    sends its header block and has the response handed to a listener as it
+    arrives, while send_body_data sends as much of the body as the windows
+    allow at the time.
+
+    An SSL socket must not be used from two threads at once, so all reads
+    and writes are done by the connection's I/O thread, over the socket in
+    non-blocking mode. The threads sending requests only update the h2
+    connection's state and wake the I/O thread up, which sends the frames
+    this produced. It also receives the server's frames and hands each
+    stream's events to that stream, whose future completes with the response
+    once the stream ends.
     '''
 
+    # How long to wait for a response, or for the server to open up its flow
+    # control windows, in seconds.
+    timeout = 5
+    # The most bytes read from the socket at a time.
+    read_size = 65535
+
     def __init__(self, sock, h2conn):
         self.sock = sock
         self.conn = h2conn
+        # Guards self.conn and the state below. It is notified whenever the
+        # server may have opened up its flow control windows.
+        self._lock = threading.Condition()
+        # stream id -> _UpstreamStream, for the streams awaiting a response.
+        self._streams = {}
+        # Set once the server sent GOAWAY or the connection closed.
+        self._terminated = False
+        # Set by close, after which the I/O thread sends the frames still
+        # pending and closes the socket.
+        self._closing = False
+        # A byte written to _wake_writer wakes the I/O thread up.
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        for s in (self.sock, self._wake_reader, self._wake_writer):
+            s.setblocking(False)
+        self._io_thread = threading.Thread(
+            target=self._run_io, name='h2-upstream-io', daemon=True)
+        self._io_thread.start()
+
+    @property
+    def is_usable(self):
+        '''
+        Whether new requests can be sent on the connection.
+        '''
+        return not self._terminated
 
-    def send_request(self, stream_id, headers, req_body):
-        '''
-        Sends a request to the h2 connection and returns the response object containing the headers, body, and possible errors.
-        '''
-        self.conn.send_headers(stream_id, headers)
-        if req_body:
-            self.conn.send_data(stream_id, req_body)
-        self.conn.end_stream(stream_id)
-        # Send the data over the socket.
-        self.sock.sendall(self.conn.data_to_send())
-        response_headers_raw = None
-        response_body = b''
-        response_stream_ended = False
-        trailers = None
-        errors = []
-        while not response_stream_ended:
-            # Read raw data from the socket.
-            data = self.sock.recv(65536 * 1024)
-            if not data:
-                break
-            # Feed raw data into h2 engine, and process resulting events.
-            events = self.conn.receive_data(data)
-            for event in events:
-                if isinstance(event, ResponseReceived):
-                    # Received response headers.
-                    response_headers_raw = event.headers
-                if isinstance(event, DataReceived):
-                    # Update flow control so the server doesn't starve us.
-                    self.conn.acknowledge_received_data(
-                        event.flow_controlled_length, event.stream_id)
-                    # Received more response body data.
-                    response_body += event.data
-                if isinstance(event, TrailersReceived):
-                    # Received trailer headers.
-                    trailers = event.headers
-                if isinstance(event, StreamReset):
-                    # Stream reset by the server.
-                    print(
-                        f"Received RST_STREAM from the server: {event}")
-                    errors.append('StreamReset')
-                    response_stream_ended = True
+    def send_request(self, headers, req_body):
+        '''
+        Sends a request to the h2 connection and returns the response object
+        containing the headers, body, and possible errors.
+
+        This blocks until the response is complete and so is called from a
+        native thread.
+
+        Args:
+            headers: The request headers.
+
+            req_body: None, the body as bytes, or an iterable of the body's
+            chunks, such as a RequestBody. The chunks are sent as they are
+            produced.
+        '''
+        stream = _UpstreamStream()
+        stream_id = self.open_stream(headers, stream)
+        try:
+            if isinstance(req_body, (bytes, bytearray)):
+                req_body = (req_body,)
+            body_complete = True
+            for chunk in req_body or ():
+                # The lock is not held while waiting for the next chunk.
+                with self._lock:
+                    body_complete = self._send_body(stream_id, stream, chunk)
+                if not body_complete:
                     break
-                if isinstance(event, ConnectionTerminated):
-                    # Received GOAWAY frame from the server.
-                    print(
-                        f"Received GOAWAY from the server: {event}")
-                    errors.append('ConnectionTerminated')
-                    response_stream_ended = True
+            with self._lock:
+                try:
+                    if body_complete:
+                        self.conn.end_stream(stream_id)
+                    else:
+                        # The server responded, or reset the stream, before
+                        # the whole body was sent. Abandon the rest of it.
+                        self.conn.reset_stream(stream_id, H2ErrorCodes.CANCEL)
+                except ProtocolError:
+                    # The stream, or the connection, is already closed.
+                    pass
+                self._wake()
+            try:
+                return stream.future.result(timeout=self.timeout)
+            except concurrent.futures.TimeoutError:
+                raise TimeoutError(
+                    f"Timed out waiting for the response on stream {stream_id}.")
+        except BaseException:
+            self.reset_stream(stream_id)
+            raise
+
+    def open_stream(self, headers, listener):
+        '''
+        Send a request's header block on a new stream, without waiting.
+
+        The response is handed to listener by the connection's I/O thread as
+        it arrives, with calls to its headers_received, data_received,
+        trailers_received and finish methods, or to fail if the connection
+        fails. Its window_opened method is called whenever the server may
+        have opened up its flow control windows. The data received is
+        acknowledged to the server right away unless listener.holds_back_data
+        is true, in which case it is only acknowledged as acknowledge is
+        called for it, so that a slow reader holds the server back.
+
+        Returns:
+            The stream id.
+        '''
+        with self._lock:
+            if self._terminated:
+                raise ConnectionError("The HTTP/2 connection to the server is closed.")
+            stream_id = self.conn.get_next_available_stream_id()
+            self._streams[stream_id] = listener
+            self.conn.send_headers(stream_id, headers)
+            self._wake()
+        return stream_id
+
+    def send_body_data(self, stream_id, data):
+        '''
+        Send as much of data on a stream opened with open_stream as the flow
+        control windows allow, without waiting.
+
+        Returns:
+            The number of bytes sent, or None if the response has ended.
+        '''
+        with self._lock:
+            if self._terminated:
+                raise ConnectionError("The HTTP/2 connection to the server is closed.")
+            if stream_id not in self._streams:
+                return None
+            size = min(self.conn.local_flow_control_window(stream_id), len(data))
+            sent = 0
+            while sent < size:
+                frame_size = min(size - sent, self.conn.max_outbound_frame_size)
+                self.conn.send_data(stream_id, bytes(data[sent:sent + frame_size]))
+                sent += frame_size
+            if sent:
+                self._wake()
+            return sent
+
+    def end_stream(self, stream_id):
+        '''
+        End the request body sent on a stream opened with open_stream.
+        '''
+        with self._lock:
+            try:
+                self.conn.end_stream(stream_id)
+            except ProtocolError:
+                # The stream, or the connection, is already closed.
+                return
+            self._wake()
+
+    def reset_stream(self, stream_id):
+        '''
+        Abandon a stream. Its listener is told nothing more.
+        '''
+        with self._lock:
+            self._streams.pop(stream_id, None)
+            try:
+                self.conn.reset_stream(stream_id, H2ErrorCodes.CANCEL)
+            except ProtocolError:
+                # The stream, or the connection, is already closed.
+                return
+            self._wake()
+
+    def acknowledge(self, stream_id, length):
+        '''
+        Let the server send length more bytes, once a listener which holds
+        back data has consumed them.
+        '''
+        with self._lock:
+            try:
+                self.conn.acknowledge_received_data(length, stream_id)
+            except ProtocolError:
+                # The connection is already closed.
+                return
+            self._wake()
+
+    def _send_body(self, stream_id, stream, body):
+        '''
+        Send the body in frames that fit the flow control windows, waiting
+        for the server to open them up as needed. The lock must be held.
+
+        Returns:
+            False if the stream ended before the whole body was sent, True
+            otherwise.
+        '''
+        view = memoryview(body)
+        while view:
+            if stream.future.done():
+                return False
+            if self._terminated:
+                raise ConnectionError("The HTTP/2 connection to the server is closed.")
+            size = min(self.conn.local_flow_control_window(stream_id),
+                       self.conn.max_outbound_frame_size, len(view))
+            if size <= 0:
+                # Let the I/O thread process WINDOW_UPDATE frames.
+                if not self._lock.wait(self.timeout):
+                    raise TimeoutError(
+                        "Timed out waiting for the server to open its flow control "
+                        f"window on stream {stream_id}.")
+                continue
+            self.conn.send_data(stream_id, view[:size].tobytes())
+            view = view[size:]
+            self._wake()
+        return True
+
+    def _wake(self):
+        '''
+        Wake the I/O thread up to send the frames pending in self.conn.
+        '''
+        try:
+            self._wake_writer.send(b'\0')
+        except OSError:
+            # Either a wake up is already pending, filling the socket
+            # pair's buffer, or the I/O thread is done.
+            pass
+
+    def _run_io(self):
+        '''
+        Exchange frames with the server until the connection closes. This
+        runs in the connection's I/O thread, the only one using the socket.
+        '''
+        selector = selectors.DefaultSelector()
+        selector.register(self._wake_reader, selectors.EVENT_READ)
+        selector.register(self.sock, selectors.EVENT_READ)
+        outbound = b''
+        try:
+            while True:
+                with self._lock:
+                    outbound += self.conn.data_to_send()
+                    closing = self._closing
+                if closing and not outbound:
                     break
-                if isinstance(event, StreamEnded):
-                    # Received complete response body.
-                    response_stream_ended = True
+                events = selectors.EVENT_READ
+                if outbound:
+                    events |= selectors.EVENT_WRITE
+                selector.modify(self.sock, events)
+                ready = selector.select(self.timeout if closing else None)
+                if not ready:
+                    # The server does not take the frames sent on closing.
                     break
-            if not errors:
-                # Send any pending data to the server.
-                self.sock.sendall(self.conn.data_to_send())
+                readable = False
+                for key, _ in ready:
+                    if key.fileobj is self._wake_reader:
+                        try:
+                            self._wake_reader.recv(4096)
+                        except BlockingIOError:
+                            pass
+                    else:
+                        readable = True
+                if outbound:
+                    outbound = self._write(outbound)
+                if readable and not self._read():
+                    break
+        except Exception as e:
+            print(f"Failed to exchange frames with the server: {e}")
+        finally:
+            selector.close()
+            with self._lock:
+                self._terminated = True
+                streams, self._streams = self._streams, {}
+                self._lock.notify_all()
+            for stream in streams.values():
+                stream.fail(ConnectionError("The HTTP/2 connection to the server closed."))
+            for s in (self.sock, self._wake_reader, self._wake_writer):
+                s.close()
+
+    def _write(self, outbound):
+        '''
+        Write as much of outbound as the socket takes.
+
+        Returns:
+            What is left to write.
+        '''
+        try:
+            sent = self.sock.send(outbound)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+            return outbound
+        return outbound[sent:]
+
+    def _read(self):
+        '''
+        Read what the server sent, including what the SSL layer buffered,
+        and dispatch its events to the streams.
+
+        Returns:
+            False once the server closed the connection, True otherwise.
+        '''
+        while True:
+            try:
+                data = self.sock.recv(self.read_size)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                return True
+            if not data:
+                return False
+            with self._lock:
+                try:
+                    for event in self.conn.receive_data(data):
+                        self._handle_event(event)
+                finally:
+                    self._lock.notify_all()
+
+    def _handle_event(self, event):
+        if isinstance(event, ConnectionTerminated):
+            # Received GOAWAY frame from the server.
+            print(
+                f"Received GOAWAY from the server: {event}")
+            self._terminated = True
+            # The server will not process the streams after the last one it
+            # reported.
+            for stream_id in [stream_id for stream_id in self._streams
+                              if stream_id > (event.last_stream_id or 0)]:
+                self._streams.pop(stream_id).finish('ConnectionTerminated')
+            return
+        if isinstance(event, (WindowUpdated, RemoteSettingsChanged)):
+            for stream in self._streams.values():
+                stream.window_opened()
+            return
+        stream = self._streams.get(getattr(event, 'stream_id', None))
+        if stream is None:
+            return
+        if isinstance(event, ResponseReceived):
+            # Received response headers.
+            stream.headers_received(event.headers)
+        elif isinstance(event, DataReceived):
+            if not stream.holds_back_data:
+                # Update flow control so the server doesn't starve us.
+                self.conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            # Received more response body data.
+            stream.data_received(event.data, event.flow_controlled_length)
+        elif isinstance(event, TrailersReceived):
+            # Received trailer headers.
+            stream.trailers_received(event.headers)
+        elif isinstance(event, StreamReset):
+            # Stream reset by the server.
+            print(
+                f"Received RST_STREAM from the server: {event}")
+            del self._streams[event.stream_id]
+            stream.finish('StreamReset')
+        elif isinstance(event, StreamEnded):
+            # Received complete response body.
+            del self._streams[event.stream_id]
+            stream.finish()
 
+    def close(self):
+        # Tell the server we are closing the h2 connection. The I/O thread
+        # sends the GOAWAY frame, then closes the socket.
+        with self._lock:
+            if self._closing:
+                return
+            self._terminated = True
+            self._closing = True
+            try:
+                self.conn.close_connection()
+            except ProtocolError:
+                pass
+        self._wake()
+
+
+class _UpstreamStream:
+    '''
+    The response being received on a stream of an Http2Connection, for
+    send_request.
+    '''
+
+    # The connection acknowledges the body as it arrives.
+    holds_back_data = False
+
+    def __init__(self):
+        self.headers = None
+        self.body = []
+        self.trailers = None
+        self.future = concurrent.futures.Future()
+
+    def headers_received(self, headers):
+        self.headers = headers
+
+    def data_received(self, data, flow_controlled_length):
+        self.body.append(data)
+
+    def trailers_received(self, headers):
+        self.trailers = headers
+
+    def window_opened(self):
+        # send_request waits on the connection's condition instead.
+        pass
+
+    def finish(self, error=None):
+        '''
+        Complete the future with the response received so far.
+        '''
         # Decode the header fields.
         response_headers = [(key.decode(), value.decode())
-                            for key, value in response_headers_raw]
+                            for key, value in self.headers or []]
         status_code = next(
             (t[1] for t in response_headers if t[0] == ':status'), None)
-        return Response(status_code, Headers(response_headers), response_body, trailers, errors)
+        errors = [error] if error else []
+        self.future.set_result(Response(
+            status_code, Headers(response_headers), b''.join(self.body),
+            self.trailers, errors))
 
-    def close(self):
-        # Tell the server we are closing the h2 connection.
-        self.conn.close_connection()
-        self.sock.sendall(self.conn.data_to_send())
-        self.sock.close()
+    def fail(self, exception):
+        self.future.set_exception(exception)
+
+
+def connect_to_http2_server(server_port, cert_file, sni=None, pp_context=None):
+    """
+    Open an HTTP/2 connection to the server. This blocks.
+
+    Args:
+        server_port: The server's port on 127.0.0.1.
+
+        cert_file: The certificate to present to the server.
+
+        sni: The server name to send, if any.
+
+        pp_context: The ProxyProtocolContext of the client connection the
+        connection is made for, whose PROXY header, if any, is sent first.
+
+    Returns:
+        The Http2Connection, or None if the server does not speak HTTP/2.
+    """
+    # Open a socket to the server and initiate TLS/SSL.
+    ssl_context = _create_ssl_context(
+        cert=cert_file)
+    if sni:
+        setattr(ssl_context, "old_wrap_socket",
+                ssl_context.wrap_socket)
+
+        def new_wrap_socket(sock, *args, **kwargs):
+            # Send proxy protocol header first before TLS handshake.
+            kwargs['server_hostname'] = sni
+            return ssl_context.old_wrap_socket(sock, *args, **kwargs)
+        setattr(ssl_context, "wrap_socket", new_wrap_socket)
+    # Opens a connection to the server.
+    if pp_context is None:
+        pp_context = ProxyProtocolContext()
+    sock = pp_context.create_connection(('127.0.0.1', server_port))
+    sock = ssl_context.wrap_socket(sock)
+    if sock.selected_alpn_protocol() != 'h2':
+        sock.close()
+        return None
+    # Initiate a HTTP/2 connection. The connection's I/O thread sends the
+    # preface.
+    http2_connection = H2Connection()
+    http2_connection.initiate_connection()
+    return Http2Connection(sock, http2_connection)
 
 
 def _create_ssl_context(cert):
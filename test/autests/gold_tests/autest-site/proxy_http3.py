@@ -7,30 +7,42 @@ Implement HTTP/3 proxy behavior in Python.
 # SPDX-License-Identifier: Apache-2.0
 #
 import asyncio
+import collections
+from contextlib import AsyncExitStack
+import itertools
 import json
 import os
+import time
 from pathlib import Path
 from typing import Callable, Dict, Optional, Union
 
 # For HTTP/1 to origin.
 from email.message import EmailMessage as HttpHeaders
 import http.client
+import ssl
 import sys
-import threading
 import traceback
 import urllib
 
 import aioquic
-from aioquic.asyncio import QuicConnectionProtocol, serve
+from aioquic.asyncio import QuicConnectionProtocol, connect, serve
+from aioquic.asyncio.server import QuicServer
 from aioquic.h0.connection import H0Connection
-from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.h3.connection import H3_ALPN, ErrorCode as H3ErrorCode, H3Connection
 from aioquic.h3.events import DataReceived, H3Event, Headers, HeadersReceived
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.logger import QuicLogger, QuicLoggerTrace
-from aioquic.quic.events import DatagramFrameReceived, ProtocolNegotiated, QuicEvent
-from aioquic.tls import SessionTicket
+from aioquic.quic.logger import QLOG_VERSION, QuicLogger, QuicLoggerTrace, hexdump
+from aioquic.quic.events import (
+    ConnectionTerminated, DatagramFrameReceived, ProtocolNegotiated, QuicEvent, StreamReset)
 
+from async_http1_client import AsyncHttp1Connection
+from background_writer import BackgroundFileWriter
+from connection_pool import UpstreamConnectionPool
+from directive_engine import DirectiveEngine
 from proxy_http1 import ProxyRequestHandler
+import proxy_http2
+from quic_steering import assign_worker_connection_ids
+from session_ticket_store import SessionTicketStore
 
 AsgiApplication = Callable
 HttpConnection = Union[H0Connection, H3Connection]
@@ -40,27 +52,249 @@ SERVER_NAME = "aioquic/" + aioquic.__version__
 
 class QuicDirectoryLogger(QuicLogger):
     """
-    Custom QUIC logger which writes one trace per file.
+    Custom QUIC logger which streams each trace to a file of its own.
+
+    The events are written as they are logged, as a JSON text sequence
+    (.sqlog), through a BackgroundFileWriter. Neither logging an event nor
+    ending a connection therefore waits on the disk. Only 1 in every
+    sample_rate connections is traced. The others log nothing at all.
     """
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, writer: BackgroundFileWriter, sample_rate: int = 1) -> None:
         if not os.path.isdir(path):
             raise ValueError(f"QUIC log output directory '{path}' does not exist")
+        if sample_rate < 1:
+            raise ValueError(f"Invalid qlog sample rate: {sample_rate}")
         self.path = path
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self._sample_counter = itertools.count()
         super().__init__()
 
+    def start_trace(self, is_client: bool, odcid: bytes) -> Optional[QuicLoggerTrace]:
+        # aioquic does not log the connection at all without a trace.
+        if next(self._sample_counter) % self.sample_rate != 0:
+            return None
+        trace_path = os.path.join(self.path, hexdump(odcid) + ".sqlog")
+        return JsonSeqQuicLoggerTrace(
+            is_client=is_client, odcid=odcid, writer=self.writer, path=trace_path)
+
     def end_trace(self, trace: QuicLoggerTrace) -> None:
-        trace_dict = trace.to_dict()
-        trace_path = os.path.join(
-            self.path, trace_dict["common_fields"]["ODCID"] + ".qlog"
-        )
-        with open(trace_path, "w", encoding='utf-8') as logger_fp:
-            json.dump({"qlog_version": "draft-01", "traces": [trace_dict]}, logger_fp)
-        self._traces.remove(trace)
+        self.writer.close_file(trace.path)
+
+
+class JsonSeqQuicLoggerTrace(QuicLoggerTrace):
+    """
+    A QUIC event trace written out event by event rather than kept in memory.
+    """
+
+    def __init__(self, *, is_client: bool, odcid: bytes, writer: BackgroundFileWriter,
+                 path: str) -> None:
+        super().__init__(is_client=is_client, odcid=odcid)
+        self.writer = writer
+        self.path = path
+        self.writer.write(self.path, {
+            "qlog_format": "JSON-SEQ",
+            "qlog_version": QLOG_VERSION,
+            "trace": {
+                "common_fields": {"ODCID": hexdump(odcid)},
+                "vantage_point": self._vantage_point,
+            },
+        }, render=_json_seq_record, block=True)
+
+    def log_event(self, *, category: str, event: str, data: Dict) -> None:
+        # The event is dropped if the writer cannot keep up.
+        self.writer.write(self.path, {
+            "data": data,
+            "name": category + ":" + event,
+            "time": self.encode_time(time.time()),
+        }, render=_json_seq_record)
+
+
+def _json_seq_record(record: Dict) -> str:
+    """
+    Render a record of a JSON text sequence (RFC 7464).
+    """
+    return "\x1e" + json.dumps(record) + "\n"
+
+
+class FlowControlledQuicProtocol(QuicConnectionProtocol):
+    """
+    A QUIC connection whose streams are written no faster than they are sent.
+
+    aioquic queues whatever is written to a stream until flow control credit
+    and the congestion window let it be sent. send_data instead waits while
+    more than SEND_BUFFER_LIMIT bytes written to the stream are still to be
+    sent, so that a slow peer holds the writer back rather than grow the
+    proxy's buffers.
+    """
+
+    SEND_BUFFER_LIMIT = 256 * 1024
+    # The most data written to a stream at a time.
+    SEND_CHUNK_SIZE = 64 * 1024
+    # How long to wait for a datagram before checking on a stream anyway, in
+    # case a timer, rather than a datagram, let its data be sent.
+    PROGRESS_CHECK_INTERVAL = 0.05
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Set, and replaced, whenever a datagram may have let data be sent.
+        self._progress = asyncio.Event()
+        self.is_closed = False
+
+    def datagram_received(self, data, addr) -> None:
+        super().datagram_received(data, addr)
+        self._notify_progress()
+
+    def quic_event_received(self, event: QuicEvent) -> None:
+        if isinstance(event, ConnectionTerminated):
+            self.is_closed = True
+            self._notify_progress()
+
+    async def send_data(self, http: H3Connection, stream_id: int, data: bytes,
+                        end_stream: bool = False) -> bool:
+        """
+        Write data to a stream in DATA frames, waiting whenever the stream has
+        too much left to send.
+
+        Returns:
+            False if the connection closed before all the data was written.
+        """
+        view = memoryview(data)
+        while True:
+            while self._unsent_bytes(stream_id) > self.SEND_BUFFER_LIMIT and not self.is_closed:
+                try:
+                    await asyncio.wait_for(self._progress.wait(), self.PROGRESS_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            if self.is_closed:
+                return False
+            piece = view[:self.SEND_CHUNK_SIZE]
+            view = view[len(piece):]
+            http.send_data(stream_id=stream_id, data=piece.tobytes(),
+                           end_stream=end_stream and not view)
+            self.transmit()
+            if not view:
+                return True
+
+    def _unsent_bytes(self, stream_id: int) -> int:
+        stream = self._quic._streams.get(stream_id)
+        if stream is None:
+            return 0
+        return stream.sender._buffer_stop - stream.sender.highest_offset
+
+    def _notify_progress(self) -> None:
+        self._progress.set()
+        self._progress = asyncio.Event()
+
+
+class RequestBody:
+    """
+    A request body received in DATA frames, readable while it still arrives.
+
+    The handler appends the frames' data as it arrives and the request to
+    the origin iterates over it, waiting until more arrives or the body
+    ends. The chunks are kept so that the whole body can be logged once the
+    transaction is over.
+
+    If the request's pacing directives pace its body, the reader is handed
+    it in the Pacer's chunks and at its pace.
+    """
+
+    def __init__(self) -> None:
+        self._chunks = []
+        # Hands the chunks to the reader, None marking the end.
+        self._arrived: asyncio.Queue = asyncio.Queue()
+        self.ended = False
+        # The Pacer of the body, if it is paced.
+        self.pacer = None
+
+    def append(self, data: bytes) -> None:
+        self._chunks.append(data)
+        self._arrived.put_nowait(data)
+
+    def end(self) -> None:
+        if not self.ended:
+            self.ended = True
+            self._arrived.put_nowait(None)
+
+    async def __aiter__(self):
+        while True:
+            data = await self._arrived.get()
+            if data is None:
+                return
+            if self.pacer is None:
+                yield data
+                continue
+            for wait, chunk in self.pacer.pace(data):
+                if wait:
+                    await asyncio.sleep(wait)
+                yield bytes(chunk)
+
+    async def read_all(self) -> bytes:
+        """
+        Wait for the body to end and return all of it.
+        """
+        async for _ in self:
+            pass
+        return self.getvalue()
+
+    def getvalue(self) -> bytes:
+        return b''.join(self._chunks)
+
+
+class OriginResponse:
+    """
+    A response from the origin, relayed to the client as its body arrives.
+    """
+
+    def __init__(self, request_headers, request_body, status, reason, headers, chunks,
+                 trailers, pacing, release=None) -> None:
+        """
+        Args:
+            request_headers: The request headers, as sent to the origin.
+
+            request_body: The RequestBody.
+
+            status: The response status code.
+
+            reason: The response reason phrase.
+
+            headers: The response headers to send to the client.
+
+            chunks: An async iterator of the response body's chunks.
+
+            trailers: The response trailers to send to the client, if any.
+
+            pacing: The response's Pacing.
+
+            release: A function called once the response is relayed, with
+            whether its whole body was read.
+        """
+        self.request_headers = request_headers
+        self.request_body = request_body
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunks = chunks
+        self.trailers = trailers
+        self.pacing = pacing
+        self.release = release
+
+
+async def _chunks_of(body: bytes):
+    """
+    Generate the chunks of a body received whole.
+    """
+    if body:
+        yield body
 
 
 class HttpRequestHandler:
     timeout = 5
+    # Keep-alive connections to the origin, shared by all streams of all
+    # connections. They are only used from the event loop.
+    upstream_pool = UpstreamConnectionPool()
 
     def __init__(
         self,
@@ -74,6 +308,7 @@ class HttpRequestHandler:
         transmit: Callable[[], None],
         is_h3_to_server: bool,
         server_port: int,
+        is_h2_to_server: bool = False,
     ) -> None:
         self.authority = authority
         self.connection = connection
@@ -83,17 +318,14 @@ class HttpRequestHandler:
         self.stream_id = stream_id
         self.transmit = transmit
         self.is_h3_to_server = is_h3_to_server
+        self.is_h2_to_server = is_h2_to_server
         self.server_port = server_port
 
-        self.client_request_done_event: asyncio.Event = asyncio.Event()
         self.request_headers: Headers = None
-        self.request_body = b''
-
-        self.response_headers: Headers
-        self.response_body = b""
-
-        self.local_thread = threading.local()
-        self.local_thread.http_conns = {}
+        # The request is sent to the origin while its body still arrives.
+        self.request_body = RequestBody()
+        # Set if the client reset its stream.
+        self.is_reset = False
 
         if stream_ended:
             self.queue.put_nowait({"type": "http.request"})
@@ -110,9 +342,17 @@ class HttpRequestHandler:
             new_headers.add_header(key, value)
         return new_headers
 
-    # TODO: Gah...this should be asynchronous. Punting on that for now. It will
-    # currently block.
-    def _send_http1_request_to_server(self, request_headers, req_body, stream_id):
+    async def _send_http1_request_to_server(self, request_headers, req_body, stream_id):
+        """
+        Send the request to the origin over HTTP/1.
+
+        If the exchange with the origin fails before the response head is
+        received, the client is answered with a 502.
+
+        Returns:
+            The OriginResponse, or None if the client's stream was answered
+            with an error instead.
+        """
         if not isinstance(request_headers, HttpHeaders):
             request_headers_message = HttpHeaders()
             for name, value in request_headers:
@@ -126,54 +366,152 @@ class HttpRequestHandler:
         method = request_headers[':method']
         path = request_headers[':path']
 
+        origin = (scheme, replay_server)
+        connection_to_server = None
+        # Set once the connection is handed over to the OriginResponse, whose
+        # release puts it back in the pool.
+        handed_over = False
         try:
-            origin = (scheme, replay_server)
-            if origin not in self.local_thread.http_conns:
-                self.local_thread.http_conns[origin] = http.client.HTTPConnection(
-                    replay_server, timeout=self.timeout)
-            connection_to_server = self.local_thread.http_conns[origin]
+            # The exchange with the origin only waits on the event loop, so the
+            # other streams and connections proceed in the meantime.
+            connection_to_server = self.upstream_pool.acquire(
+                origin, lambda: AsyncHttp1Connection(
+                    '127.0.0.1', self.server_port, timeout=self.timeout))
             http1_headers = self.convert_headers_to_http1(request_headers)
-            if req_body:
-                http1_headers.add_header('Content-Length', str(len(req_body)))
-            connection_to_server.request(method, path, req_body, http1_headers)
-            res = connection_to_server.getresponse()
+            if req_body.ended and req_body.pacer is None:
+                # The body has all arrived already, so it is sent whole.
+                body = await req_body.read_all()
+                if body and 'Content-Length' not in http1_headers:
+                    http1_headers.add_header('Content-Length', str(len(body)))
+            else:
+                # Stream the body to the origin as it arrives, chunked if the
+                # client did not give its length.
+                body = req_body
+            res = await connection_to_server.request(
+                method, path, body, http1_headers, stream=True)
 
-            version_table = {10: 'HTTP/1.0', 11: 'HTTP/1.1'}
-            setattr(res, 'headers', res.msg)
-            setattr(res, 'response_version', version_table[res.version])
+            res_directives = DirectiveEngine(res.headers)
+            setattr(res, 'headers', ProxyRequestHandler.filter_headers(res.headers, res_directives))
 
-            response_body = res.read()
+            response_headers = [
+                (':status'.encode(), str(res.status).encode()),
+            ]
+            # Field names are lowercase in HTTP/3.
+            for k, v in res.headers.items():
+                response_headers += ((k.lower().encode(), v.encode()),)
+            handed_over = True
         except Exception as e:
             authority = request_headers.get(':authority', '')
             print(f"Connection to '{replay_server}' initiated with request to "
                   f"'{scheme}://{authority}{path}' failed: {e}")
             traceback.print_exc(file=sys.stdout)
-            raise e
+            self.connection.send_headers(
+                stream_id=stream_id, headers=[(b':status', b'502')], end_stream=True)
+            self.transmit()
+            return None
+        finally:
+            if not handed_over and connection_to_server is not None:
+                # The connection is in an unknown state.
+                self.upstream_pool.discard(connection_to_server)
+
+        def release(complete):
+            if complete:
+                self.upstream_pool.release(origin, connection_to_server)
+            else:
+                # The rest of the body is still to be read.
+                self.upstream_pool.discard(connection_to_server)
+        return OriginResponse(
+            request_headers, req_body, res.status, res.reason, response_headers, res.chunks,
+            None, res_directives.get_pacing(), release)
+
+    async def _send_request_to_origin(self, request_headers, req_body, stream_id):
+        """
+        Send the request to the origin over HTTP/3 or HTTP/2.
+
+        The request is sent on a connection to the origin shared by all the
+        streams proxied to it, each request on a stream of its own. The
+        response is relayed to the client as its body arrives. If the origin
+        resets the stream, or closes the connection, before completing the
+        response, the client's stream is reset in turn.
+
+        Returns:
+            The OriginResponse, or None if the client's stream was reset or
+            answered with an error instead.
+        """
+        # For all of these, for convenience, we simply talk to 127.0.0.1.
+        replay_server = f"127.0.0.1:{self.server_port}"
+        scheme = 'https'
+        authority = request_headers.get(':authority', '')
+        path = request_headers.get(':path', '')
+        server_name = urllib.parse.urlsplit(f'//{authority}').hostname
 
         try:
-            setattr(res, 'headers', ProxyRequestHandler.filter_headers(res.headers))
+            if self.is_h3_to_server:
+                connection = await http3_origin_connections.get(
+                    ('127.0.0.1', self.server_port, server_name))
+            else:
+                connection = await http2_origin_connections.get(
+                    (self.server_port, server_name))
+                if connection is None:
+                    # The origin does not speak HTTP/2.
+                    return await self._send_http1_request_to_server(
+                        request_headers, req_body, stream_id)
 
-            response_headers = [
-                (':status'.encode(), str(res.status).encode()),
-            ]
-            for k, v in res.headers.items():
-                response_headers += ((k.encode(), v.encode()),)
-            self.print_info(
-                request_headers,
-                req_body,
-                response_headers,
-                response_body,
-                res.status,
-                res.reason)
+            request_headers = ProxyRequestHandler.filter_headers(request_headers)
+            # Field names are lowercase in HTTP/2 and HTTP/3.
+            headers = [(name.lower().encode(), value.encode())
+                       for name, value in request_headers.items()]
+            response = await connection.send_request(headers, req_body, self.timeout)
+        except Exception as e:
+            print(f"Connection to '{replay_server}' initiated with request to "
+                  f"'{scheme}://{authority}{path}' failed: {e}")
+            traceback.print_exc(file=sys.stdout)
+            self.connection.send_headers(
+                stream_id=stream_id, headers=[(b':status', b'502')], end_stream=True)
+            self.transmit()
+            return None
 
+        if response.errors:
+            print(f"The origin did not complete the response to "
+                  f"'{scheme}://{authority}{path}': {', '.join(response.errors)}")
+            self.protocol.reset_stream(stream_id, H3ErrorCode.H3_REQUEST_CANCELLED)
+            return None
+
+        try:
+            res_directives = DirectiveEngine(response.headers)
+            response_headers = ProxyRequestHandler.filter_headers(
+                response.headers, res_directives)
+            response_headers = [(name.encode(), value.encode())
+                                for name, value in response_headers.raw]
         except Exception as e:
-            print(f"Curating the HTTP/1 response to proxy to HTTP/3 failed: {e}")
+            response.chunks.close()
+            print(f"Curating the response to proxy to HTTP/3 failed: {e}")
             traceback.print_exc(file=sys.stdout)
             raise e
-        return response_headers, response_body
+        # Closing the stream abandons it unless the whole response was read.
+        origin_response = OriginResponse(
+            request_headers, req_body, response.status_code, '', response_headers,
+            None, None, res_directives.get_pacing(),
+            lambda complete: response.chunks.close())
+        origin_response.chunks = self._chunks_then_trailers(response, origin_response)
+        return origin_response
+
+    @staticmethod
+    async def _chunks_then_trailers(response, origin_response):
+        """
+        Generate the chunks of a response's body as they arrive from the
+        origin, then hand its trailers, if any, to origin_response.
+        """
+        async for chunk in response.chunks:
+            yield chunk
+        if response.trailers:
+            origin_response.trailers = [
+                (name if isinstance(name, bytes) else name.encode(),
+                 value if isinstance(value, bytes) else value.encode())
+                for name, value in response.trailers]
 
     def print_info(self, request_headers, req_body, response_headers, res_body,
-                   response_status, response_reason):
+                   response_status, response_reason, response_trailers=None):
         def parse_qsl(s):
             return '\n'.join(
                 "%-20s %s" %
@@ -200,50 +538,144 @@ class HttpRequestHandler:
         if res_body is not None:
             print(f"\n==== RESPONSE BODY ====\n{res_body}\n")
 
+        if response_trailers:
+            print("==== RESPONSE TRAILERS ====")
+            for k, v in response_trailers:
+                print(f"{k.decode('ascii')}: {v.decode('ascii')}")
+            print()
+
     def http_event_received(self, event: H3Event) -> None:
         if isinstance(event, DataReceived):
-            self.request_body += event.data
-            if event.stream_ended:
-                self.client_request_done_event.set()
+            self.request_body.append(event.data)
         elif isinstance(event, HeadersReceived):
             if self.request_headers is not None:
                 self.request_headers.append(event.headers)
             else:
                 self.request_headers = event.headers
-            if event.stream_ended:
-                self.client_request_done_event.set()
+        if event.stream_ended:
+            self.request_body.end()
         self.transmit()
 
-    async def send_response(self) -> None:
+    def stream_reset(self) -> None:
+        """
+        Stop relaying the transaction: the client reset its stream, or the
+        connection closed.
+        """
+        self.is_reset = True
+        self.request_body.end()
 
-        await self.client_request_done_event.wait()
-        if self.is_h3_to_server:
-            raise RuntimeError(
-                "Unexpectedly received HTTP/3 to origin configuration.")
+    async def send_response(self) -> None:
+        # The request is sent as soon as its headers have arrived, its body
+        # following as it arrives.
+        request_headers = HttpHeaders()
+        for name, value in self.request_headers:
+            request_headers.add_header(name.decode(), value.decode())
+        # Wait on the event loop so that the connection's other streams, and
+        # other connections, proceed in the meantime.
+        pacing = DirectiveEngine(request_headers).get_pacing()
+        if pacing.paces_body:
+            self.request_body.pacer = pacing.pacer()
+        await asyncio.sleep(pacing.delay)
+        if self.is_h3_to_server or self.is_h2_to_server:
+            response = await self._send_request_to_origin(
+                request_headers, self.request_body, self.stream_id)
         else:
-            self.response_headers, self.response_body = self._send_http1_request_to_server(
-                self.request_headers, self.request_body, self.stream_id)
+            response = await self._send_http1_request_to_server(
+                request_headers, self.request_body, self.stream_id)
+        if response is None:
+            return
+        await self._relay_response(response)
 
+    async def _relay_response(self, response: OriginResponse) -> None:
+        """
+        Send the response to the client as its body arrives from the origin,
+        as requested by its pacing directives.
+
+        The body is sent no faster than the client's stream takes it, so that
+        a slow client holds the origin back rather than have the response
+        buffered.
+        """
+        body = []
+        complete = False
         try:
+            await asyncio.sleep(response.pacing.delay)
+            chunk = await self._next_chunk(response.chunks)
             self.connection.send_headers(
                 stream_id=self.stream_id,
-                headers=self.response_headers,
-                end_stream=not self.response_body
+                headers=response.headers,
+                end_stream=chunk is None and not response.trailers
             )
-            if self.response_body:
-                self.connection.send_data(
-                    stream_id=self.stream_id,
-                    data=self.response_body,
-                    end_stream=True
-                )
             self.transmit()
+            pacer = response.pacing.pacer() if response.pacing.paces_body else None
+            sent_body = chunk is not None
+            while chunk is not None:
+                body.append(chunk)
+                if not await self._send_body_chunk(chunk, pacer):
+                    break
+                chunk = await self._next_chunk(response.chunks)
+            else:
+                complete = True
+                if response.trailers:
+                    self.connection.send_headers(
+                        stream_id=self.stream_id,
+                        headers=response.trailers,
+                        end_stream=True
+                    )
+                elif sent_body:
+                    await self.protocol.send_data(
+                        self.connection, self.stream_id, b'', end_stream=True)
+                self.transmit()
         except Exception as e:
             print(f"Transmitting the HTTP/3 response to the client failed: {e}")
             traceback.print_exc(file=sys.stdout)
-            raise e
+            if not self.is_reset:
+                # Do not leave the client waiting for the rest of the response.
+                self.protocol.reset_stream(self.stream_id, H3ErrorCode.H3_REQUEST_CANCELLED)
+            return
+        finally:
+            if not complete:
+                await response.chunks.aclose()
+            if response.release is not None:
+                response.release(complete)
+
+        self.print_info(
+            response.request_headers,
+            response.request_body.getvalue(),
+            response.headers,
+            b''.join(body),
+            response.status,
+            response.reason,
+            response.trailers)
+
+    async def _send_body_chunk(self, chunk, pacer) -> bool:
+        """
+        Send a chunk of the response body, in paced pieces if there is a
+        pacer.
+
+        Returns:
+            False if the stream was reset or the connection closed meanwhile.
+        """
+        steps = pacer.pace(chunk) if pacer is not None else ((0, chunk),)
+        for wait, piece in steps:
+            if wait:
+                await asyncio.sleep(wait)
+            if self.is_reset or not await self.protocol.send_data(
+                    self.connection, self.stream_id, piece):
+                return False
+        return True
+
+    @staticmethod
+    async def _next_chunk(chunks) -> Optional[bytes]:
+        """
+        Return the next chunk of the body, or None at its end.
+        """
+        try:
+            return await chunks.__anext__()
+        except StopAsyncIteration:
+            return None
 
 
-class HttpQuicServerHandler(QuicConnectionProtocol):
+class HttpQuicServerHandler(FlowControlledQuicProtocol):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self._handlers: Dict[int, HttpRequestHandler] = {}
@@ -308,6 +740,7 @@ class HttpQuicServerHandler(QuicConnectionProtocol):
                 transmit=self.transmit,
                 is_h3_to_server=self.h3_to_server,
                 server_port=self.server_port,
+                is_h2_to_server=self.h2_to_server,
             )
             self._handlers[event.stream_id] = handler
             handler.http_event_received(event)
@@ -319,9 +752,22 @@ class HttpQuicServerHandler(QuicConnectionProtocol):
             handler = self._handlers[event.stream_id]
             handler.http_event_received(event)
 
+    def reset_stream(self, stream_id: int, error_code: int) -> None:
+        """
+        Abruptly terminate the sending part of the client's stream.
+        """
+        self._quic.reset_stream(stream_id, error_code)
+        self.transmit()
+
     def quic_event_received(self, event: QuicEvent) -> None:
-        if isinstance(event, ProtocolNegotiated):
-            if event.alpn_protocol.startswith("h3-"):
+        super().quic_event_received(event)
+        if isinstance(event, StreamReset) and event.stream_id in self._handlers:
+            self._handlers[event.stream_id].stream_reset()
+        elif isinstance(event, ConnectionTerminated):
+            for handler in self._handlers.values():
+                handler.stream_reset()
+        elif isinstance(event, ProtocolNegotiated):
+            if event.alpn_protocol == "h3" or event.alpn_protocol.startswith("h3-"):
                 self._http = H3Connection(self._quic)
             elif event.alpn_protocol.startswith("hq-"):
                 self._http = H0Connection(self._quic)
@@ -335,19 +781,456 @@ class HttpQuicServerHandler(QuicConnectionProtocol):
                 self.http_event_received(http_event)
 
 
-class SessionTicketStore:
+class SharedOriginConnections:
     """
-    Simple in-memory store for session tickets.
+    The connections to the origins, one per origin, shared by all the
+    streams proxied to it.
+
+    The connection to an origin is made by the first stream that needs it.
+    Streams that need it meanwhile wait for that same connection rather than
+    making their own. A connection that failed or is no longer usable is
+    replaced by the next stream that needs it.
     """
 
-    def __init__(self) -> None:
-        self.tickets: Dict[bytes, SessionTicket] = {}
+    def __init__(self, connect: Callable) -> None:
+        """
+        Args:
+            connect: A coroutine function taking an origin and returning a
+            connection to it, or None if the origin cannot be connected to.
+        """
+        self._connect = connect
+        # origin -> the asyncio.Task making, or which made, its connection.
+        self._connections: Dict = {}
+
+    async def get(self, origin):
+        task = self._connections.get(origin)
+        if task is not None and task.done() and (
+                task.cancelled() or task.exception() is not None or
+                (task.result() is not None and not task.result().is_usable)):
+            task = None
+        if task is None:
+            task = asyncio.ensure_future(self._connect(*origin))
+            self._connections[origin] = task
+        # A waiting stream that is cancelled does not cancel the connection
+        # attempt the other streams wait on.
+        return await asyncio.shield(task)
+
+
+class Http3OriginConnection(FlowControlledQuicProtocol):
+    """
+    An HTTP/3 connection to the origin, shared by concurrent streams.
+
+    Each request is sent on a stream of its own, whose response is handed
+    over as it arrives, so a slow stream holds up no other.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._http = H3Connection(self._quic)
+        # stream id -> _OriginStream, for the streams awaiting a response.
+        self._streams: Dict[int, _OriginStream] = {}
+        # Closes the connection. Set by connect_to_http3_server.
+        self.exit_stack: Optional[AsyncExitStack] = None
+
+    @property
+    def is_usable(self) -> bool:
+        """
+        Whether new requests can be sent on the connection.
+        """
+        return not self.is_closed
+
+    async def send_request(self, headers: Headers, body, timeout: float):
+        """
+        Send a request and wait for its response's header block.
+
+        Args:
+            headers: The request header fields, as bytes.
+
+            body: The request body as bytes, None, or an async iterable of the
+            body's chunks, which are sent as they are produced.
+
+            timeout: How long to wait for the response, and then for each
+            chunk of its body, in seconds.
+
+        Returns:
+            The proxy_http2.Response, whose chunks, an _OriginStream, iterate
+            over its body as it arrives.
+        """
+        if self.is_closed:
+            raise ConnectionError("The HTTP/3 connection to the server is closed.")
+        stream_id = self._quic.get_next_available_stream_id()
+        stream = _OriginStream(timeout, cancel=lambda: self._cancel_stream(stream_id))
+        self._streams[stream_id] = stream
+        if body is None or isinstance(body, (bytes, bytearray)):
+            body = _chunks_of(body)
+        self._http.send_headers(stream_id=stream_id, headers=headers)
+        self.transmit()
+        async for chunk in body:
+            if stream.finished or not await self.send_data(self._http, stream_id, chunk):
+                # The server already responded or reset the stream.
+                break
+        else:
+            if not stream.finished:
+                await self.send_data(self._http, stream_id, b'', end_stream=True)
+        try:
+            response = await asyncio.wait_for(stream.head, timeout)
+        except asyncio.TimeoutError:
+            self._cancel_stream(stream_id)
+            raise TimeoutError(f"Timed out waiting for the response on stream {stream_id}.")
+        return response
+
+    def _cancel_stream(self, stream_id: int) -> None:
+        if self._streams.pop(stream_id, None) is not None and not self.is_closed:
+            self._quic.reset_stream(stream_id, H3ErrorCode.H3_REQUEST_CANCELLED)
+            self.transmit()
+
+    def quic_event_received(self, event: QuicEvent) -> None:
+        super().quic_event_received(event)
+        if isinstance(event, StreamReset):
+            stream = self._streams.pop(event.stream_id, None)
+            if stream is not None:
+                print(f"Received RESET_STREAM from the server: {event}")
+                stream.finish('StreamReset')
+        elif isinstance(event, ConnectionTerminated):
+            print(f"The HTTP/3 connection to the server closed: {event}")
+            streams, self._streams = self._streams, {}
+            for stream in streams.values():
+                stream.finish('ConnectionTerminated')
+            if self.exit_stack is not None:
+                # Release the connection's socket.
+                asyncio.ensure_future(self.exit_stack.aclose())
+                self.exit_stack = None
+
+        for http_event in self._http.handle_event(event):
+            if not isinstance(http_event, (DataReceived, HeadersReceived)):
+                continue
+            stream = self._streams.get(http_event.stream_id)
+            if stream is None:
+                continue
+            if isinstance(http_event, HeadersReceived):
+                if stream.response is None:
+                    stream.headers_received(http_event.headers)
+                else:
+                    stream.trailers_received(http_event.headers)
+            elif isinstance(http_event, DataReceived):
+                stream.data_received(http_event.data)
+            if http_event.stream_ended:
+                del self._streams[http_event.stream_id]
+                stream.finish()
+
+
+class Http2OriginConnection:
+    """
+    A proxy_http2.Http2Connection to the origin, used from the event loop.
+
+    The connection's I/O thread hands each stream's response over to the
+    event loop as it arrives, and request bodies are sent from the event loop
+    as the flow control windows allow, so no thread waits on a request. The
+    response body is only acknowledged to the origin as the client's stream
+    takes it.
+    """
+
+    def __init__(self, connection: proxy_http2.Http2Connection) -> None:
+        self._connection = connection
+
+    @property
+    def is_usable(self) -> bool:
+        """
+        Whether new requests can be sent on the connection.
+        """
+        return self._connection.is_usable
+
+    async def send_request(self, headers: Headers, body, timeout: float):
+        """
+        Send a request and wait for its response's header block.
+
+        Args:
+            headers: The request header fields, as bytes.
+
+            body: The request body as bytes, None, or an async iterable of the
+            body's chunks, which are sent as they are produced.
+
+            timeout: How long to wait for the response, and then for each
+            chunk of its body, in seconds.
+
+        Returns:
+            The proxy_http2.Response, whose chunks, an _OriginStream, iterate
+            over its body as it arrives.
+        """
+        connection = self._connection
+        stream = _OriginStream(
+            timeout,
+            acknowledge=lambda length: connection.acknowledge(stream_id, length),
+            cancel=lambda: connection.reset_stream(stream_id))
+        stream_id = connection.open_stream(
+            headers, _LoopListener(stream, asyncio.get_running_loop()))
+        try:
+            if body is None or isinstance(body, (bytes, bytearray)):
+                body = _chunks_of(body)
+            async for chunk in body:
+                if not await self._send_body_chunk(stream_id, stream, chunk, timeout):
+                    # The server already responded or reset the stream.
+                    connection.reset_stream(stream_id)
+                    break
+            else:
+                connection.end_stream(stream_id)
+            try:
+                response = await asyncio.wait_for(stream.head, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError(
+                    f"Timed out waiting for the response on stream {stream_id}.")
+        except BaseException:
+            connection.reset_stream(stream_id)
+            raise
+        return response
+
+    async def _send_body_chunk(self, stream_id: int, stream: '_OriginStream', chunk: bytes,
+                               timeout: float) -> bool:
+        """
+        Send a chunk of the request body, waiting for the server to open up
+        its flow control windows as needed.
+
+        Returns:
+            False if the response ended before the whole chunk was sent.
+        """
+        view = memoryview(chunk)
+        while view:
+            stream.window.clear()
+            sent = self._connection.send_body_data(stream_id, view)
+            if sent is None:
+                return False
+            view = view[sent:]
+            if view and not sent:
+                try:
+                    await asyncio.wait_for(stream.window.wait(), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(
+                        "Timed out waiting for the server to open its flow control "
+                        f"window on stream {stream_id}.")
+        return True
+
+
+class _LoopListener:
+    """
+    Pass the events an Http2Connection's I/O thread receives for a stream on
+    to its _OriginStream, on the event loop.
+    """
+
+    # The _OriginStream acknowledges the body as the client takes it.
+    holds_back_data = True
+
+    def __init__(self, stream: '_OriginStream', loop: asyncio.AbstractEventLoop) -> None:
+        self._stream = stream
+        self._loop = loop
+
+    def headers_received(self, headers) -> None:
+        self._call(self._stream.headers_received, headers)
+
+    def data_received(self, data: bytes, flow_controlled_length: int) -> None:
+        self._call(self._stream.data_received, data, flow_controlled_length)
+
+    def trailers_received(self, headers) -> None:
+        self._call(self._stream.trailers_received, headers)
+
+    def window_opened(self) -> None:
+        self._call(self._stream.window.set)
+
+    def finish(self, error: Optional[str] = None) -> None:
+        self._call(self._stream.finish, error)
+
+    def fail(self, exception: Exception) -> None:
+        self._call(self._stream.fail, exception)
+
+    def _call(self, callback: Callable, *args) -> None:
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The event loop is closed.
+            pass
 
-    def add(self, ticket: SessionTicket) -> None:
-        self.tickets[ticket.ticket] = ticket
 
-    def pop(self, label: bytes) -> Optional[SessionTicket]:
-        return self.tickets.pop(label, None)
+class _OriginStream:
+    """
+    The response being received on a stream of a connection to the origin.
+
+    The response is handed over as it arrives: head completes with the
+    proxy_http2.Response once its header block has arrived, and the stream
+    then iterates over the chunks of its body as its DATA frames arrive. The
+    data which arrived meanwhile is handed over as a single chunk.
+    """
+
+    # The most data handed over as a single chunk.
+    MAX_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, timeout: float, acknowledge: Optional[Callable] = None,
+                 cancel: Optional[Callable] = None) -> None:
+        """
+        Args:
+            timeout: How long to wait for each chunk of the body, in seconds.
+
+            acknowledge: A function called with the flow controlled length of
+            each chunk of the body once it is taken, or abandoned, if the
+            connection only lets the server send more as it is called.
+
+            cancel: A function called to abandon the stream if it is closed
+            before the response is complete.
+        """
+        self._timeout = timeout
+        self._acknowledge = acknowledge or (lambda length: None)
+        self._cancel = cancel or (lambda: None)
+        self.head: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.response: Optional[proxy_http2.Response] = None
+        # (data, flow controlled length) pairs, yet to be taken.
+        self._pending = collections.deque()
+        # Set whenever data arrives or the response ends.
+        self._arrived = asyncio.Event()
+        # The flow controlled length of the chunk last taken, until it is
+        # acknowledged.
+        self._taken = 0
+        # Set once no more of the response arrives.
+        self.finished = False
+        self._error: Optional[str] = None
+        self._closed = False
+        # Set whenever the server may have opened up its flow control windows.
+        self.window = asyncio.Event()
+
+    def headers_received(self, headers: Headers) -> None:
+        response_headers = [(key.decode(), value.decode()) for key, value in headers]
+        status_code = next(
+            (value for key, value in response_headers if key == ':status'), None)
+        self.response = proxy_http2.Response(
+            status_code, proxy_http2.Headers(response_headers), None, None, [], self)
+        if not self.head.done():
+            self.head.set_result(self.response)
+
+    def data_received(self, data: bytes, flow_controlled_length: int = 0) -> None:
+        if self._closed or not data:
+            self._acknowledge(flow_controlled_length)
+            return
+        self._pending.append((data, flow_controlled_length))
+        self._arrived.set()
+
+    def trailers_received(self, headers: Headers) -> None:
+        if self.response is not None:
+            self.response.trailers = headers
+
+    def finish(self, error: Optional[str] = None) -> None:
+        """
+        End the response, with error if it is incomplete.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self._error = error
+        if not self.head.done():
+            self.head.set_result(proxy_http2.Response(
+                None, proxy_http2.Headers([]), None, None, [error] if error else [], self))
+        self._arrived.set()
+
+    def fail(self, exception: Exception) -> None:
+        if not self.head.done():
+            self.head.set_exception(exception)
+        self.finish(str(exception))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        # The chunk taken before has been relayed.
+        self._acknowledge_taken()
+        while not self._pending:
+            if self.finished:
+                if self._error:
+                    raise ConnectionError(
+                        f"The origin did not complete the response: {self._error}")
+                raise StopAsyncIteration
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), self._timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("Timed out waiting for the response body.")
+        pieces = []
+        size = 0
+        while self._pending and size < self.MAX_CHUNK_SIZE:
+            data, flow_controlled_length = self._pending.popleft()
+            pieces.append(data)
+            size += len(data)
+            self._taken += flow_controlled_length
+        return b''.join(pieces)
+
+    async def aclose(self) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Stop reading the response, abandoning the stream unless the response
+        is complete.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._acknowledge_taken()
+        if not self.finished:
+            self._cancel()
+        while self._pending:
+            self._acknowledge(self._pending.popleft()[1])
+
+    def _acknowledge_taken(self) -> None:
+        if self._taken:
+            self._acknowledge(self._taken)
+            self._taken = 0
+
+
+async def connect_to_http3_server(host: str, port: int, server_name: Optional[str]):
+    """
+    Open an HTTP/3 connection to the server.
+
+    The session is resumed with a ticket from an earlier connection to
+    server_name if there is one, so that requests are sent as 0-RTT data
+    rather than after the handshake.
+
+    Returns:
+        The Http3OriginConnection.
+    """
+    configuration = QuicConfiguration(
+        alpn_protocols=H3_ALPN,
+        is_client=True,
+        server_name=server_name,
+        verify_mode=ssl.CERT_NONE,
+    )
+    configuration.session_ticket = origin_session_tickets.find(server_name)
+    exit_stack = AsyncExitStack()
+    connection = await exit_stack.enter_async_context(connect(
+        host,
+        port,
+        configuration=configuration,
+        create_protocol=Http3OriginConnection,
+        session_ticket_handler=origin_session_tickets.add,
+        # Requests are sent as 0-RTT data while the handshake completes.
+        wait_connected=configuration.session_ticket is None,
+    ))
+    connection.exit_stack = exit_stack
+    return connection
+
+
+async def connect_to_http2_server(port: int, server_name: Optional[str]):
+    """
+    Open an HTTP/2 connection to the server, or return None if the server
+    does not speak HTTP/2.
+
+    Returns:
+        The Http2OriginConnection.
+    """
+    connection = await asyncio.get_running_loop().run_in_executor(
+        None, proxy_http2.connect_to_http2_server,
+        port, HttpQuicServerHandler.cert_file, server_name)
+    return Http2OriginConnection(connection) if connection is not None else None
+
+
+# Session tickets received from the origins, used to resume their sessions.
+origin_session_tickets = SessionTicketStore()
+http3_origin_connections = SharedOriginConnections(connect_to_http3_server)
+http2_origin_connections = SharedOriginConnections(connect_to_http2_server)
 
 
 def configure_http3_server(
@@ -356,19 +1239,35 @@ def configure_http3_server(
         https_pem,
         ca_pem,
         listening_sentinel,
-        h3_to_server=False):
+        h3_to_server=False,
+        h2_to_server=False,
+        qlog_sample_rate=1,
+        session_ticket_directory=None,
+        sock=None,
+        worker_id=None):
+    """
+    Run the HTTP/3 proxy until interrupted.
+
+    A worker process, one of several sharing the listen port, passes the UDP
+    socket it was given by quic_steering.create_steered_sockets and its
+    worker id, which the connection IDs it chooses carry so that the
+    connections' packets are steered to it.
+    """
 
     HttpQuicServerHandler.cert_file = https_pem
     HttpQuicServerHandler.ca_file = ca_pem
     HttpQuicServerHandler.h3_to_server = h3_to_server
+    HttpQuicServerHandler.h2_to_server = h2_to_server
     HttpQuicServerHandler.server_port = server_port
 
     try:
         os.mkdir('quic_log_directory')
     except FileExistsError:
         pass
-    quic_logger = QuicDirectoryLogger('quic_log_directory')
-    secrets_log_file = open('tls_secrets.log', "a", encoding='utf-8')
+    # The qlog traces and TLS secrets are written off the event loop.
+    log_writer = BackgroundFileWriter()
+    quic_logger = QuicDirectoryLogger('quic_log_directory', log_writer, qlog_sample_rate)
+    secrets_log_file = log_writer.stream('tls_secrets.log')
     configuration = QuicConfiguration(
         alpn_protocols=H3_ALPN,
         is_client=False,
@@ -378,34 +1277,50 @@ def configure_http3_server(
     )
 
     configuration.load_cert_chain(https_pem, ca_pem)
-    ticket_store = SessionTicketStore()
+    # With a directory, the proxy processes sharing it resume each other's
+    # sessions.
+    ticket_store = SessionTicketStore(directory=session_ticket_directory)
+
+    if worker_id is None:
+        create_protocol = HttpQuicServerHandler
+    else:
+        def create_protocol(connection, **kwargs):
+            assign_worker_connection_ids(connection, worker_id)
+            return HttpQuicServerHandler(connection, **kwargs)
+    server_args = dict(
+        configuration=configuration,
+        create_protocol=create_protocol,
+        session_ticket_fetcher=ticket_store.pop,
+        session_ticket_handler=ticket_store.add
+    )
 
     # TODO
     # In 3.7: how about asyncio.run(serve(...))
     loop = asyncio.get_event_loop()
-    server_side_proto = "HTTP/3" if h3_to_server else "HTTP/1"
+    server_side_proto = "HTTP/3" if h3_to_server else "HTTP/2" if h2_to_server else "HTTP/1"
+    worker = "" if worker_id is None else f" (worker {worker_id})"
     print(
-        f"Serving HTTP/3 Proxy on 127.0.0.1:{listen_port} with pem '{https_pem}', "
+        f"Serving HTTP/3 Proxy on 127.0.0.1:{listen_port}{worker} with pem '{https_pem}', "
         f"forwarding to 127.0.0.1:{server_port} over {server_side_proto}")
-    loop.run_until_complete(
-        serve(
-            '0.0.0.0',
-            listen_port,
-            configuration=configuration,
-            create_protocol=HttpQuicServerHandler,
-            session_ticket_fetcher=ticket_store.pop,
-            session_ticket_handler=ticket_store.add
-        )
-    )
+    if sock is None:
+        loop.run_until_complete(serve('0.0.0.0', listen_port, **server_args))
+    else:
+        loop.run_until_complete(
+            loop.create_datagram_endpoint(lambda: QuicServer(**server_args), sock=sock))
 
-    # Indicate to the caller that the quic socket is configured and listening.
-    Path(listening_sentinel).touch()
+    if listening_sentinel:
+        # Indicate to the caller that the quic socket is configured and listening.
+        Path(listening_sentinel).touch()
 
     try:
         loop.run_forever()
     except KeyboardInterrupt as e:
         # The calling test_proxy.py will handle this.
         print("Handling KeyboardInterrupt")
+        print(f"Session tickets: {ticket_store.summary()}")
         raise e
     except SystemExit:
         pass
+    finally:
+        # Write out the tickets for the processes sharing the directory.
+        ticket_store.close()
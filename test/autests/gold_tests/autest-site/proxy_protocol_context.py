@@ -8,16 +8,75 @@ Implement the PROXY protocol utility class and the socket wrapper class.
 #
 
 
+import os
 import socket
 import struct
-import time
 from enum import Enum
-import threading
 
 PP_V2_PREFIX = b'\x0d\x0a\x0d\x0a\x00\x0d\x0a\x51\x55\x49\x54\x0a'
-# The maximum size of the proxy protocol header is 108 bytes(assuming TLV and
-# linux socket address are not used)
+# The number of bytes peeked at the start of a client connection: enough for
+# any v1 header and for v2 headers of IP addresses without TLVs. A longer v2
+# header is read by the length it announces.
 PP_MAX_DATA_SIZE = 108
+# The number of seconds a new client connection has to send its PROXY header,
+# if any, and to complete the TLS handshake.
+PP_ACCEPT_TIMEOUT = 5
+
+# The PROXY protocol v2 commands.
+PP2_CMD_LOCAL = 0x0
+PP2_CMD_PROXY = 0x1
+
+# The PROXY protocol v2 TLV types.
+PP2_TYPE_ALPN = 0x01
+PP2_TYPE_AUTHORITY = 0x02
+PP2_TYPE_CRC32C = 0x03
+PP2_TYPE_NOOP = 0x04
+PP2_TYPE_UNIQUE_ID = 0x05
+PP2_TYPE_SSL = 0x20
+PP2_SUBTYPE_SSL_VERSION = 0x21
+PP2_SUBTYPE_SSL_CN = 0x22
+PP2_SUBTYPE_SSL_CIPHER = 0x23
+PP2_SUBTYPE_SSL_SIG_ALG = 0x24
+PP2_SUBTYPE_SSL_KEY_ALG = 0x25
+PP2_TYPE_NETNS = 0x30
+
+# The bits of the client field of a PP2_TYPE_SSL TLV.
+PP2_CLIENT_SSL = 0x01
+PP2_CLIENT_CERT_CONN = 0x02
+PP2_CLIENT_CERT_SESS = 0x04
+
+# The fixed part of a v2 header: the signature, the version and command, the
+# address family and transport protocol, and the length of the rest.
+_PP_V2_HEADER = struct.Struct('!12sBBH')
+# The address blocks: source and destination addresses, then ports.
+_PP_V2_IPV4_ADDRESSES = struct.Struct('!4s4sHH')
+_PP_V2_IPV6_ADDRESSES = struct.Struct('!16s16sHH')
+_PP_V2_UNIX_ADDRESSES = struct.Struct('!108s108s')
+_PP_V2_TLV = struct.Struct('!BH')
+# The client and verify fields leading the value of a PP2_TYPE_SSL TLV.
+_PP_V2_SSL = struct.Struct('!BI')
+
+# The valid address family and transport protocol bytes.
+_PP_V2_FAMILY_PROTOCOLS = {
+    0x00: 'UNSPEC',
+    0x11: 'TCP4',
+    0x12: 'UDP4',
+    0x21: 'TCP6',
+    0x22: 'UDP6',
+    0x31: 'UNIX_STREAM',
+    0x32: 'UNIX_DGRAM',
+}
+# address family nibble -> (socket family, address block)
+_PP_V2_FAMILIES = {
+    0x0: (socket.AF_UNSPEC, None),
+    0x1: (socket.AF_INET, _PP_V2_IPV4_ADDRESSES),
+    0x2: (socket.AF_INET6, _PP_V2_IPV6_ADDRESSES),
+    0x3: (socket.AF_UNIX, _PP_V2_UNIX_ADDRESSES),
+}
+_PP_V2_FAMILY_NIBBLES = {family: nibble for nibble, (family, _) in _PP_V2_FAMILIES.items()}
+# transport protocol nibble -> socket type
+_PP_V2_TRANSPORTS = {0x1: socket.SOCK_STREAM, 0x2: socket.SOCK_DGRAM}
+_PP_V2_TRANSPORT_NIBBLES = {transport: nibble for nibble, transport in _PP_V2_TRANSPORTS.items()}
 
 
 class ProxyProtocolVersion(Enum):
@@ -26,20 +85,299 @@ class ProxyProtocolVersion(Enum):
     V2 = 2
 
 
+class ProxyProtocolContext:
+    """The PROXY protocol state of a client connection: the PROXY header the
+    client sent, if any, which the connections to the server made on the
+    client's behalf send in turn.
+
+    PP_socket.complete_accept creates a context for each client connection,
+    which is then carried alongside the connection's socket, so that
+    concurrent connections each pass on their own client's header.
+    """
+
+    def __init__(self, pp_version=ProxyProtocolVersion.NONE, src_addr=None,
+                 dst_addr=None, addr_family=None, tlvs=()):
+        """
+        @param pp_version: The version of the PROXY protocol header to be sent.
+        @param src_addr: The source address in the PROXY protocol header to be
+        sent.
+        @param dst_addr: The destination address in the PROXY protocol header to
+        be sent.
+        @param addr_family: The address family in the PROXY protocol header to
+        be sent. AF_UNSPEC sends a v2 LOCAL header, without addresses.
+        @param tlvs: The (type, value) pairs of the TLVs in the v2 PROXY
+        protocol header to be sent.
+        """
+        self.pp_version = pp_version
+        self.src_addr = src_addr
+        self.dst_addr = dst_addr
+        self.addr_family = addr_family
+        self.tlvs = tuple(tlvs)
+
+    @property
+    def key(self):
+        """A hashable description of the PROXY protocol header that
+        create_connection would send on a new connection, or None if no PROXY
+        protocol header would be sent.
+        """
+        if self.pp_version == ProxyProtocolVersion.NONE:
+            return None
+        return (self.pp_version, self.src_addr, self.dst_addr, self.addr_family, self.tlvs)
+
+    def send_header(self, sock):
+        """ Send the PROXY protocol header, if any, on a new connection to the
+        server.
+        :param sock: the socket of the connection
+        """
+        if self.pp_version != ProxyProtocolVersion.NONE:
+            ProxyProtocolUtil.send_proxy_header(
+                sock, self.pp_version, self.src_addr, self.dst_addr, self.addr_family,
+                self.tlvs)
+
+    def create_connection(self, address, timeout=5, source_address=None):
+        """ This is a wraper of the socket.create_connection method, which in
+        addition sends the PROXY protocol header as the connection is
+        established.
+        :param address: the address to connect to
+        :param timeout: the timeout for the connection
+        :param source_address: the source address to bind to
+        :returns: the socket of the established connection
+        """
+        sock = socket.create_connection(
+            address, timeout, source_address)
+        self.send_header(sock)
+        return sock
+
+
+class ProxyHeaderV2:
+    """A PROXY protocol v2 header, decoded from or encoded to its binary form.
+
+    The header's fixed part, address blocks and TLVs are each read and written
+    with a precompiled struct.Struct, at offsets into a memoryview of the
+    received bytes, so that decoding does not copy them.
+
+    The addresses are (host, port) tuples for IPv4 and IPv6 and paths for UNIX
+    sockets. There are none for the UNSPEC family. The TLVs are a list of
+    (type, value) pairs, in the order they appear.
+
+    >>> header = ProxyHeaderV2(
+    ...     socket.AF_INET6, ('2001:db8::1', 51000), ('::1', 443),
+    ...     tlvs=[(PP2_TYPE_ALPN, b'h2'), (PP2_TYPE_AUTHORITY, b'example.com'),
+    ...           ProxyHeaderV2.ssl_tlv(
+    ...               PP2_CLIENT_SSL, 0, [(PP2_SUBTYPE_SSL_VERSION, b'TLSv1.3')])])
+    >>> data = header.build()
+    >>> parsed, length = ProxyHeaderV2.parse(data + b'GET / HTTP/1.1\\r\\n')
+    >>> length == len(data), parsed.describe()
+    (True, 'PROXY TCP6 2001:db8::1 ::1 51000 443')
+    >>> parsed.alpn, parsed.authority, parsed.ssl
+    (b'h2', b'example.com', (1, 0, [(33, b'TLSv1.3')]))
+
+    The header of IPv4 addresses is byte for byte the one the verifier builds.
+
+    >>> ProxyHeaderV2(socket.AF_INET, ('127.0.0.1', 1234), ('127.0.0.1', 80)).build().hex()
+    '0d0a0d0a000d0a515549540a2111000c7f0000017f00000104d20050'
+    >>> ProxyHeaderV2.parse(ProxyHeaderV2(
+    ...     socket.AF_UNIX, '/tmp/client.sock', '/tmp/server.sock').build())[0].describe()
+    'PROXY UNIX_STREAM /tmp/client.sock /tmp/server.sock'
+    >>> ProxyHeaderV2.parse(PP_V2_PREFIX + b'\\x21\\x11\\x00\\x0c' + bytes(4))
+    Traceback (most recent call last):
+    ...
+    ValueError: Incomplete PROXY protocol v2 header: 20 of 28 bytes
+    """
+
+    __slots__ = ('family', 'src_addr', 'dst_addr', 'transport', 'command', 'tlvs')
+
+    def __init__(self, family, src_addr=None, dst_addr=None,
+                 transport=socket.SOCK_STREAM, command=PP2_CMD_PROXY, tlvs=()):
+        """
+        @param family: The address family: AF_INET, AF_INET6, AF_UNIX or
+        AF_UNSPEC.
+        @param src_addr: The source address, None for AF_UNSPEC.
+        @param dst_addr: The destination address, None for AF_UNSPEC.
+        @param transport: The transport protocol, SOCK_STREAM or SOCK_DGRAM.
+        It is ignored for AF_UNSPEC.
+        @param command: PP2_CMD_PROXY or PP2_CMD_LOCAL.
+        @param tlvs: The (type, value) pairs of the TLVs.
+        """
+        self.family = family
+        self.src_addr = src_addr
+        self.dst_addr = dst_addr
+        self.transport = transport
+        self.command = command
+        self.tlvs = list(tlvs)
+
+    @classmethod
+    def parse(cls, data):
+        """ Decode the v2 header at the start of data.
+        :param data: a bytes-like object starting with the header. There may
+        be more bytes than the header.
+        :returns: the ProxyHeaderV2 and the number of bytes it occupies
+        :raises ValueError: data does not start with a whole and valid header
+        """
+        view = memoryview(data)
+        if len(view) < _PP_V2_HEADER.size:
+            raise ValueError("Incomplete PROXY protocol v2 header: "
+                             f"{len(view)} of at least {_PP_V2_HEADER.size} bytes")
+        signature, version_command, family_protocol, length = _PP_V2_HEADER.unpack_from(view)
+        if signature != PP_V2_PREFIX:
+            raise ValueError("Not a PROXY protocol v2 header")
+
+        # Of version_command, the higher 4 bits is the version and the lower 4
+        # is the command.
+        version = version_command >> 4
+        command = version_command & 0x0F
+        if version != 2:
+            raise ValueError(
+                f'Invalid version: {version} (by spec, should always be 0x02)')
+        if command not in (PP2_CMD_LOCAL, PP2_CMD_PROXY):
+            raise ValueError(
+                f'Invalid command: {command} (by spec, should be 0x00 or 0x01)')
+        if family_protocol not in _PP_V2_FAMILY_PROTOCOLS:
+            raise ValueError(
+                f'Invalid address family: {family_protocol} (by spec, should be '
+                '0x00, 0x11, 0x12, 0x21, 0x22, 0x31, or 0x32)')
+        end = _PP_V2_HEADER.size + length
+        if len(view) < end:
+            raise ValueError(
+                f"Incomplete PROXY protocol v2 header: {len(view)} of {end} bytes")
+
+        # Of family_protocol, the higher 4 bits is the address family and the
+        # lower 4 is the transport protocol.
+        family, addresses = _PP_V2_FAMILIES[family_protocol >> 4]
+        transport = _PP_V2_TRANSPORTS.get(family_protocol & 0x0F)
+        offset = _PP_V2_HEADER.size
+        src_addr = dst_addr = None
+        if addresses is not None:
+            if length < addresses.size:
+                raise ValueError(
+                    f"Unexpected address length for {_PP_V2_FAMILY_PROTOCOLS[family_protocol]}: "
+                    f"{length} (by spec, should be at least {addresses.size})")
+            if family == socket.AF_UNIX:
+                src_path, dst_path = addresses.unpack_from(view, offset)
+                src_addr = os.fsdecode(src_path.split(b'\0', 1)[0])
+                dst_addr = os.fsdecode(dst_path.split(b'\0', 1)[0])
+            else:
+                src_ip, dst_ip, src_port, dst_port = addresses.unpack_from(view, offset)
+                src_addr = (socket.inet_ntop(family, src_ip), src_port)
+                dst_addr = (socket.inet_ntop(family, dst_ip), dst_port)
+            offset += addresses.size
+        tlvs = ProxyHeaderV2._parse_tlvs(view, offset, end) if offset < end else []
+        return cls(family, src_addr, dst_addr, transport, command, tlvs), end
+
+    def build(self):
+        """ Encode the header.
+        :returns: the bytes of the header
+        :raises ValueError: the header cannot be encoded
+        """
+        family_nibble = _PP_V2_FAMILY_NIBBLES.get(self.family)
+        if family_nibble is None:
+            raise ValueError(f"Unsupported PROXY protocol v2 address family: {self.family}")
+        addresses = _PP_V2_FAMILIES[family_nibble][1]
+        if addresses is None:
+            family_protocol = 0x00
+            address_block = b''
+        else:
+            family_protocol = family_nibble << 4 | _PP_V2_TRANSPORT_NIBBLES[self.transport]
+            if addresses is _PP_V2_UNIX_ADDRESSES:
+                src_path = os.fsencode(self.src_addr)
+                dst_path = os.fsencode(self.dst_addr)
+                if max(len(src_path), len(dst_path)) >= addresses.size // 2:
+                    raise ValueError("UNIX socket path too long for a PROXY protocol v2 header")
+                address_block = addresses.pack(src_path, dst_path)
+            else:
+                address_block = addresses.pack(
+                    socket.inet_pton(self.family, self.src_addr[0]),
+                    socket.inet_pton(self.family, self.dst_addr[0]),
+                    self.src_addr[1], self.dst_addr[1])
+        tlv_block = ProxyHeaderV2._build_tlvs(self.tlvs) if self.tlvs else b''
+        length = len(address_block) + len(tlv_block)
+        if length > 0xFFFF:
+            raise ValueError(f"PROXY protocol v2 header too long: {length} bytes")
+        return b''.join((
+            _PP_V2_HEADER.pack(PP_V2_PREFIX, 0x20 | self.command, family_protocol, length),
+            address_block, tlv_block))
+
+    def describe(self):
+        """ Describe the header as the PROXY protocol v1 header would.
+        :returns: the description of the command, protocol and addresses
+        """
+        command = 'LOCAL' if self.command == PP2_CMD_LOCAL else 'PROXY'
+        if self.family == socket.AF_UNSPEC:
+            return f'{command} UNSPEC'
+        family_protocol = (_PP_V2_FAMILY_NIBBLES[self.family] << 4 |
+                           _PP_V2_TRANSPORT_NIBBLES.get(self.transport, 0))
+        protocol = _PP_V2_FAMILY_PROTOCOLS.get(family_protocol, 'UNSPEC')
+        if self.family == socket.AF_UNIX:
+            return f'{command} {protocol} {self.src_addr} {self.dst_addr}'
+        return (f'{command} {protocol} {self.src_addr[0]} {self.dst_addr[0]} '
+                f'{self.src_addr[1]} {self.dst_addr[1]}')
+
+    def tlv(self, tlv_type):
+        """ Return the value of the first TLV of the given type, or None.
+        """
+        for t, value in self.tlvs:
+            if t == tlv_type:
+                return value
+        return None
+
+    @property
+    def alpn(self):
+        return self.tlv(PP2_TYPE_ALPN)
+
+    @property
+    def authority(self):
+        return self.tlv(PP2_TYPE_AUTHORITY)
+
+    @property
+    def ssl(self):
+        """The (client, verify, sub-TLVs) of the PP2_TYPE_SSL TLV, or None.
+        """
+        value = self.tlv(PP2_TYPE_SSL)
+        if value is None:
+            return None
+        view = memoryview(value)
+        if len(view) < _PP_V2_SSL.size:
+            raise ValueError("Truncated PROXY protocol v2 SSL TLV")
+        client, verify = _PP_V2_SSL.unpack_from(view)
+        return client, verify, ProxyHeaderV2._parse_tlvs(view, _PP_V2_SSL.size, len(view))
+
+    @staticmethod
+    def ssl_tlv(client, verify, sub_tlvs=()):
+        """ Encode a PP2_TYPE_SSL TLV.
+        :param client: the PP2_CLIENT_* bits
+        :param verify: 0 if the client's certificate was verified
+        :param sub_tlvs: the (PP2_SUBTYPE_SSL_*, value) pairs
+        :returns: the (type, value) pair of the TLV
+        """
+        return PP2_TYPE_SSL, _PP_V2_SSL.pack(client, verify) + ProxyHeaderV2._build_tlvs(sub_tlvs)
+
+    @staticmethod
+    def _parse_tlvs(view, offset, end):
+        tlvs = []
+        while offset < end:
+            if end - offset < _PP_V2_TLV.size:
+                raise ValueError("Truncated PROXY protocol v2 TLV")
+            tlv_type, tlv_length = _PP_V2_TLV.unpack_from(view, offset)
+            offset += _PP_V2_TLV.size
+            if end - offset < tlv_length:
+                raise ValueError(
+                    f"Truncated PROXY protocol v2 TLV of type {tlv_type:#04x}: "
+                    f"{end - offset} of {tlv_length} bytes")
+            tlvs.append((tlv_type, bytes(view[offset:offset + tlv_length])))
+            offset += tlv_length
+        return tlvs
+
+    @staticmethod
+    def _build_tlvs(tlvs):
+        return b''.join(_PP_V2_TLV.pack(tlv_type, len(value)) + value
+                        for tlv_type, value in tlvs)
+
+
 class ProxyProtocolUtil:
     """Utility class for parsing and encoding the PROXY protocol header. The
     parsing code is largely adopted from Brian Neradt's proxy_protocol_server in
     the ATS repo.
     """
-    # The following needs to be thread-local as connections can be concurrent.
-    # They are set to match the PROXY protocol header received from client.
-
-    # The version of the PROXY protocol header to be sent.
-    pp_version = threading.local()
-    # The source and destination in the PROXY protocol header to be sent.
-    src_addr = threading.local()
-    dst_addr = threading.local()
-    addr_family = threading.local()
 
     @staticmethod
     def wrap_socket(sock, use_ssl=False, ssl_ctx=None):
@@ -47,11 +385,12 @@ class ProxyProtocolUtil:
 
     # utility methods for parsing or encoding the PROXY protocol header
     @staticmethod
-    def parse_pp_v1(pp_bytes: bytes) -> int:
+    def parse_pp_v1(pp_bytes: bytes):
         """Parse and print the Proxy Protocol v1 string.
         :param pp_bytes: The bytes containing the Proxy Protocol string. There may
         be more bytes than the Proxy Protocol string.
-        :returns: The number of bytes occupied by the proxy v1 protocol.
+        :returns: The number of bytes occupied by the proxy v1 protocol, and the
+        ProxyProtocolContext for the header to be sent to the server.
         """
         # Proxy Protocol v1 string ends with CRLF.
         end = pp_bytes.find(b'\r\n')
@@ -65,112 +404,35 @@ class ProxyProtocolUtil:
         src_addr = (pp_parts[2], int(pp_parts[4]))
         dst_addr = (pp_parts[3], int(pp_parts[5]))
         addr_family = socket.AF_INET if pp_parts[1] == 'TCP4' else socket.AF_INET6
-        # set the thread local storage for the PROXY protocol header to be sent
-        # to server
-        ProxyProtocolUtil.set_tls(
-            ProxyProtocolVersion.V1, src_addr, dst_addr, addr_family)
         # print the proxy protocol v1 string
         print(pp_str)
-        return end + 2
+        return end + 2, ProxyProtocolContext(
+            ProxyProtocolVersion.V1, src_addr, dst_addr, addr_family)
 
     @staticmethod
-    def parse_pp_v2(pp_bytes: bytes) -> int:
+    def parse_pp_v2(pp_bytes: bytes):
         """Parse and print the Proxy Protocol v2 string.
         :param pp_bytes: The bytes containing the Proxy Protocol string. There may
         be more bytes than the Proxy Protocol string.
-        :returns: The number of bytes occupied by the proxy v2 protocol string.
+        :returns: The number of bytes occupied by the proxy v2 protocol string,
+        and the ProxyProtocolContext for the header to be sent to the server.
         """
 
-        # Skip the 12 byte header.
-        pp_bytes = pp_bytes[12:]
-        version_command = pp_bytes[0]
-        pp_bytes = pp_bytes[1:]
-        family_protocol = pp_bytes[0]
-        pp_bytes = pp_bytes[1:]
-        tuple_length = int.from_bytes(pp_bytes[:2], byteorder='big')
-        pp_bytes = pp_bytes[2:]
-
-        # Of version_command, the higher 4 bits is the version and the lower 4
-        # is the command.
-        version = version_command >> 4
-        command = version_command & 0x0F
-
-        if version != 2:
-            raise ValueError(
-                f'Invalid version: {version} (by spec, should always be 0x02)')
-
-        if command == 0x0:
-            command_description = 'LOCAL'
-        elif command == 0x1:
-            command_description = 'PROXY'
-        else:
-            raise ValueError(
-                f'Invalid command: {command} (by spec, should be 0x00 or 0x01)')
+        header, length = ProxyHeaderV2.parse(pp_bytes)
 
-        # Of address_family, the higher 4 bits is the address family and the
-        # lower 4 is the transport protocol.
-        if family_protocol == 0x0:
-            transport_protocol_description = 'UNSPEC'
-        elif family_protocol == 0x11:
-            transport_protocol_description = 'TCP4'
-        elif family_protocol == 0x12:
-            transport_protocol_description = 'UDP4'
-        elif family_protocol == 0x21:
-            transport_protocol_description = 'TCP6'
-        elif family_protocol == 0x22:
-            transport_protocol_description = 'UDP6'
-        elif family_protocol == 0x31:
-            transport_protocol_description = 'UNIX_STREAM'
-        elif family_protocol == 0x32:
-            transport_protocol_description = 'UNIX_DGRAM'
-        else:
-            raise ValueError(
-                f'Invalid address family: {family_protocol} (by spec, should be '
-                '0x00, 0x11, 0x12, 0x21, 0x22, 0x31, or 0x32)')
-
-        if family_protocol in (0x11, 0x12):
-            if tuple_length != 12:
-                raise ValueError(
-                    "Unexpected tuple length for TCP4/UDP4: "
-                    f"{tuple_length} (by) spec, should be 12)"
-                )
-            src_addr = socket.inet_ntop(socket.AF_INET, pp_bytes[:4])
-            pp_bytes = pp_bytes[4:]
-            dst_addr = socket.inet_ntop(socket.AF_INET, pp_bytes[:4])
-            pp_bytes = pp_bytes[4:]
-            src_port = int.from_bytes(pp_bytes[:2], byteorder='big')
-            pp_bytes = pp_bytes[2:]
-            dst_port = int.from_bytes(pp_bytes[:2], byteorder='big')
-            pp_bytes = pp_bytes[2:]
-
-        # set the thread local storage for the PROXY protocol header to be sent
-        # to server
-        ProxyProtocolUtil.set_tls(
-            ProxyProtocolVersion.V2, (src_addr, src_port), (dst_addr, dst_port), socket.AF_INET)
         # print the PROXY protocol header
-        tuple_description = f'{src_addr} {dst_addr} {src_port} {dst_port}'
-        print(
-            f'{command_description} {transport_protocol_description} '
-            f'{tuple_description}')
-
-        return 16 + tuple_length
-
-    @staticmethod
-    def set_tls(pp_version, src_addr, dst_addr, addr_family):
-        """Set the thread local storage for the PROXY protocol header to be
-        sent.
-        @param pp_version: The version of the PROXY protocol header to be sent.
-        @param src_addr: The source address in the PROXY protocol header to be
-        sent.
-        @param dst_addr: The destination address in the PROXY protocol header to
-        be sent.
-        @param addr_family: The address family in the PROXY protocol header to
-        be sent.
-        """
-        ProxyProtocolUtil.pp_version = pp_version
-        ProxyProtocolUtil.src_addr = src_addr
-        ProxyProtocolUtil.dst_addr = dst_addr
-        ProxyProtocolUtil.addr_family = addr_family
+        print(header.describe())
+        if header.tlvs:
+            print('PROXY TLVs: ' + ' '.join(
+                f'{tlv_type:#04x}={value!r}' for tlv_type, value in header.tlvs))
+
+        if header.command == PP2_CMD_LOCAL:
+            # The connection is the proxy's own: the addresses are not passed on.
+            return length, ProxyProtocolContext(
+                ProxyProtocolVersion.V2, addr_family=socket.AF_UNSPEC, tlvs=header.tlvs)
+        return length, ProxyProtocolContext(
+            ProxyProtocolVersion.V2, header.src_addr, header.dst_addr, header.family,
+            header.tlvs)
 
     @staticmethod
     def construct_proxy_header_v1(src_addr, dst_addr, family):
@@ -186,98 +448,98 @@ class ProxyProtocolUtil:
         )
 
     @staticmethod
-    def construct_proxy_header_v2(src_addr, dst_addr, family):
+    def construct_proxy_header_v2(src_addr, dst_addr, family, tlvs=()):
         """ Construct a Proxy Protocol v2 string.
         :param src_addr: the source socket address
         :param dst_addr: the destination socket address
-        :param family: the socket family
+        :param family: the socket family, AF_UNSPEC for a LOCAL header
+        :param tlvs: the (type, value) pairs of the TLVs
         :returns: The bytes containing the Proxy Protocol v2 string.
         """
-        # Construct the PROXY protocol v2 header
-        header = PP_V2_PREFIX
-        # Protocol version 2 + PROXY command
-        header += b'\x21'
-        # TCP over IPv4 or IPv6
-        header += b'\x11' if family == socket.AF_INET else b'\x21'
-        # address length
-        header += b'\x00\x0C'
-        header += socket.inet_pton(socket.AF_INET, src_addr[0])
-        header += socket.inet_pton(socket.AF_INET, dst_addr[0])
-        header += struct.pack('!H', src_addr[1])
-        header += struct.pack('!H', dst_addr[1])
-        return header
+        command = PP2_CMD_LOCAL if family == socket.AF_UNSPEC else PP2_CMD_PROXY
+        return ProxyHeaderV2(family, src_addr, dst_addr, command=command, tlvs=tlvs).build()
 
     @staticmethod
-    def send_proxy_header(sock, proxy_protocol_version, src_addr, dst_addr, addr_family, ):
-        """ Send the PROXY header to the stream
+    def send_proxy_header(sock, proxy_protocol_version, src_addr, dst_addr, addr_family,
+                          tlvs=()):
+        """ Send the PROXY header to the stream, ahead of whatever is sent
+        next. The receiver reads the header off the start of the stream by its
+        length, so the first payload can follow right away. Where the platform
+        allows, the header is written with MSG_MORE: the kernel holds it back
+        until the first payload, the request or the TLS ClientHello, is written
+        and sends them together.
         :param sock: the socket of the stream
         :param src_addr: the source socket address in the PROXY header
         :param dst_addr: the destination address in the PROXY header
         :param addr_family: the address family in the PROXY header
         :param proxy_protocol_version: the version of the PROXY protocol to send
+        :param tlvs: the TLVs of a v2 PROXY header
         """
         print(f'Sending PROXY protocol version {proxy_protocol_version.value}')
-        proxy_header_construcut_func = ProxyProtocolUtil.construct_proxy_header_v1 if proxy_protocol_version == ProxyProtocolVersion.V1 else ProxyProtocolUtil.construct_proxy_header_v2
-        proxy_header_data = proxy_header_construcut_func(
-            src_addr, dst_addr, addr_family)
-        sock.sendall(proxy_header_data)
-        time.sleep(1)
+        if proxy_protocol_version == ProxyProtocolVersion.V1:
+            proxy_header_data = ProxyProtocolUtil.construct_proxy_header_v1(
+                src_addr, dst_addr, addr_family)
+        else:
+            proxy_header_data = ProxyProtocolUtil.construct_proxy_header_v2(
+                src_addr, dst_addr, addr_family, tlvs)
+        if hasattr(socket, 'MSG_MORE'):
+            sock.sendall(proxy_header_data, socket.MSG_MORE)
+        else:
+            sock.sendall(proxy_header_data)
 
     @staticmethod
     def read_pp_header_if_present(sock):
         """ Consume the PROXY header from the socket if present
         :param sock: the socket of the stream
+        :returns: the ProxyProtocolContext of the stream
         """
         # peek at the file content to check for proxy protocol header
         data = sock.recv(PP_MAX_DATA_SIZE, socket.MSG_PEEK)
-        pp_num_bytes = ProxyProtocolUtil.check_for_proxy_header(data)
+        if data.startswith(PP_V2_PREFIX) and len(data) >= _PP_V2_HEADER.size:
+            pp_length = _PP_V2_HEADER.size + _PP_V2_HEADER.unpack_from(data)[3]
+            if pp_length > len(data):
+                # A v2 header with a UNIX address or TLVs may not fit in what
+                # was peeked. Read the whole of it instead.
+                data = ProxyProtocolUtil._recv_exactly(sock, pp_length)
+                return ProxyProtocolUtil.check_for_proxy_header(data)[1]
+        pp_num_bytes, pp_context = ProxyProtocolUtil.check_for_proxy_header(data)
         if pp_num_bytes > 0:
             # read the pp header bytes from the file
             sock.recv(pp_num_bytes)
-        return
+        return pp_context
+
+    @staticmethod
+    def _recv_exactly(sock, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise ValueError(
+                    f"Connection closed after {len(data)} of {length} bytes of "
+                    "the PROXY protocol header")
+            data += chunk
+        return bytes(data)
 
     @staticmethod
     def check_for_proxy_header(data):
         """ Examine the data to see if it contains a proxy protocol header
         :param data: the data to examine
-        :returns: the number of bytes in the proxy protocol header if present, 0 otherwise
+        :returns: the number of bytes in the proxy protocol header if present, 0
+        otherwise, and the ProxyProtocolContext for the header to be sent to the
+        server
         """
         print("checking for PROXY protocol header")
         pp_length = 0
-        ProxyProtocolUtil.pp_version = ProxyProtocolVersion.NONE
+        pp_context = ProxyProtocolContext()
 
         if (data.startswith(b'PROXY') and b'\r\n' in data):
-            pp_length = ProxyProtocolUtil.parse_pp_v1(data)
-            ProxyProtocolUtil.pp_version = ProxyProtocolVersion.V1
+            pp_length, pp_context = ProxyProtocolUtil.parse_pp_v1(data)
         if data.startswith(PP_V2_PREFIX):
-            pp_length = ProxyProtocolUtil.parse_pp_v2(data)
-            ProxyProtocolUtil.pp_version = ProxyProtocolVersion.V2
+            pp_length, pp_context = ProxyProtocolUtil.parse_pp_v2(data)
         if pp_length > 0:
             print(
-                f"Received {pp_length} bytes of Proxy Protocol V{ProxyProtocolUtil.pp_version.value}")
-        return pp_length
-
-    @staticmethod
-    def create_connection_and_send_pp(address, timeout=5,
-                                      source_address=None):
-        """ This is a wraper of the socket.create_connection method, which in
-        addition sends a PROXY protocol header as the connection is established.
-        :param address: the address to connect to
-        :param timeout: the timeout for the connection
-        :param source_address: the source address to bind to
-        :returns: the socket of the established connection
-        """
-        sock = socket.create_connection(
-            address, timeout, source_address)
-        if ProxyProtocolUtil.pp_version != ProxyProtocolVersion.NONE:
-            # send the PROXY protocol header
-            ProxyProtocolUtil.send_proxy_header(
-                sock,
-                ProxyProtocolUtil.pp_version,
-                ProxyProtocolUtil.src_addr,
-                ProxyProtocolUtil.dst_addr,
-                ProxyProtocolUtil.addr_family)
-        return sock
+                f"Received {pp_length} bytes of Proxy Protocol V{pp_context.pp_version.value}")
+        return pp_length, pp_context
 
 
 class PP_socket(socket.socket):
@@ -297,16 +559,82 @@ class PP_socket(socket.socket):
         return self._socket.fileno()
 
     def accept(self):
-        """ stripes off any proxy protocol header before returning the accepted
-        client socket
+        """ Accept a client connection without reading from it. The caller
+        passes the client socket to complete_accept from the connection's own
+        thread, so that a slow or silent client does not hold up accepting the
+        other connections.
+        """
+        return self._socket.accept()
+
+    def complete_accept(self, client_sock, timeout=PP_ACCEPT_TIMEOUT):
+        """ Strip off any proxy protocol header from an accepted client
+        socket and, for TLS, complete the handshake.
+        :param client_sock: the socket returned by accept
+        :param timeout: the number of seconds the client has for each
+        :returns: the socket to serve the connection on and the connection's
+        ProxyProtocolContext
+        :raises OSError: the client was too slow or the TLS handshake failed
+        :raises ValueError: the proxy protocol header is invalid
         """
-        client_sock, client_addr = self._socket.accept()
-        ProxyProtocolUtil.read_pp_header_if_present(client_sock)
+        previous_timeout = client_sock.gettimeout()
+        client_sock.settimeout(timeout)
+        pp_context = ProxyProtocolUtil.read_pp_header_if_present(client_sock)
         if self._use_ssl:
             print("wrapping the socket with ssl")
             client_sock = self._ssl_ctx.wrap_socket(
                 client_sock, server_side=True)
-        # Returning the accepted client socket here, since we are done with
-        # proxy protocol processing and can yield control back to the raw socket
-        # beyond this point
-        return client_sock, client_addr
+        # We are done with proxy protocol processing and can yield control back
+        # to the raw socket beyond this point
+        client_sock.settimeout(previous_timeout)
+        return client_sock, pp_context
+
+
+def benchmark(iterations=100000):
+    """ Time building and parsing v2 headers, and print the cost per header
+    next to that of opening a loopback TCP connection, which each header
+    accompanies.
+    :param iterations: the number of times each header is built and parsed
+    """
+    import timeit
+    headers = {
+        'TCP4': ProxyHeaderV2(socket.AF_INET, ('192.0.2.1', 51000), ('198.51.100.1', 443)),
+        'TCP6 with TLVs': ProxyHeaderV2(
+            socket.AF_INET6, ('2001:db8::1', 51000), ('2001:db8::2', 443),
+            tlvs=[(PP2_TYPE_ALPN, b'h2'), (PP2_TYPE_AUTHORITY, b'example.com'),
+                  ProxyHeaderV2.ssl_tlv(PP2_CLIENT_SSL, 0, [
+                      (PP2_SUBTYPE_SSL_VERSION, b'TLSv1.3'),
+                      (PP2_SUBTYPE_SSL_CIPHER, b'TLS_AES_128_GCM_SHA256')])]),
+        'UNIX_STREAM': ProxyHeaderV2(socket.AF_UNIX, '/tmp/client.sock', '/tmp/server.sock'),
+    }
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    address = listener.getsockname()
+
+    def connect():
+        client = socket.create_connection(address)
+        server, _ = listener.accept()
+        server.close()
+        client.close()
+
+    connections = max(iterations // 100, 100)
+    connect_cost = timeit.timeit(connect, number=connections) / connections
+    listener.close()
+    print(f'loopback TCP connection: {connect_cost * 1e6:.1f} us')
+
+    for name, header in headers.items():
+        data = header.build()
+        build_cost = timeit.timeit(header.build, number=iterations) / iterations
+        parse_cost = timeit.timeit(
+            lambda: ProxyHeaderV2.parse(data), number=iterations) / iterations
+        print(f'{name} ({len(data)} bytes): build {build_cost * 1e6:.2f} us, '
+              f'parse {parse_cost * 1e6:.2f} us, '
+              f'{(build_cost + parse_cost) / connect_cost:.1%} of a connection')
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['--benchmark']:
+        benchmark()
+    else:
+        import doctest
+        doctest.testmod()
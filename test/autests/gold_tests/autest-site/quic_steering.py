@@ -0,0 +1,173 @@
+'''
+Implement the steering of QUIC packets to the proxy worker owning their
+connection.
+'''
+# @file
+#
+# Copyright 2023, Verizon Media
+# SPDX-License-Identifier: Apache-2.0
+#
+
+
+import ctypes
+import os
+import socket
+
+
+# The most workers whose ids fit in the first byte of a connection ID.
+MAX_WORKERS = 256
+
+# From linux/socket.h, which the socket module does not export.
+SO_ATTACH_REUSEPORT_CBPF = 51
+
+# Classic BPF opcodes, from linux/filter.h.
+_BPF_LDB_ABS = 0x30   # A = packet[k]
+_BPF_JSET_K = 0x45    # pc += jt if A & k else jf
+_BPF_JA = 0x05        # pc += k
+_BPF_MOD_K = 0x94     # A %= k
+_BPF_RET_A = 0x16     # return A
+
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_uint16), ('jt', ctypes.c_uint8),
+                ('jf', ctypes.c_uint8), ('k', ctypes.c_uint32)]
+
+
+class _SockFprog(ctypes.Structure):
+    _fields_ = [('len', ctypes.c_uint16), ('filter', ctypes.POINTER(_SockFilter))]
+
+
+def worker_connection_id(worker_id, length=8):
+    """
+    Return a new random connection ID naming the worker.
+
+    The worker id is the ID's first byte, where steering_program reads it.
+
+    >>> cid = worker_connection_id(3)
+    >>> len(cid), cid[0]
+    (8, 3)
+    """
+    return bytes([worker_id]) + os.urandom(length - 1)
+
+
+def packet_worker(packet, num_workers):
+    """
+    Return the worker a QUIC packet is steered to, as steering_program does.
+
+    The worker is read from the first byte of the packet's destination
+    connection ID, which follows the first byte of a short header packet and
+    the first byte, the version and the ID's length in a long header packet.
+
+    >>> cid = worker_connection_id(2)
+    >>> short_header = bytes([0x40]) + cid + b'payload'
+    >>> long_header = bytes([0xc0]) + b'\\x00\\x00\\x00\\x01' + bytes([len(cid)]) + cid
+    >>> packet_worker(short_header, 4), packet_worker(long_header, 4)
+    (2, 2)
+
+    The first packets of a connection carry an ID chosen by the client,
+    whose first byte is any worker's. That worker accepts the connection
+    and the IDs it chooses name it, so all of the connection's packets
+    reach it.
+    """
+    offset = 6 if packet[0] & 0x80 else 1
+    return packet[offset] % num_workers
+
+
+def steering_program(num_workers):
+    """
+    Return the classic BPF program steering packets among num_workers
+    sockets sharing a port, as (code, jt, jf, k) tuples.
+    """
+    return [
+        (_BPF_LDB_ABS, 0, 0, 0),
+        # Long header packets have the high bit of the first byte set.
+        (_BPF_JSET_K, 0, 2, 0x80),
+        (_BPF_LDB_ABS, 0, 0, 6),
+        (_BPF_JA, 0, 0, 1),
+        (_BPF_LDB_ABS, 0, 0, 1),
+        (_BPF_MOD_K, 0, 0, num_workers),
+        (_BPF_RET_A, 0, 0, 0),
+    ]
+
+
+def create_steered_sockets(host, port, num_workers):
+    """
+    Bind num_workers UDP sockets to the same port, the packets each receives
+    being those whose destination connection ID names its worker.
+
+    The sockets must be created before the workers are forked and kept open
+    by the supervising process: the kernel numbers the sockets sharing a
+    port in the order they were bound, and a worker that is restarted must
+    take over the same socket to keep its number.
+
+    >>> sockets = create_steered_sockets('127.0.0.1', 0, 2)
+    >>> address = sockets[0].getsockname()
+    >>> client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    >>> for worker_id in (1, 0, 1):
+    ...     _ = client.sendto(bytes([0x40]) + worker_connection_id(worker_id), address)
+    >>> [len(sockets[i].recv(100)) for i in (1, 0, 1)]
+    [9, 9, 9]
+    >>> for sock in sockets + [client]:
+    ...     sock.close()
+
+    Raises:
+        OSError: The sockets could not be bound, or the platform cannot
+        steer packets among them.
+    """
+    if not 1 <= num_workers <= MAX_WORKERS:
+        raise ValueError(f"Invalid number of QUIC workers: {num_workers}")
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sockets = []
+    try:
+        for _ in range(num_workers):
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((host, port))
+            # Any later sockets share the port actually bound.
+            port = sock.getsockname()[1]
+        _attach_steering_program(sockets[0], num_workers)
+    except BaseException:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets
+
+
+def _attach_steering_program(sock, num_workers):
+    program = steering_program(num_workers)
+    filters = (_SockFilter * len(program))(*[_SockFilter(*op) for op in program])
+    fprog = _SockFprog(len(program), filters)
+    # The kernel copies the program during the call, while filters is alive.
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF,
+                    ctypes.string_at(ctypes.addressof(fprog), ctypes.sizeof(fprog)))
+
+
+def assign_worker_connection_ids(connection, worker_id):
+    """
+    Make an aioquic QuicConnection only choose connection IDs naming the
+    worker.
+
+    This must be called before the connection handles its first packet,
+    while none of its IDs has been sent.
+    """
+    length = len(connection.host_cid)
+    first = connection._host_cids[0]
+    first.cid = worker_connection_id(worker_id, length)
+    connection.host_cid = first.cid
+    connection._local_initial_source_connection_id = first.cid
+
+    # The connection issues further IDs as the client retires the old ones.
+    replenish = connection._replenish_connection_ids
+
+    def replenish_worker_connection_ids():
+        replenish()
+        for connection_id in connection._host_cids:
+            if connection_id.cid[0] != worker_id:
+                connection_id.cid = worker_connection_id(worker_id, length)
+    connection._replenish_connection_ids = replenish_worker_connection_ids
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,452 @@
+'''
+Implement a bounded store of TLS session tickets for the QUIC proxy.
+'''
+# @file
+#
+# Copyright 2023, Verizon Media
+# SPDX-License-Identifier: Apache-2.0
+#
+
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from aioquic.tls import CipherSuite, SessionTicket
+
+
+class SessionTicketStore:
+    """
+    A bounded store of session tickets, keyed by ticket label.
+
+    Servers hand the tickets they issue to add() and look the tickets
+    clients present up with pop(), each ticket being usable once. Clients
+    hand the tickets they receive to add() and take one for the server they
+    reconnect to with find().
+
+    At most capacity tickets are kept, the least recently added being
+    evicted first, and tickets are dropped ttl seconds after they were
+    added, or once they are no longer valid, whichever is first. hits and
+    misses count the lookups that did and did not find a ticket.
+
+    >>> from types import SimpleNamespace
+    >>> def Ticket(label):
+    ...     return SimpleNamespace(ticket=label, server_name='example.com', is_valid=True)
+    >>> store = SessionTicketStore(capacity=2)
+    >>> for label in (b'a', b'b', b'c'):
+    ...     store.add(Ticket(label))
+    >>> store.pop(b'a') is None, store.pop(b'c').ticket, store.pop(b'c') is None
+    (True, b'c', True)
+    >>> store.find('example.com').ticket, store.find('example.com') is None
+    (b'b', True)
+    >>> store.summary()
+    'hits=2 misses=3 evictions=1'
+
+    With a directory, the tickets are also kept in files, so that the proxy
+    processes sharing the directory share the tickets: a client can resume
+    its session with whichever process receives its next connection. The
+    files are read and written in the background, so a ticket reaches the
+    other processes once they next scan the directory.
+
+    >>> import tempfile
+    >>> now = datetime.datetime.now(datetime.timezone.utc)
+    >>> ticket = SessionTicket(
+    ...     age_add=1, cipher_suite=CipherSuite.AES_128_GCM_SHA256,
+    ...     not_valid_after=now + datetime.timedelta(hours=1), not_valid_before=now,
+    ...     resumption_secret=b'secret', server_name='example.com', ticket=b'd')
+    >>> directory = tempfile.mkdtemp()
+    >>> this_process = SessionTicketStore(directory=directory)
+    >>> this_process.add(ticket)
+    >>> this_process.close()
+    >>> other_process = SessionTicketStore(directory=directory)
+    >>> other_process.sync()
+    >>> other_process.pop(b'd') == ticket, other_process.pop(b'd') is None
+    (True, True)
+    >>> other_process.close()
+    """
+
+    DEFAULT_CAPACITY = 10000
+    DEFAULT_TTL = 3600
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, ttl=DEFAULT_TTL, directory=None):
+        """
+        Args:
+            capacity: The most tickets to keep.
+
+            ttl: How long to keep a ticket, in seconds.
+
+            directory: An existing directory to keep the tickets in, shared
+            with other processes, or None to keep them in memory.
+        """
+        if capacity < 1:
+            raise ValueError(f"Invalid session ticket capacity: {capacity}")
+        self.capacity = capacity
+        self.ttl = ttl
+        if directory is None:
+            self._storage = _MemoryStorage(self)
+        else:
+            self._storage = _DirectoryStorage(self, directory)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, ticket):
+        self._storage.put(ticket.ticket, ticket)
+
+    def pop(self, label):
+        """
+        Take the ticket with the given label, or return None.
+        """
+        return self._count(self._storage.take(label))
+
+    def find(self, server_name):
+        """
+        Take the most recently added ticket received from server_name, or
+        return None.
+        """
+        for label in self._storage.labels_newest_first():
+            ticket = self._storage.peek(label)
+            if ticket is not None and ticket.server_name == server_name:
+                ticket = self._storage.take(label)
+                if ticket is not None:
+                    return self._count(ticket)
+        return self._count(None)
+
+    def summary(self):
+        return f"hits={self.hits} misses={self.misses} evictions={self.evictions}"
+
+    def sync(self):
+        """
+        Wait for the tickets added and taken so far to be written to the
+        directory and for the tickets the other processes added to be read,
+        if the tickets are kept in a directory.
+        """
+        self._storage.sync()
+
+    def close(self):
+        """
+        Write out the tickets added and taken so far, if the tickets are kept
+        in a directory, and stop the background thread doing so.
+        """
+        self._storage.close()
+
+    def _count(self, ticket):
+        if ticket is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return ticket
+
+
+class _MemoryStorage:
+    """
+    Keeps a SessionTicketStore's tickets in memory.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        # label -> (expiry, ticket), the least recently added first.
+        self._tickets = collections.OrderedDict()
+
+    def put(self, label, ticket, expiry=None):
+        """
+        Keep a ticket until expiry, a time.monotonic() time, or for the
+        store's ttl.
+        """
+        if expiry is None:
+            expiry = time.monotonic() + self._store.ttl
+        self._tickets.pop(label, None)
+        self._tickets[label] = (expiry, ticket)
+        while len(self._tickets) > self._store.capacity:
+            self._tickets.popitem(last=False)
+            self._store.evictions += 1
+
+    def take(self, label):
+        ticket = self.peek(label)
+        self._tickets.pop(label, None)
+        return ticket
+
+    def peek(self, label):
+        expiry, ticket = self._tickets.get(label, (None, None))
+        if ticket is None:
+            return None
+        if expiry < time.monotonic() or not ticket.is_valid:
+            del self._tickets[label]
+            return None
+        return ticket
+
+    def labels_newest_first(self):
+        return list(reversed(self._tickets))
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _DirectoryStorage:
+    """
+    Keeps a SessionTicketStore's tickets in a directory, a file per ticket,
+    as well as in memory.
+
+    The store's callers, the event loop's session ticket callbacks, only
+    use an in-memory index of the tickets, a _MemoryStorage. A background
+    thread writes the file of each ticket added, removes the file of each
+    ticket taken, and every RESCAN_INTERVAL seconds reads the tickets that
+    other processes added into the index and sweeps the directory of
+    expired and excess tickets. A ticket whose file another process removed
+    is dropped from the index at the next rescan, so that a ticket is
+    normally only used once: only two processes taking it within a rescan
+    of each other both use it.
+
+    A file holds its ticket's fields as JSON, and is written to a temporary
+    name and then renamed, so that no process reads a partial ticket. Its
+    modification time records when the ticket was added.
+    """
+
+    # How often to read the tickets the other processes added and remove
+    # expired and excess tickets, in seconds.
+    RESCAN_INTERVAL = 1.0
+
+    _STOP = object()
+
+    def __init__(self, store, directory):
+        if not os.path.isdir(directory):
+            raise ValueError(f"Session ticket directory '{directory}' does not exist")
+        self._store = store
+        self._directory = directory
+        self._index = _MemoryStorage(store)
+        # File name -> label of the tickets in the index, and the file names
+        # of those whose files a rescan found.
+        self._labels = {}
+        self._on_disk = set()
+        # Operations for the background thread: ('write', name, ticket),
+        # ('remove', name) and ('sync', event).
+        self._operations = queue.SimpleQueue()
+        # The results of the rescans: (tickets read, as (name, added time,
+        # ticket), names of all the ticket files).
+        self._rescans = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name='session-ticket-files', daemon=True)
+        self._thread.start()
+
+    def put(self, label, ticket):
+        self._apply_rescans()
+        name = self._name(label)
+        self._labels[name] = label
+        self._index.put(label, ticket)
+        self._operations.put(('write', name, ticket))
+
+    def take(self, label):
+        self._apply_rescans()
+        ticket = self._index.take(label)
+        name = self._name(label)
+        if self._labels.pop(name, None) is not None:
+            self._on_disk.discard(name)
+            self._operations.put(('remove', name))
+        return ticket
+
+    def peek(self, label):
+        self._apply_rescans()
+        return self._index.peek(label)
+
+    def labels_newest_first(self):
+        self._apply_rescans()
+        return self._index.labels_newest_first()
+
+    def sync(self):
+        event = threading.Event()
+        self._operations.put(('sync', event))
+        event.wait()
+        self._apply_rescans()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._operations.put(_DirectoryStorage._STOP)
+            self._thread.join()
+
+    @staticmethod
+    def _name(label):
+        return hashlib.sha256(label).hexdigest()
+
+    def _apply_rescans(self):
+        """
+        Bring the index up to date with the rescans done since the last call.
+        """
+        while True:
+            try:
+                read, names = self._rescans.get_nowait()
+            except queue.Empty:
+                return
+            for name, added, ticket in read:
+                if name not in self._labels:
+                    self._labels[name] = ticket.ticket
+                    expiry = time.monotonic() + added + self._store.ttl - time.time()
+                    self._index.put(ticket.ticket, ticket, expiry)
+            for name in self._on_disk - names:
+                # Another process took the ticket, or it expired.
+                label = self._labels.pop(name, None)
+                if label is not None:
+                    self._index.take(label)
+            self._on_disk = names & self._labels.keys()
+
+    def _run(self):
+        """
+        Carry out the operations queued for the background thread and rescan
+        the directory every RESCAN_INTERVAL seconds.
+        """
+        # The files this thread wrote or already read.
+        known = set()
+        next_rescan = time.monotonic()
+        while True:
+            try:
+                operation = self._operations.get(
+                    timeout=max(0, next_rescan - time.monotonic()))
+            except queue.Empty:
+                operation = None
+            if operation is _DirectoryStorage._STOP:
+                return
+            try:
+                if operation is None or operation[0] == 'sync':
+                    self._rescan(known)
+                    next_rescan = time.monotonic() + self.RESCAN_INTERVAL
+                    if operation is not None:
+                        operation[1].set()
+                elif operation[0] == 'write':
+                    _, name, ticket = operation
+                    known.add(name)
+                    self._write(name, ticket)
+                else:
+                    _, name = operation
+                    try:
+                        os.unlink(os.path.join(self._directory, name))
+                    except FileNotFoundError:
+                        pass
+            except OSError as e:
+                print(f"Failed to update session ticket directory '{self._directory}': {e}",
+                      file=sys.stderr)
+
+    def _write(self, name, ticket):
+        path = os.path.join(self._directory, name)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write(_encode_ticket(ticket))
+        os.replace(temporary_path, path)
+
+    def _rescan(self, known):
+        """
+        Read the tickets added since the last rescan, remove the expired and
+        excess ones, and pass the tickets read and the names of the files left
+        to _apply_rescans.
+        """
+        files = sorted(self._ticket_files(), key=lambda entry: entry[1])
+        expired_before = time.time() - self._store.ttl
+        excess = len(files) - self._store.capacity
+        kept = []
+        for name, modified in files:
+            if modified < expired_before or excess > 0:
+                excess -= 1
+                try:
+                    os.unlink(os.path.join(self._directory, name))
+                except FileNotFoundError:
+                    pass
+            else:
+                kept.append((name, modified))
+        read = []
+        for name, modified in kept:
+            if name in known:
+                continue
+            try:
+                with open(os.path.join(self._directory, name), encoding='utf-8') as f:
+                    ticket = _decode_ticket(f.read())
+            except FileNotFoundError:
+                # Another process took it.
+                continue
+            except ValueError as e:
+                print(f"Ignoring malformed session ticket file {name}: {e}", file=sys.stderr)
+            else:
+                read.append((name, modified, ticket))
+            known.add(name)
+        names = {name for name, _ in kept}
+        known &= names
+        self._rescans.put((read, names))
+
+    def _ticket_files(self):
+        """
+        Return (name, modification time) for each ticket file.
+        """
+        files = []
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if '.' in entry.name:
+                    # Being written.
+                    continue
+                try:
+                    files.append((entry.name, entry.stat().st_mtime))
+                except FileNotFoundError:
+                    continue
+        return files
+
+
+def _encode_ticket(ticket):
+    """
+    Return the JSON text of a SessionTicket's fields.
+
+    >>> now = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    >>> ticket = SessionTicket(
+    ...     age_add=1, cipher_suite=CipherSuite.AES_128_GCM_SHA256,
+    ...     not_valid_after=now, not_valid_before=now, resumption_secret=b'secret',
+    ...     server_name='example.com', ticket=b'label', max_early_data_size=16,
+    ...     other_extensions=[(42, b'')])
+    >>> _decode_ticket(_encode_ticket(ticket)) == ticket
+    True
+    """
+    return json.dumps({
+        'age_add': ticket.age_add,
+        'cipher_suite': int(ticket.cipher_suite),
+        'not_valid_after': ticket.not_valid_after.isoformat(),
+        'not_valid_before': ticket.not_valid_before.isoformat(),
+        'resumption_secret': ticket.resumption_secret.hex(),
+        'server_name': ticket.server_name,
+        'ticket': ticket.ticket.hex(),
+        'max_early_data_size': ticket.max_early_data_size,
+        'other_extensions': [
+            [extension_type, value.hex()] for extension_type, value in ticket.other_extensions],
+    })
+
+
+def _decode_ticket(text):
+    """
+    Return the SessionTicket whose fields _encode_ticket encoded.
+
+    Raises:
+        ValueError: The text is not such an encoding.
+    """
+    try:
+        fields = json.loads(text)
+        return SessionTicket(
+            age_add=int(fields['age_add']),
+            cipher_suite=CipherSuite(fields['cipher_suite']),
+            not_valid_after=datetime.datetime.fromisoformat(fields['not_valid_after']),
+            not_valid_before=datetime.datetime.fromisoformat(fields['not_valid_before']),
+            resumption_secret=bytes.fromhex(fields['resumption_secret']),
+            server_name=fields['server_name'],
+            ticket=bytes.fromhex(fields['ticket']),
+            max_early_data_size=fields['max_early_data_size'],
+            other_extensions=[
+                (int(extension_type), bytes.fromhex(value))
+                for extension_type, value in fields['other_extensions']])
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid session ticket: {e!r}") from e
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -10,11 +10,17 @@ Implement the common test proxy logic.
 
 import argparse
 import os
+from pathlib import Path
+import signal
 import sys
 
 import proxy_http1
 import proxy_http2
 import proxy_http3
+from connection_pool import UpstreamConnectionPool
+from quic_steering import create_steered_sockets
+from transaction_log import TransactionLog, parse_sample_rates
+from workers import WorkerCounters, WorkerSupervisor
 
 
 def parse_args():
@@ -31,6 +37,25 @@ def parse_args():
                         help='The certificate authority file for verifying peers')
     parser.add_argument('--listening-http3-sentinel', type=str, default=None,
                         help='A sentinel file to touch when the HTTP/3 socket is listening.')
+    parser.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='The number of proxy processes to run, each listening on '
+                        'the port via SO_REUSEPORT. HTTP/3 packets are steered to the '
+                        'process owning their connection by its connection ID.')
+    parser.add_argument('--log-format', choices=TransactionLog.FORMATS, default='text',
+                        help='The format of the HTTP/1 proxy transaction log.')
+    parser.add_argument('--log-level', choices=TransactionLog.LEVELS, default='full',
+                        help='What to record in the HTTP/1 proxy transaction log: '
+                        'nothing, everything but the bodies, or everything.')
+    parser.add_argument('--log-sample', metavar='FIELD=N', action='append', default=[],
+                        help='Only record FIELD in the transaction log for 1 in every N '
+                        'transactions. May be passed multiple times.')
+    parser.add_argument('--log-file', type=str, default=None,
+                        help='The file to write the transaction log to. Defaults to stdout.')
+    parser.add_argument('--qlog-sample', metavar='N', type=int, default=1,
+                        help='Only write qlog traces for 1 in every N HTTP/3 connections.')
+    parser.add_argument('--session-ticket-dir', type=str, default=None,
+                        help='Keep the HTTP/3 session tickets in this directory so that '
+                        'the proxy processes sharing it resume each other\'s sessions.')
 
     proto_group = parser.add_mutually_exclusive_group()
     proto_group.add_argument('--http2_to_1', action="store_true",
@@ -39,6 +64,10 @@ def parse_args():
                              help='Listen for HTTP/2 connections and talk HTTP/2 to the server.')
     proto_group.add_argument('--http3_to_1', action="store_true",
                              help='Listen for HTTP/3 connections and talk HTTP/1 to the server.')
+    proto_group.add_argument('--http3_to_2', action="store_true",
+                             help='Listen for HTTP/3 connections and talk HTTP/2 to the server.')
+    proto_group.add_argument('--http3_to_3', action="store_true",
+                             help='Listen for HTTP/3 connections and talk HTTP/3 to the server.')
 
     args = parser.parse_args()
 
@@ -46,14 +75,129 @@ def parse_args():
         if not os.path.isfile(args.https_pem):
             raise argparse.ArgumentTypeError(
                 "--https-pem argument is not a file: {}".format(args.https_pem))
+    if args.workers < 1:
+        raise argparse.ArgumentTypeError(
+            "--workers argument must be at least 1: {}".format(args.workers))
+    if args.qlog_sample < 1:
+        raise argparse.ArgumentTypeError(
+            "--qlog-sample argument must be at least 1: {}".format(args.qlog_sample))
+    try:
+        args.log_sample = parse_sample_rates(args.log_sample)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"--log-sample: {e}")
     return args
 
 
+def create_transaction_log(args, worker_id=None):
+    stream = None
+    if args.log_file:
+        log_file = args.log_file
+        if worker_id is not None:
+            log_file = f"{log_file}.{worker_id}"
+        stream = open(log_file, 'a', encoding='utf-8')
+    return TransactionLog(
+        stream=stream,
+        log_format=args.log_format,
+        level=args.log_level,
+        sample_rates=args.log_sample)
+
+
+def run_http1_worker(args, worker_id, server_context):
+    """
+    Run one of several HTTP/1 proxy processes sharing the listen port.
+    """
+    handler = proxy_http1.ProxyRequestHandler
+    # Connections to the origin are not shared across processes.
+    handler.upstream_pool = UpstreamConnectionPool()
+    transaction_log = create_transaction_log(args, worker_id)
+    try:
+        proxy_http1.configure_http1_server(
+            handler, proxy_http1.ThreadingHTTPServer,
+            "HTTP/1.1", args.listen_port, args.server_port, args.https_pem,
+            transaction_log=transaction_log, reuse_port=True,
+            server_context=server_context)
+    finally:
+        transaction_log.close()
+    return 0
+
+
+def run_http2_workers(args, h2_to_server):
+    """
+    Run the HTTP/2 proxy in several processes sharing the listen port.
+
+    The workers' combined counters are printed when the workers stop, and
+    whenever the supervising process receives SIGUSR1.
+    """
+    # Created before forking so the workers share session ticket keys.
+    server_context = proxy_http2.create_server_context(args.https_pem)
+    counters = WorkerCounters(proxy_http2.Http2ConnectionManager.COUNTER_NAMES, args.workers)
+
+    def run_worker(worker_id):
+        counters.worker_id = worker_id
+        proxy_http2.Http2ConnectionManager.counters = counters
+        proxy_http2.configure_http2_server(
+            args.listen_port,
+            args.server_port,
+            args.https_pem,
+            args.ca_pem,
+            h2_to_server=h2_to_server,
+            server_context=server_context)
+        return 0
+
+    previous_handler = signal.signal(
+        signal.SIGUSR1, lambda signum, frame: print(counters.summary(), flush=True))
+    try:
+        status = WorkerSupervisor(args.workers, run_worker).run()
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+    print(counters.summary())
+    return status
+
+
+def run_http3_workers(args):
+    """
+    Run the HTTP/3 proxy in several processes sharing the listen port.
+
+    The UDP sockets are bound before forking, one per worker, so that the
+    sentinel can be touched once the port is listening and a restarted
+    worker takes over its predecessor's socket.
+    """
+    sockets = create_steered_sockets('0.0.0.0', args.listen_port, args.workers)
+    if args.listening_http3_sentinel:
+        Path(args.listening_http3_sentinel).touch()
+
+    def run_worker(worker_id):
+        for other_id, sock in enumerate(sockets):
+            if other_id != worker_id:
+                sock.close()
+        proxy_http3.configure_http3_server(
+            args.listen_port,
+            args.server_port,
+            args.https_pem,
+            args.https_pem,
+            None,
+            h3_to_server=args.http3_to_3,
+            h2_to_server=args.http3_to_2,
+            qlog_sample_rate=args.qlog_sample,
+            session_ticket_directory=args.session_ticket_dir,
+            sock=sockets[worker_id],
+            worker_id=worker_id)
+        return 0
+
+    try:
+        return WorkerSupervisor(args.workers, run_worker).run()
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
 def main():
     args = parse_args()
 
     try:
-        if args.http2_to_1:
+        if (args.http2_to_1 or args.http2_to_2) and args.workers > 1:
+            return run_http2_workers(args, h2_to_server=args.http2_to_2)
+        elif args.http2_to_1:
             proxy_http2.configure_http2_server(
                 args.listen_port,
                 args.server_port,
@@ -67,7 +211,9 @@ def main():
                 args.https_pem,
                 args.ca_pem,
                 h2_to_server=True)
-        elif args.http3_to_1:
+        elif (args.http3_to_1 or args.http3_to_2 or args.http3_to_3) and args.workers > 1:
+            return run_http3_workers(args)
+        elif args.http3_to_1 or args.http3_to_2 or args.http3_to_3:
             # TODO: why is the ca and the server cert both https.pem? That
             # seems to be the needed thing to do.
             proxy_http3.configure_http3_server(
@@ -76,11 +222,23 @@ def main():
                 args.https_pem,
                 args.https_pem,
                 args.listening_http3_sentinel,
-                h3_to_server=False)
+                h3_to_server=args.http3_to_3,
+                h2_to_server=args.http3_to_2,
+                qlog_sample_rate=args.qlog_sample,
+                session_ticket_directory=args.session_ticket_dir)
+        elif args.workers > 1:
+            server_context = None
+            if args.https_pem:
+                # Created before forking so the workers share session ticket keys.
+                server_context = proxy_http1.create_server_context(args.https_pem)
+            return WorkerSupervisor(
+                args.workers,
+                lambda worker_id: run_http1_worker(args, worker_id, server_context)).run()
         else:
             proxy_http1.configure_http1_server(
                 proxy_http1.ProxyRequestHandler, proxy_http1.ThreadingHTTPServer,
-                "HTTP/1.1", args.listen_port, args.server_port, args.https_pem)
+                "HTTP/1.1", args.listen_port, args.server_port, args.https_pem,
+                transaction_log=create_transaction_log(args))
     except KeyboardInterrupt:
         print("Received KeyboardInterrupt. Exiting gracefully.")
 
@@ -0,0 +1,214 @@
+'''
+Implement an asynchronous transaction log for the test proxies.
+'''
+# @file
+#
+# Copyright 2023, Verizon Media
+# SPDX-License-Identifier: Apache-2.0
+#
+
+
+import atexit
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+
+class TransactionLog:
+    """
+    Log proxied transactions without serializing the proxy threads.
+
+    Proxy threads hand each transaction to log() as a dict of fields. The
+    fields are queued and a background writer thread renders and writes
+    them, flushing the stream whenever the queue runs empty. Nothing on the
+    proxy threads' path takes a lock or waits on stream I/O.
+
+    Records are either rendered as human readable text, via a per-proxy
+    render function, or as JSON lines. The level controls which fields are
+    recorded at all:
+
+        none: Nothing is logged.
+        headers: Everything but the message bodies is logged.
+        full: Everything is logged.
+
+    Additionally, any field can be sampled so that it is only recorded for 1
+    in every N transactions.
+
+    >>> import io
+    >>> stream = io.StringIO()
+    >>> log = TransactionLog(stream=stream, log_format='json', level='headers',
+    ...                      sample_rates={'request_headers': 2})
+    >>> for i in range(2):
+    ...     log.log({'status': 200 + i, 'request_headers': [['host', 'a']],
+    ...              'request_body': b'abc'}, None)
+    >>> log.close()
+    >>> for line in stream.getvalue().splitlines():
+    ...     record = json.loads(line)
+    ...     del record['time']
+    ...     print(sorted(record.items()))
+    [('request_headers', [['host', 'a']]), ('status', 200)]
+    [('status', 201)]
+    """
+
+    FORMATS = ('text', 'json')
+    LEVELS = ('none', 'headers', 'full')
+    # The fields dropped at the headers level.
+    BODY_FIELDS = frozenset(('request_body', 'response_body'))
+
+    _STOP = object()
+
+    def __init__(self, stream=None, log_format='text', level='full', sample_rates=None):
+        """
+        Args:
+            stream: The stream to write to. Defaults to sys.stdout, as it is
+            when the record is written.
+
+            log_format: One of FORMATS.
+
+            level: One of LEVELS.
+
+            sample_rates: A dict mapping field names to N, the field being
+            recorded for 1 in every N transactions.
+        """
+        if log_format not in TransactionLog.FORMATS:
+            raise ValueError(f"Unknown transaction log format: {log_format}")
+        if level not in TransactionLog.LEVELS:
+            raise ValueError(f"Unknown transaction log level: {level}")
+        self._stream = stream
+        self._log_format = log_format
+        self._level = level
+        self._sample_rates = dict(sample_rates or {})
+        for field, rate in self._sample_rates.items():
+            if rate < 1:
+                raise ValueError(f"Invalid sample rate for {field}: {rate}")
+        self._start_lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # The writer thread does not survive a fork. Give the child its own.
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._queue = queue.SimpleQueue()
+        self._writer = None
+        self._closed = False
+        # itertools.count is advanced atomically, which keeps sampling
+        # lock-free.
+        self._sample_counters = {
+            field: itertools.count() for field in self._sample_rates}
+
+    @property
+    def enabled(self):
+        """
+        Whether log() records anything. Callers can use this to skip building
+        the fields altogether.
+        """
+        return self._level != 'none'
+
+    @property
+    def log_bodies(self):
+        """
+        Whether message bodies are recorded.
+        """
+        return self._level == 'full'
+
+    def log(self, fields, render_text):
+        """
+        Queue a transaction for logging.
+
+        Args:
+            fields: A dict describing the transaction. Its values must not be
+            modified after this call. bytes values are written to JSON as
+            strings.
+
+            render_text: A function rendering the (possibly level and sample
+            filtered) fields as text, called on the writer thread. It is only
+            used for the text format.
+        """
+        if not self.enabled or self._closed:
+            return
+        if not self.log_bodies:
+            fields = {k: v for k, v in fields.items() if k not in TransactionLog.BODY_FIELDS}
+        for field, rate in self._sample_rates.items():
+            if field in fields and next(self._sample_counters[field]) % rate != 0:
+                del fields[field]
+        fields.setdefault('time', time.time())
+        if self._writer is None:
+            self._start_writer()
+        self._queue.put((fields, render_text))
+
+    def close(self):
+        """
+        Write out everything queued so far and stop the writer thread.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._queue.put(TransactionLog._STOP)
+            self._writer.join()
+
+    def _start_writer(self):
+        with self._start_lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(
+                target=self._write_records, name='transaction-log', daemon=True)
+            self._writer.start()
+
+    def _write_records(self):
+        while True:
+            item = self._queue.get()
+            stream = self._stream if self._stream is not None else sys.stdout
+            # Write everything that has queued up, then flush once.
+            while True:
+                if item is TransactionLog._STOP:
+                    stream.flush()
+                    return
+                try:
+                    stream.write(self._render(*item))
+                except Exception as e:
+                    print(f"Failed to write a transaction log record: {e}", file=sys.stderr)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            stream.flush()
+
+    def _render(self, fields, render_text):
+        if self._log_format == 'text':
+            return render_text(fields)
+        return json.dumps(fields, default=_json_default) + '\n'
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', errors='backslashreplace')
+    return str(value)
+
+
+def parse_sample_rates(specifications):
+    """
+    Parse field sampling specifications of the form FIELD=N.
+
+    >>> parse_sample_rates(['request_body=10', 'response_headers=2'])
+    {'request_body': 10, 'response_headers': 2}
+    >>> parse_sample_rates([])
+    {}
+    """
+    sample_rates = {}
+    for specification in specifications or []:
+        field, separator, rate = specification.partition('=')
+        if not separator or not field:
+            raise ValueError(f"Expected FIELD=N, got: {specification}")
+        sample_rates[field] = int(rate)
+    return sample_rates
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
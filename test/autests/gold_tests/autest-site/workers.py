@@ -0,0 +1,209 @@
+'''
+Implement a supervisor for running the test proxy in several processes, and
+counters shared by those processes.
+'''
+# @file
+#
+# Copyright 2023, Verizon Media
+# SPDX-License-Identifier: Apache-2.0
+#
+
+
+import ctypes
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+
+class WorkerSupervisor:
+    """
+    Fork and supervise a fixed number of proxy worker processes.
+
+    Each worker runs run_worker(worker_id) and is expected to bind its own
+    listening socket with SO_REUSEPORT so that the kernel spreads incoming
+    connections across the workers. A worker that exits is restarted unless
+    the supervisor is shutting down. Workers that keep failing right after
+    being started, as they would if the listen port cannot be bound, make the
+    supervisor give up rather than restarting them forever.
+
+    >>> def run_worker(worker_id):
+    ...     return 0 if worker_id == 0 else 3
+    >>> supervisor = WorkerSupervisor(2, run_worker, max_quick_failures=2)
+    >>> supervisor.run()  # doctest: +ELLIPSIS
+    Worker 1 (pid ...) exited with status 3.
+    Worker 1 (pid ...) exited with status 3.
+    Worker 1 keeps failing on start up, stopping all workers.
+    1
+    """
+
+    def __init__(self, num_workers, run_worker, min_uptime=1.0, max_quick_failures=5):
+        """
+        Args:
+            num_workers: The number of worker processes to keep running.
+
+            run_worker: A callable taking the worker id, 0 through
+            num_workers - 1, run in the forked worker. Its return value is the
+            worker's exit status.
+
+            min_uptime: A worker exiting within this many seconds of being
+            started counts as a quick failure.
+
+            max_quick_failures: The number of consecutive quick failures of a
+            worker after which the supervisor stops all workers.
+        """
+        if num_workers < 1:
+            raise ValueError(f"Invalid number of workers: {num_workers}")
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.min_uptime = min_uptime
+        self.max_quick_failures = max_quick_failures
+        # pid -> (worker id, start time)
+        self._workers = {}
+        self._quick_failures = [0] * num_workers
+        self._stopping = False
+
+    def run(self):
+        """
+        Start the workers and supervise them until they are all stopped.
+
+        Returns:
+            The exit status for the supervising process.
+        """
+        previous_handlers = {
+            signum: signal.signal(signum, self._handle_stop)
+            for signum in (signal.SIGINT, signal.SIGTERM)}
+        status = 0
+        try:
+            for worker_id in range(self.num_workers):
+                self._spawn(worker_id)
+            while self._workers:
+                try:
+                    pid, wait_status = os.wait()
+                except ChildProcessError:
+                    break
+                worker_id, started_at = self._workers.pop(pid, (None, None))
+                if worker_id is None or self._stopping:
+                    continue
+                exit_code = os.waitstatus_to_exitcode(wait_status)
+                if exit_code == 0:
+                    # A worker shutting down cleanly is not restarted.
+                    continue
+                print(f"Worker {worker_id} (pid {pid}) exited with status {exit_code}.")
+                if time.monotonic() - started_at < self.min_uptime:
+                    self._quick_failures[worker_id] += 1
+                else:
+                    self._quick_failures[worker_id] = 0
+                if self._quick_failures[worker_id] >= self.max_quick_failures:
+                    print(f"Worker {worker_id} keeps failing on start up, stopping all workers.")
+                    status = 1
+                    self._stop_workers()
+                    continue
+                self._spawn(worker_id)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        return status
+
+    def _spawn(self, worker_id):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(worker_id)
+        self._workers[pid] = (worker_id, time.monotonic())
+
+    def _run_child(self, worker_id):
+        """
+        Run a worker in the forked child. This never returns.
+        """
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        exit_code = 1
+        try:
+            exit_code = self.run_worker(worker_id) or 0
+        except KeyboardInterrupt:
+            exit_code = 0
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Do not run the supervisor's atexit handlers or unwind into its
+            # stack.
+            os._exit(exit_code)
+
+    def _handle_stop(self, signum, frame):
+        self._stop_workers()
+
+    def _stop_workers(self):
+        self._stopping = True
+        for pid in list(self._workers):
+            try:
+                # Workers treat SIGINT as a request to shut down gracefully.
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+
+class WorkerCounters:
+    """
+    Counters shared by the workers and readable in one place.
+
+    The counters live in shared memory, which must be created before the
+    workers are forked. Each worker only adds to its own set of counters, so
+    the workers never contend for a lock, while totals() sums them across all
+    workers for whoever reads them, typically the supervising process. Within
+    a worker, add is not safe to call from several native threads at once.
+
+    >>> counters = WorkerCounters(('streams', 'response_bytes'), num_workers=2)
+    >>> counters.worker_id = 1
+    >>> counters.add('streams')
+    >>> counters.add('response_bytes', 10)
+    >>> counters.worker_id = 0
+    >>> counters.add('streams')
+    >>> counters.totals()
+    {'streams': 2, 'response_bytes': 10}
+    >>> counters.summary()
+    'Totals across 2 workers: streams=2 response_bytes=10'
+    """
+
+    def __init__(self, names, num_workers):
+        """
+        Args:
+            names: The names of the counters.
+
+            num_workers: The number of workers adding to the counters.
+        """
+        self.names = tuple(names)
+        self.num_workers = num_workers
+        self._positions = {name: i for i, name in enumerate(self.names)}
+        # The counters of worker N are at N * len(names) onwards.
+        self._values = multiprocessing.RawArray(
+            ctypes.c_uint64, len(self.names) * num_workers)
+        # Set by each worker, after the fork, to its own id.
+        self.worker_id = 0
+
+    def add(self, name, amount=1):
+        """
+        Add to one of the current worker's counters.
+        """
+        self._values[self.worker_id * len(self.names) + self._positions[name]] += amount
+
+    def totals(self):
+        """
+        Return a dict of each counter's sum across the workers.
+        """
+        stride = len(self.names)
+        return {name: sum(self._values[i::stride]) for i, name in enumerate(self.names)}
+
+    def summary(self):
+        totals = ' '.join(f"{name}={value}" for name, value in self.totals().items())
+        return f"Totals across {self.num_workers} workers: {totals}"
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()